@@ -4,30 +4,49 @@ import os
 import json
 import shutil
 import subprocess
+import tempfile
+import uuid
+import csv
+import itertools
+import calendar
+import hashlib
 
 import smtplib 
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart 
 import requests 
+from requests.adapters import HTTPAdapter
 import threading 
+from concurrent.futures import ThreadPoolExecutor
+import time
 import pandas as pd 
+import numpy as np
 from io import BytesIO, StringIO
 from zoneinfo import ZoneInfo 
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user, login_url
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, abort, g, jsonify, Response, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, send_file, abort, g, jsonify, Response, make_response, stream_with_context, session
 from werkzeug.utils import secure_filename
 import openpyxl 
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 from openpyxl.styles.borders import Border, Side
 from openpyxl.utils.dataframe import dataframe_to_rows 
 from openpyxl.utils import get_column_letter 
+from openpyxl.cell import WriteOnlyCell
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Parquet é opcional; sem pyarrow só CSV/Excel ficam disponíveis
+    pa = None
+    pq = None
 
 from database import DatabaseManager 
 from werkzeug.security import generate_password_hash, check_password_hash
 from database import DatabaseManager # Assumindo que DatabaseManager está em database.py
+from notificacoes_render import RenderizadorNotificacoes
 ANEXOS_BASE_DIR_NAME = "anexos_certificados_flask"
 ANEXOS_EMPRESAS_DIR_NAME = "anexos_empresas_iso" 
+EXPORTACOES_DIR_NAME = "exportacoes_flask"
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 NOTIFICACAO_CONFIG_FILE_NAME = "notificacao_config_flask.json" 
 NOTIFICACAO_CONFIG_FILE_PATH = os.path.join(BASE_DIR, NOTIFICACAO_CONFIG_FILE_NAME)
@@ -39,8 +58,53 @@ app = Flask(__name__)
 app.secret_key = os.urandom(24) 
 app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, ANEXOS_BASE_DIR_NAME)
 app.config['UPLOAD_FOLDER_EMPRESAS'] = os.path.join(BASE_DIR, ANEXOS_EMPRESAS_DIR_NAME) 
+app.config['EXPORT_FOLDER'] = os.path.join(BASE_DIR, EXPORTACOES_DIR_NAME)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  
 app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'png', 'jpg', 'jpeg', 'doc', 'docx', 'xls', 'xlsx'} # Adicionado mais extensões
+# PRAGMAs do SQLite (WAL permite leituras concorrentes enquanto uma escrita está em andamento)
+app.config['DB_SQLITE_PRAGMAS'] = {
+    'journal_mode': os.environ.get('CALIBRACAO_DB_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('CALIBRACAO_DB_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.environ.get('CALIBRACAO_DB_CACHE_SIZE', -16000)),
+    'mmap_size': int(os.environ.get('CALIBRACAO_DB_MMAP_SIZE', 134217728)),
+    'busy_timeout': int(os.environ.get('CALIBRACAO_DB_BUSY_TIMEOUT', 5000)),
+}
+# Atualização de status em segundo plano: horário da execução diária e intervalo de verificação (s)
+app.config['STATUS_REFRESH_HORARIO'] = os.environ.get('CALIBRACAO_STATUS_HORARIO', '00:05')
+app.config['STATUS_REFRESH_INTERVALO'] = int(os.environ.get('CALIBRACAO_STATUS_INTERVALO', 60))
+# Exportações em segundo plano: threads do pool e tempo (s) que o arquivo gerado fica disponível
+app.config['EXPORT_JOB_WORKERS'] = int(os.environ.get('CALIBRACAO_EXPORT_WORKERS', 2))
+app.config['EXPORT_JOB_TTL'] = int(os.environ.get('CALIBRACAO_EXPORT_TTL', 3600))
+# Usuários: cache do user_loader (capacidade/TTL em s) e, opcionalmente, claims assinados na sessão
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('CALIBRACAO_USER_CACHE_SIZE', 256))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('CALIBRACAO_USER_CACHE_TTL', 300))
+app.config['USER_SESSION_CLAIMS'] = os.environ.get('CALIBRACAO_USER_SESSION_CLAIMS', '0') == '1'
+# Z-API: envios simultâneos (conexões keep-alive) e tentativas por destinatário
+app.config['ZAPI_CONCORRENCIA'] = int(os.environ.get('CALIBRACAO_ZAPI_CONCORRENCIA', 5))
+app.config['ZAPI_TENTATIVAS'] = int(os.environ.get('CALIBRACAO_ZAPI_TENTATIVAS', 3))
+app.config['ZAPI_BACKOFF'] = float(os.environ.get('CALIBRACAO_ZAPI_BACKOFF', 1.0))
+# Fila de notificações: varredura (s), tentativas por item e backoff exponencial entre elas (base/teto em s)
+app.config['NOTIFICACAO_FILA_INTERVALO'] = float(os.environ.get('CALIBRACAO_NOTIFICACAO_INTERVALO', 5))
+app.config['NOTIFICACAO_FILA_TENTATIVAS'] = int(os.environ.get('CALIBRACAO_NOTIFICACAO_TENTATIVAS', 5))
+app.config['NOTIFICACAO_FILA_BACKOFF'] = float(os.environ.get('CALIBRACAO_NOTIFICACAO_BACKOFF', 60))
+app.config['NOTIFICACAO_FILA_BACKOFF_MAX'] = float(os.environ.get('CALIBRACAO_NOTIFICACAO_BACKOFF_MAX', 3600))
+# Item 'enviando' há mais que isso (s) é de um processo que caiu e volta para a fila
+app.config['NOTIFICACAO_FILA_TRAVADA'] = float(os.environ.get('CALIBRACAO_NOTIFICACAO_TRAVADA', 900))
+# SMTP local para testes ("host:porta", ex.: python -m aiosmtpd -n -l 127.0.0.1:1025): sem TLS e sem login
+app.config['SMTP_SINK'] = os.environ.get('CALIBRACAO_SMTP_SINK', '')
+# Gemini: validade (s) das mensagens em cache, timeout da chamada e circuito (falhas seguidas / pausa em s)
+app.config['GEMINI_CACHE_TTL'] = int(os.environ.get('CALIBRACAO_GEMINI_CACHE_TTL', 86400))
+app.config['GEMINI_TIMEOUT'] = float(os.environ.get('CALIBRACAO_GEMINI_TIMEOUT', 15))
+app.config['GEMINI_LIMITE_FALHAS'] = int(os.environ.get('CALIBRACAO_GEMINI_LIMITE_FALHAS', 3))
+app.config['GEMINI_PAUSA'] = int(os.environ.get('CALIBRACAO_GEMINI_PAUSA', 300))
+# WhatsApp: tamanho máximo de cada mensagem; textos maiores são enviados em partes
+app.config['WHATSAPP_LIMITE_CARACTERES'] = int(os.environ.get('CALIBRACAO_WHATSAPP_LIMITE', 4096))
+# Threads em segundo plano (status, fila de notificações, agendamento): importar o app não as inicia; cada
+# processo as inicia na primeira requisição (fila e agendamento se coordenam pelo banco entre processos).
+# CALIBRACAO_WORKERS=0 desliga nos processos web; nesse caso rode `flask --app app workers` à parte.
+app.config['WORKERS_BACKGROUND'] = os.environ.get('CALIBRACAO_WORKERS', '1') != '0'
+# Agendamento de notificações: intervalo (s) entre as verificações da próxima ocorrência
+app.config['AGENDAMENTO_INTERVALO'] = int(os.environ.get('CALIBRACAO_AGENDAMENTO_INTERVALO', 60))
 
 
 COLOR_RULES_FIXED = [
@@ -67,10 +131,41 @@ CRITERIOS_VENCIMENTO_NOTIFICACAO = [
     "Notificar apenas equipamentos vencidos (<= 0 dias)"
 ]
 CRITERIOS_VENCIMENTO_NOTIFICACAO_MANUAL = ["Usar configuração padrão do sistema"] + CRITERIOS_VENCIMENTO_NOTIFICACAO
+# Critério -> (dias_limite, apenas_vencidos) de DatabaseManager.fetch_equipamentos_para_notificacao
+PARAMETROS_CRITERIO_NOTIFICACAO = dict(zip(CRITERIOS_VENCIMENTO_NOTIFICACAO, [(30, False), (45, False), (90, False), (None, True)]))
 PERIODICIDADE_NOTIFICACAO = ["Desativado", "Diário", "Semanal", "Quinzenal", "Mensal", "Bimestral", "Trimestral"]
+# Intervalo entre execuções de cada periodicidade ("Desativado" fica de fora)
+PERIODOS_AGENDAMENTO = {
+    "Diário": ("dias", 1), "Semanal": ("dias", 7), "Quinzenal": ("dias", 15),
+    "Mensal": ("meses", 1), "Bimestral": ("meses", 2), "Trimestral": ("meses", 3),
+}
+CAMPOS_AGENDAMENTO = ("agendamento_periodicidade", "agendamento_data_inicio", "agendamento_horario")
 HORARIOS_NOTIFICACAO = [f"{h:02d}:00" for h in range(0, 24)]
+ZAPI_BASE_URL_PADRAO = "https://api.z-api.io"
+SMTP_SEGURANCA_OPCOES = ["SSL", "STARTTLS", "Nenhuma"]
+AGRUPAMENTO_EMAIL_OPCOES = ["Mensagem única", "Por destinatário", "Por localização"]
+NOTIFICACAO_SETTINGS_PADRAO = {
+    "remetente_email": "", "remetente_senha": "", "para": "", "cc": "",
+    "smtp_host": "smtp.gmail.com", "smtp_porta": 465, "smtp_seguranca": SMTP_SEGURANCA_OPCOES[0],
+    "email_agrupamento": AGRUPAMENTO_EMAIL_OPCOES[0], "email_destinatarios_localizacao": "",
+    "assunto": "Alerta de Calibrações",
+    "corpo_template_email": "<p>Prezados,</p><p>Seguem os equipamentos que precisam de atenção quanto à calibração:</p>"
+                            "{tabela_equipamentos}<p>Mensagem automática.</p>",
+    "zapi_base_url": ZAPI_BASE_URL_PADRAO, "zapi_instancia": "", "zapi_token_instancia": "", "zapi_client_token": "",
+    "gemini_api_key": "", "whatsapp_para": "",
+    "corpo_template_whatsapp": "{tabela_equipamentos_texto}",
+    "criterio_padrao_vencimento": CRITERIOS_VENCIMENTO_NOTIFICACAO[0],
+    "agendamento_periodicidade": PERIODICIDADE_NOTIFICACAO[0],
+    "agendamento_data_inicio": "",
+    "agendamento_horario": "08:00",
+    "agendamento_atualizado_em": "",
+    "criterio_email_manual": CRITERIOS_VENCIMENTO_NOTIFICACAO_MANUAL[0],
+    "criterio_wpp_manual": CRITERIOS_VENCIMENTO_NOTIFICACAO_MANUAL[0],
+    "campos_tabela": {campo: True for campo in CAMPOS_TABELA_NOTIFICACAO},
+}
 
-db = DatabaseManager(DB_FULL_PATH) 
+db = DatabaseManager(DB_FULL_PATH, pragmas=app.config['DB_SQLITE_PRAGMAS'], regras_cores=COLOR_RULES_FIXED,
+                     user_cache_size=app.config['USER_CACHE_SIZE'], user_cache_ttl=app.config['USER_CACHE_TTL']) 
 
 # --- RESETAR SENHA DO ADMIN PARA 123 SEMPRE QUE INICIAR (remova depois de testar) ---
 admin_user = db.get_user_by_username("Admin")
@@ -91,6 +186,15 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'  # Define o endpoint para a página de login
 
+@login_manager.unauthorized_handler
+def nao_autenticado():
+    # Chamadas AJAX/JSON (DataTables, exportações, fila) recebem 401 em JSON em vez do HTML da página de login
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.accept_mimetypes.best == 'application/json':
+        return jsonify({"success": False, "error": "Sessão expirada ou usuário não autenticado. Faça login novamente.",
+                        "login_url": url_for(login_manager.login_view)}), 401
+    flash(login_manager.login_message, login_manager.login_message_category)
+    return redirect(login_url(login_manager.login_view, next_url=request.url))
+
 # Classe de Usuário para Flask-Login
 class User(UserMixin):
     def __init__(self, user_id, nome_usuario, ativo=True, requires_password_change=False):
@@ -103,27 +207,58 @@ class User(UserMixin):
     def is_active(self):
         return self._ativo
 
+SESSAO_CLAIMS_USUARIO = '_usuario_claims'
+
+def _user_from_dict(user_dict):
+    return User(
+        user_dict['id'],
+        user_dict['nome_usuario'],
+        user_dict.get('ativo', True),
+        user_dict.get('requires_password_change', False)
+    )
+
+def _gravar_claims_usuario(user_dict, geracao):
+    """Guarda a identidade na sessão (assinada pelo Flask) junto com a geração atual do usuário."""
+    if app.config['USER_SESSION_CLAIMS']:
+        session[SESSAO_CLAIMS_USUARIO] = {
+            'id': user_dict['id'], 'nome_usuario': user_dict['nome_usuario'],
+            'ativo': bool(user_dict.get('ativo', True)),
+            'requires_password_change': bool(user_dict.get('requires_password_change', False)),
+            'geracao': geracao
+        }
+
 # Função user_loader para Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    """Carrega um usuário dado seu ID.""" 
-    db_instance = db  # Use o objeto global db
-    user_data = db_instance.get_user_by_id(user_id)
+    """Carrega um usuário dado seu ID.
+
+    A geração gravada no banco (uma consulta por chave primária) valida os claims da sessão
+    (USER_SESSION_CLAIMS) e o cache de usuários do DatabaseManager, em qualquer processo.
+    """ 
+    try:
+        geracao = db.get_user_generation(user_id)
+    except (TypeError, ValueError):
+        return None
+    if geracao is None:
+        return None
+    if app.config['USER_SESSION_CLAIMS']:
+        claims = session.get(SESSAO_CLAIMS_USUARIO)
+        if claims and str(claims.get('id')) == str(user_id) and claims.get('geracao') == geracao:
+            return _user_from_dict(claims)
+    user_data = db.get_user_by_id(user_id, geracao=geracao)
     if user_data:
         user_dict = dict(user_data)
-        user = User(
-            user_dict['id'],
-            user_dict['nome_usuario'],
-            user_dict.get('ativo', True),
-            user_dict.get('requires_password_change', False)
-        )
-        return user
+        _gravar_claims_usuario(user_dict, user_dict['geracao_sessao'])
+        return _user_from_dict(user_dict)
     return None
 
 class AppUtils:
+    regras_cores = COLOR_RULES_FIXED # usado pelos métodos estáticos de classificação
+
     def __init__(self, db_manager_instance):
         self.db_manager = db_manager_instance
-        self.regras_cores = COLOR_RULES_FIXED
+        self._recalculo_lock = threading.Lock()
+        self._ultimo_recalculo = None # (data, versão dos dados) do último recálculo de status
 
     @staticmethod
     def format_date_for_display(date_str_iso):
@@ -167,38 +302,173 @@ class AppUtils:
             print(f"DEBUG calcular_dias: ValueError ao parsear data '{data_proxima_str}': {e}")
             return None, "status_semdata", STATUS_SEM_DATA_COR_HEX
 
-    def check_calibration_due_dates_and_update_status(self):
-        # Obter uma nova instância do DB para esta thread/contexto, se necessário
-        equipamentos = self.db_manager.fetch_all_equipamentos_completos()
-        updated_count = 0
-        for eq_data_row in equipamentos:
-            eq_data = dict(eq_data_row)
-            eq_id = eq_data['id']
-            prox_cal_str_equip = eq_data['proxima_data_calibracao']
-            current_status_equip = eq_data['status']
-            ativo = eq_data['ativo']
-            em_calibracao = eq_data['em_calibracao']
-
-            if not ativo or em_calibracao: continue
-            dias_venc, _, _ = AppUtils.calcular_dias_para_vencimento(prox_cal_str_equip, ativo, em_calibracao)
-            new_status = current_status_equip
-            # Lógica para atualizar o status baseada nos dias_venc
-            if dias_venc is not None:
-                if dias_venc <= 0 and current_status_equip != "Calibração Vencida":
-                    new_status = "Calibração Vencida"
-                elif dias_venc > 0 and current_status_equip == "Calibração Vencida":
-                     # Se estava vencido e agora não está mais (ex: data corrigida ou nova análise), definir para um status padrão ou baseado em lógica adicional
-                     # Aqui, assumimos que se não está vencido, e não está 'Em Calibração', o status padrão é 'Ativo' ou manter o último status não-vencido.
-                     # Uma abordagem simples é definir como 'Ativo' se não estiver 'Em Calibração' e a data for futura
-                     if not em_calibracao:
-                          new_status = "Ativo" # Ou outro status padrão apropriado
-
-            if new_status != current_status_equip:
-                 self.db_manager.update_equipamento_status(eq_id, new_status)
-                 updated_count += 1
-        # print(f"Status de {updated_count} equipamentos atualizados.") # Opcional: logar atualizações
+    @staticmethod
+    def classificar_vencimentos_em_lote(datas_proximas, ativos, em_calibracoes, hoje=None):
+        """Versão vetorizada de calcular_dias_para_vencimento para uma coluna inteira de equipamentos.
+
+        Usa um único "hoje" para todas as linhas e retorna três listas alinhadas à entrada:
+        dias para o vencimento (None quando não se aplica), tag_style e cor_hex.
+        """
+        total = len(datas_proximas)
+        if total == 0:
+            return [], [], []
+        datas = pd.to_datetime(pd.Series(list(datas_proximas), dtype=object), format="%Y-%m-%d", errors="coerce")
+        hoje_ts = pd.Timestamp(hoje or datetime.date.today())
+        dias = (datas - hoje_ts).dt.days.to_numpy(dtype=float, na_value=np.nan)
+        ativo = np.fromiter((bool(v) for v in ativos), dtype=bool, count=total)
+        em_calibracao = np.fromiter((bool(v) for v in em_calibracoes), dtype=bool, count=total)
+        com_data = ~np.isnan(dias)
+
+        # A ordem das condições reproduz a precedência de calcular_dias_para_vencimento
+        condicoes = [~ativo, em_calibracao, ~com_data]
+        tags = ["status_inativo", "status_em_calibracao", "status_semdata"]
+        cores = [STATUS_INATIVO_COR_HEX, STATUS_EM_CALIBRACAO_COR_HEX, STATUS_SEM_DATA_COR_HEX]
+        with np.errstate(invalid='ignore'):
+            for regra in AppUtils.regras_cores:
+                lim_inf, lim_sup = regra['limite_inferior'], regra['limite_superior']
+                if lim_inf is None and lim_sup is None:
+                    continue
+                condicao = com_data.copy()
+                if lim_inf is not None:
+                    condicao &= dias >= lim_inf
+                if lim_sup is not None:
+                    condicao &= dias < lim_sup
+                condicoes.append(condicao)
+                tags.append(regra['tag_style'])
+                cores.append(regra['cor_hex'])
+
+        tags_saida = np.select(condicoes, tags, default="status_semdata").tolist()
+        cores_saida = np.select(condicoes, cores, default=STATUS_SEM_DATA_COR_HEX).tolist()
+        dias_validos = ativo & ~em_calibracao & com_data
+        dias_saida = [int(d) if valido else None for d, valido in zip(dias.tolist(), dias_validos.tolist())]
+        return dias_saida, tags_saida, cores_saida
+
+    @staticmethod
+    def classificar_equipamentos_em_lote(equipamentos, hoje=None):
+        """Classifica uma lista de equipamentos (dicts/Rows) de uma vez; veja classificar_vencimentos_em_lote."""
+        return AppUtils.classificar_vencimentos_em_lote(
+            [e['proxima_data_calibracao'] for e in equipamentos],
+            [e['ativo'] for e in equipamentos],
+            [e['em_calibracao'] for e in equipamentos],
+            hoje
+        )
+
+    @staticmethod
+    def load_notification_settings():
+        """Lê as configurações de notificação do JSON, completando com os valores padrão."""
+        settings = json.loads(json.dumps(NOTIFICACAO_SETTINGS_PADRAO))
+        if os.path.exists(NOTIFICACAO_CONFIG_FILE_PATH):
+            try:
+                with open(NOTIFICACAO_CONFIG_FILE_PATH, 'r', encoding='utf-8') as f:
+                    salvas = json.load(f)
+                campos_salvos = salvas.pop('campos_tabela', None) or {}
+                settings.update({chave: valor for chave, valor in salvas.items() if valor is not None})
+                settings['campos_tabela'].update(campos_salvos)
+            except (IOError, ValueError) as e:
+                print(f"Erro ao carregar configurações de notificação: {e}")
+        return settings
+
+    def check_calibration_due_dates_and_update_status(self, forcar=False):
+        """Atualiza os status vencido/ativo em lote, no máximo uma vez por dia ou após mudança nos dados."""
+        hoje = datetime.date.today()
+        with self._recalculo_lock:
+            if not forcar and self._ultimo_recalculo == (hoje, self.db_manager.get_data_version()):
+                return None
+            resultado = self.db_manager.recalcular_status_equipamentos(hoje)
+            if resultado is not None:
+                self._ultimo_recalculo = (hoje, self.db_manager.get_data_version())
+            return resultado
 
 utils = AppUtils(db) # <-- Instancie a classe AppUtils aqui, após sua definição
+renderizador = RenderizadorNotificacoes(CAMPOS_TABELA_NOTIFICACAO, AppUtils.format_date_for_display,
+                                        limite_whatsapp=app.config['WHATSAPP_LIMITE_CARACTERES'])
+
+class StatusRefreshWorker:
+    """Thread em segundo plano que mantém os status de calibração atualizados.
+
+    Executa o recálculo na partida, na virada do dia, no horário configurado e quando os
+    dados mudam (verificação barata a cada `intervalo` segundos), fora das requisições HTTP.
+    A versão dos dados fica no banco, então escritas de outros processos também disparam o recálculo.
+    """
+    def __init__(self, app_utils_instance, horario="00:05", intervalo=60):
+        self.app_utils = app_utils_instance
+        self.horario = datetime.datetime.strptime(horario, "%H:%M").time()
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._proxima_execucao = None
+        self.ultima_execucao = None
+        self.ultima_duracao_ms = None
+        self.ultimo_resultado = None
+        self.ultimo_erro = None
+        self.execucoes = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._loop, name="status-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._parar.set()
+
+    def _calcular_proxima_execucao(self, agora):
+        proxima = datetime.datetime.combine(agora.date(), self.horario)
+        if proxima <= agora:
+            proxima += datetime.timedelta(days=1)
+        return proxima
+
+    def executar(self, forcar=True):
+        inicio = time.perf_counter()
+        try:
+            resultado = self.app_utils.check_calibration_due_dates_and_update_status(forcar=forcar)
+            if forcar:
+                # Execução diária: as faixas de cor do dashboard mudam com a data
+                self.app_utils.db_manager.reconstruir_agregados_dashboard()
+            erro = None
+        except Exception as e:
+            resultado, erro = None, str(e)
+            print(f"Erro na atualização de status em segundo plano: {e}")
+        finally:
+            self.app_utils.db_manager.release_connection()
+        if resultado is None and erro is None:
+            return None # nada mudou desde a última execução
+        with self._lock:
+            self.ultima_execucao = datetime.datetime.now()
+            self.ultima_duracao_ms = round((time.perf_counter() - inicio) * 1000, 3)
+            self.ultimo_resultado = resultado
+            self.ultimo_erro = erro
+            self.execucoes += 1
+        return resultado
+
+    def _loop(self):
+        self.executar(forcar=True)
+        self._proxima_execucao = self._calcular_proxima_execucao(datetime.datetime.now())
+        while not self._parar.wait(self.intervalo):
+            agora = datetime.datetime.now()
+            if agora >= self._proxima_execucao:
+                self.executar(forcar=True)
+                self._proxima_execucao = self._calcular_proxima_execucao(agora)
+            else:
+                # Virada do dia ou dados alterados; sem mudanças só lê a versão dos dados
+                self.executar(forcar=False)
+
+    def get_status(self):
+        with self._lock:
+            return {
+                "ativo": bool(self._thread and self._thread.is_alive()),
+                "horario": self.horario.strftime("%H:%M"),
+                "proxima_execucao": self._proxima_execucao.isoformat(timespec='seconds') if self._proxima_execucao else None,
+                "ultima_execucao": self.ultima_execucao.isoformat(timespec='seconds') if self.ultima_execucao else None,
+                "ultima_duracao_ms": self.ultima_duracao_ms,
+                "ultimo_resultado": self.ultimo_resultado,
+                "ultimo_erro": self.ultimo_erro,
+                "execucoes": self.execucoes,
+            }
+
+status_worker = StatusRefreshWorker(utils, app.config['STATUS_REFRESH_HORARIO'], app.config['STATUS_REFRESH_INTERVALO'])
 
 # Adicionar rotas de Login e Logout
 @app.route('/login', methods=['GET', 'POST'])
@@ -220,13 +490,9 @@ def login():
         user_data = db_instance.get_user_by_username(username)
         if user_data and check_password_hash(user_data['senha'], password):
             user_dict = dict(user_data)
-            user = User(
-                user_dict['id'],
-                user_dict['nome_usuario'],
-                user_dict.get('ativo', True),
-                user_dict.get('requires_password_change', False)
-            )
+            user = _user_from_dict(user_dict)
             login_user(user)
+            _gravar_claims_usuario(user_dict, user_dict['geracao_sessao'])
 
             if user.requires_password_change:
                 flash('Por favor, altere sua senha temporária.', 'warning')
@@ -248,6 +514,7 @@ def login():
 @login_required # Apenas usuários logados podem fazer logout
 def logout():
     logout_user()
+    session.pop(SESSAO_CLAIMS_USUARIO, None)
     flash('Você foi desconectado.', 'info') # Mensagem de informação
     return redirect(url_for('login')) # Redireciona para a página de login
 
@@ -308,6 +575,25 @@ def alterar_senha():
     flash('Senha alterada com sucesso!', 'success')
     return redirect(url_for('dashboard'))
 
+@app.teardown_appcontext
+def liberar_conexao_db(exception=None):
+    # Devolve ao pool a conexão usada pela requisição (reutilizada pela próxima)
+    db.release_connection()
+
+@app.route('/diagnostico')
+@login_required
+def diagnostico():
+    return jsonify({
+        "esquema": db.get_schema_status(),
+        "pool_conexoes": db.get_pool_stats(),
+        "cache_referencia": db.get_cache_stats(),
+        "cache_usuarios": db.get_user_cache_stats(),
+        "atualizacao_status": status_worker.get_status(),
+        "fila_notificacoes": notificacao_worker.get_status(),
+        "agendamento_notificacoes": agendador_notificacoes.get_status(),
+        "mensagens_whatsapp": gerador_mensagem_whatsapp.get_status()
+    })
+
 @app.context_processor
 def inject_utilities():
     return {'now': datetime.datetime.now(datetime.timezone.utc), 'format_date': utils.format_date_for_display}
@@ -322,74 +608,134 @@ def allowed_file(filename):
 @login_required
 def index(): # Renomeado de dashboard para ser a rota raiz, o dashboard real será outra rota
     print(f"Usuário logado: {current_user.nome_usuario}")
-    return render_template('dashboard.html', 
-                           total_equip=total_equip, 
-                           ativos_count=ativos_count, 
-                           em_calibracao_count=em_calibracao_count)
+    return redirect(url_for('dashboard'))
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    utils.check_calibration_due_dates_and_update_status()
-    equipamentos = db.fetch_all_equipamentos_completos()
-    total_equip = len(equipamentos) if equipamentos else 0
-    ativos_count = sum(1 for eq in equipamentos if eq['ativo']) if equipamentos else 0
-    em_calibracao_count = sum(1 for eq in equipamentos if eq['ativo'] and eq['em_calibracao']) if equipamentos else 0
-    return render_template('dashboard.html', total_equip=total_equip, 
-                           ativos_count=ativos_count, 
-                           em_calibracao_count=em_calibracao_count)
+    # O recálculo de status roda em segundo plano (StatusRefreshWorker), fora da requisição
+    agregados = db.fetch_agregados_dashboard()
+    faixas_info = {regra['tag_style']: {'nome': regra['nome'], 'cor_hex': regra['cor_hex']} for regra in COLOR_RULES_FIXED}
+    faixas_info.update({
+        'status_inativo': {'nome': 'Inativo', 'cor_hex': STATUS_INATIVO_COR_HEX},
+        'status_em_calibracao': {'nome': 'Em Calibração', 'cor_hex': STATUS_EM_CALIBRACAO_COR_HEX},
+        'status_semdata': {'nome': 'Sem Data', 'cor_hex': STATUS_SEM_DATA_COR_HEX},
+    })
+    ordem_faixas = [regra['tag_style'] for regra in COLOR_RULES_FIXED] + ['status_semdata', 'status_em_calibracao', 'status_inativo']
+    por_faixa = sorted(agregados['faixa_cor'], key=lambda item: ordem_faixas.index(item['chave']) if item['chave'] in ordem_faixas else len(ordem_faixas))
+    for item in por_faixa:
+        item.update(faixas_info.get(item['chave'], {'nome': item['chave'], 'cor_hex': STATUS_SEM_DATA_COR_HEX}))
+    return render_template('dashboard.html', total_equip=agregados['total'], 
+                           ativos_count=agregados['ativos'], 
+                           em_calibracao_count=agregados['em_calibracao'],
+                           por_faixa=por_faixa,
+                           por_tipo=agregados['tipo'],
+                           por_empresa=agregados['empresa'],
+                           por_localizacao=agregados['localizacao'])
+
+MAX_PAGINA_EQUIPAMENTOS = 500
+
+def _formatar_equipamento_para_lista(equip_row, dias, cor_hex):
+    """Monta o dict exibido na lista; dias/cor_hex vêm de utils.classificar_equipamentos_em_lote."""
+    equip = dict(equip_row)
+    equip['dias_vencimento_display'] = str(dias) if dias is not None else "N/A"
+    equip['cor_vencimento'] = cor_hex
+    
+    if not equip.get('ativo'):
+        equip['status_display'] = "Inativo"
+        equip['cor_status_bg'] = STATUS_INATIVO_COR_HEX
+        equip['cor_status_text'] = "white" if STATUS_INATIVO_COR_HEX == "#B0B0B0" else "black"
+    elif equip.get('em_calibracao'):
+        equip['status_display'] = "Em Calibração"
+        equip['cor_status_bg'] = STATUS_EM_CALIBRACAO_COR_HEX
+        equip['cor_status_text'] = "black"
+    else:
+        equip['status_display'] = equip.get('status', 'N/A')
+        if equip['status_display'] == "Calibração Vencida":
+             equip['cor_status_text'] = "red"
+        else: 
+             equip['cor_status_text'] = "black" 
+             equip['cor_status_bg'] = "transparent" 
+    return equip
 
 @app.route('/equipamentos')
 def lista_equipamentos():
     # Esta rota ainda não está protegida com @login_required para manter a funcionalidade atual.
+    # As linhas da tabela são carregadas sob demanda por /equipamentos/dados (DataTables server-side).
     search_query = request.args.get('search', '')
-    if search_query:
-        equipamentos_data = db.search_equipamentos(search_query)
-    else:
-        equipamentos_data = db.fetch_all_equipamentos_completos()
-    
     empresas_calibracao_data = db.fetch_empresas_calibracao() # Use esta função
     empresas_unidade = db.fetch_empresas_unidade()
-    equipamentos_display = []
-
-    if equipamentos_data:
-        for equip_row in equipamentos_data:
-            equip = dict(equip_row) 
-            dias, tag_style, cor_hex = utils.calcular_dias_para_vencimento(
-                equip.get('proxima_data_calibracao'),
-                equip.get('ativo'),
-                equip.get('em_calibracao')
-            )
-            equip['dias_vencimento_display'] = str(dias) if dias is not None else "N/A"
-            equip['cor_vencimento'] = cor_hex
-            
-            if not equip.get('ativo'):
-                equip['status_display'] = "Inativo"
-                equip['cor_status_bg'] = STATUS_INATIVO_COR_HEX
-                equip['cor_status_text'] = "white" if STATUS_INATIVO_COR_HEX == "#B0B0B0" else "black"
-            elif equip.get('em_calibracao'):
-                equip['status_display'] = "Em Calibração"
-                equip['cor_status_bg'] = STATUS_EM_CALIBRACAO_COR_HEX
-                equip['cor_status_text'] = "black"
-            else:
-                equip['status_display'] = equip.get('status', 'N/A')
-                if equip['status_display'] == "Calibração Vencida":
-                     equip['cor_status_text'] = "red"
-                else: 
-                     equip['cor_status_text'] = "black" 
-                     equip['cor_status_bg'] = "transparent" 
-
-            equipamentos_display.append(equip)
-    
     tipos_equip_para_modal = db.fetch_all_tipos_equipamento()
 
     return render_template('lista_equipamentos.html', 
-                           equipamentos=equipamentos_display, 
                            search_query=search_query,
                            empresas=empresas_unidade, # Manter para outros usos na página, se necessário
                            empresas_calibracao=[dict(row) for row in empresas_calibracao_data], # Passar a lista de empresas de calibração
                            tipos_equip_para_modal=tipos_equip_para_modal,
                            REGRAS_VALIDACAO_CRITERIOS=REGRAS_VALIDACAO_CRITERIOS) 
 
+@app.route('/equipamentos/dados')
+@login_required
+def lista_equipamentos_dados():
+    """Processamento server-side do DataTables: paginação, ordenação, filtros e busca no SQL.
+
+    Além de start/length (OFFSET), aceita `cursor` (JSON devolvido em `next_cursor`)
+    para paginação por keyset em clientes da API.
+    """
+    args = request.args
+    draw = args.get('draw', 0, type=int)
+    inicio = max(args.get('start', 0, type=int), 0)
+    limite = args.get('length', 10, type=int)
+    if limite is None or limite <= 0 or limite > MAX_PAGINA_EQUIPAMENTOS:
+        limite = MAX_PAGINA_EQUIPAMENTOS
+
+    colunas = []
+    filtros_coluna = {}
+    i = 0
+    while f'columns[{i}][data]' in args:
+        nome_coluna = args.get(f'columns[{i}][data]')
+        colunas.append(nome_coluna)
+        valor_filtro = args.get(f'columns[{i}][search][value]', '').strip()
+        if valor_filtro:
+            filtros_coluna[nome_coluna] = valor_filtro
+        i += 1
+
+    ordenar_por = args.get('order_by', 'nome')
+    idx_ordem = args.get('order[0][column]', type=int)
+    if idx_ordem is not None and 0 <= idx_ordem < len(colunas):
+        ordenar_por = colunas[idx_ordem]
+    direcao = args.get('order[0][dir]', args.get('dir', 'asc'))
+
+    cursor = None
+    if args.get('cursor'):
+        try:
+            cursor = json.loads(args['cursor'])
+            if not isinstance(cursor, list) or len(cursor) != 2:
+                raise ValueError("cursor deve ser [valor, id]")
+        except ValueError:
+            return jsonify({"error": "Parâmetro cursor inválido."}), 400
+
+    total, total_filtrado, linhas, proximo_cursor = db.fetch_equipamentos_pagina(
+        inicio=inicio, limite=limite, ordenar_por=ordenar_por, direcao=direcao,
+        filtros_coluna=filtros_coluna, busca_global=args.get('search[value]', args.get('search', '')),
+        cursor=cursor
+    )
+
+    dados = []
+    dias_lote, _, cores_lote = utils.classificar_equipamentos_em_lote(linhas)
+    for row, dias, cor_hex in zip(linhas, dias_lote, cores_lote):
+        equip = _formatar_equipamento_para_lista(row, dias, cor_hex)
+        equip.pop('_valor_ordem', None)
+        equip['proxima_data_calibracao_fmt'] = utils.format_date_for_display(equip.get('proxima_data_calibracao'))
+        dados.append(equip)
+
+    return jsonify({
+        "draw": draw,
+        "recordsTotal": total,
+        "recordsFiltered": total_filtrado,
+        "data": dados,
+        "next_cursor": json.dumps(proximo_cursor) if proximo_cursor else None
+    })
+
 @app.route('/equipamento/novo', methods=['POST'])
 @login_required
 def novo_equipamento():
@@ -537,14 +883,7 @@ def excluir_equipamento(equip_id):
 @app.route('/tipos', methods=['GET'])
 @login_required
 def gerenciar_tipos():
-    tipos_raw = db.fetch_all_tipos_equipamento()
-    tipos_com_unidades = []
-    if tipos_raw:
-        for tipo_row in tipos_raw:
-            tipo = dict(tipo_row)
-            tipo['unidades'] = [dict(u_row) for u_row in db.fetch_unidades_by_tipo_id(tipo['id'])]
-            tipos_com_unidades.append(tipo)
-    return render_template('gerenciar_tipos.html', tipos=tipos_com_unidades)
+    return render_template('gerenciar_tipos.html', tipos=db.fetch_tipos_com_unidades())
 
 
 @app.route('/tipo/salvar', methods=['POST'])
@@ -564,34 +903,15 @@ def salvar_tipo(tipo_id=None):
         flash("Erro ao processar dados das unidades.", "danger")
         return redirect(url_for('gerenciar_tipos'))
 
-    if tipo_id is None: 
-        try:
-            novo_tipo_id = db.add_tipo_equipamento(nome_tipo)
-            if novo_tipo_id:
-                for unidade in unidades_para_salvar:
-                    if unidade.get('status') != 'deleted' and unidade.get('nome_unidade'): 
-                        db.add_unidade_medida_config(novo_tipo_id, unidade['nome_unidade'], unidade.get('simbolo_unidade'))
-                flash(f"Tipo '{nome_tipo}' adicionado com sucesso!", "success")
-            else:
-                flash(f"Erro ao adicionar tipo '{nome_tipo}'. Verifique se já existe.", "danger")
-        except Exception as e:
-            flash(f"Erro ao salvar novo tipo: {e}", "danger")
-    else: 
-        try:
-            if db.update_tipo_equipamento(tipo_id, nome_tipo):
-                for unidade_form in unidades_para_salvar:
-                    form_unit_id = unidade_form.get('id') 
-                    form_unit_status = unidade_form.get('status')
-                    
-                    if form_unit_status == 'deleted' and form_unit_id is not None:
-                        db.delete_unidade_medida_config(form_unit_id)
-                    elif form_unit_status == 'new' and unidade_form.get('nome_unidade'):
-                        db.add_unidade_medida_config(tipo_id, unidade_form['nome_unidade'], unidade_form.get('simbolo_unidade'))
-                flash(f"Tipo '{nome_tipo}' atualizado com sucesso!", "success")
-            else:
-                flash(f"Erro ao atualizar tipo '{nome_tipo}'. Verifique se o novo nome já existe.", "danger")
-        except Exception as e:
-            flash(f"Erro ao salvar alterações do tipo: {e}", "danger")
+    if db.salvar_tipo_com_unidades(tipo_id, nome_tipo, unidades_para_salvar):
+        if tipo_id is None:
+            flash(f"Tipo '{nome_tipo}' adicionado com sucesso!", "success")
+        else:
+            flash(f"Tipo '{nome_tipo}' atualizado com sucesso!", "success")
+    elif tipo_id is None:
+        flash(f"Erro ao adicionar tipo '{nome_tipo}'. Verifique se já existe.", "danger")
+    else:
+        flash(f"Erro ao atualizar tipo '{nome_tipo}'. Verifique se o novo nome já existe.", "danger")
             
     return redirect(url_for('gerenciar_tipos'))
 
@@ -604,11 +924,16 @@ def salvar_tipo_ajax():
     if not nome_tipo:
         return jsonify({"success": False, "message": "O nome do tipo é obrigatório."}), 400
     
+    unidades = data.get('unidades') or []
+    if not isinstance(unidades, list):
+        return jsonify({"success": False, "message": "O campo 'unidades' deve ser uma lista."}), 400
+
     try:
-        novo_tipo_id = db.add_tipo_equipamento(nome_tipo)
+        novo_tipo_id = db.salvar_tipo_com_unidades(None, nome_tipo, [dict(u, status='new') for u in unidades])
         if novo_tipo_id:
-            tipo_criado = db.fetch_tipo_equipamento_by_id(novo_tipo_id) 
-            return jsonify({"success": True, "message": "Tipo adicionado com sucesso!", "tipo": dict(tipo_criado)})
+            tipo_criado = dict(db.fetch_tipo_equipamento_by_id(novo_tipo_id))
+            tipo_criado['unidades'] = [dict(u) for u in db.fetch_unidades_by_tipo_id(novo_tipo_id)]
+            return jsonify({"success": True, "message": "Tipo adicionado com sucesso!", "tipo": tipo_criado})
         else: 
             return jsonify({"success": False, "message": "Erro ao adicionar tipo. Verifique se já existe."}), 400
     except Exception as e:
@@ -618,10 +943,6 @@ def salvar_tipo_ajax():
 @app.route('/tipo/excluir/<int:tipo_id>', methods=['POST'])
 @login_required
 def excluir_tipo(tipo_id):
-    unidades_associadas = db.fetch_unidades_by_tipo_id(tipo_id)
-    for unidade in unidades_associadas:
-        db.delete_unidade_medida_config(unidade['id'])
-        
     resultado = db.delete_tipo_equipamento(tipo_id) 
     if resultado == "EM_USO": 
         flash("Não é possível excluir o tipo. Ele está associado a um ou mais equipamentos.", "danger")
@@ -817,12 +1138,18 @@ def configuracoes_notificacao():
         # Campos de E-mail
         remetente_email = request.form.get('remetente_email', settings['remetente_email'])
         remetente_senha = request.form.get('remetente_senha', settings['remetente_senha'])
+        smtp_host = request.form.get('smtp_host', settings['smtp_host']).strip()
+        smtp_porta = request.form.get('smtp_porta', settings['smtp_porta'], type=int)
+        smtp_seguranca = request.form.get('smtp_seguranca', settings['smtp_seguranca'])
+        email_agrupamento = request.form.get('email_agrupamento', settings['email_agrupamento'])
+        email_destinatarios_localizacao = request.form.get('email_destinatarios_localizacao', settings['email_destinatarios_localizacao'])
         para = request.form.get('para', settings['para'])
         cc = request.form.get('cc', settings['cc'])
         assunto = request.form.get('assunto', settings['assunto'])
         corpo_template_email = request.form.get('corpo_template_email', settings['corpo_template_email'])
         
         # Campos de WhatsApp/Gemini
+        zapi_base_url = (request.form.get('zapi_base_url') or settings['zapi_base_url']).rstrip('/')
         zapi_instancia = request.form.get('zapi_instancia', settings['zapi_instancia'])
         zapi_token_instancia = request.form.get('zapi_token_instancia', settings['zapi_token_instancia'])
         zapi_client_token = request.form.get('zapi_client_token', settings['zapi_client_token'])
@@ -847,10 +1174,16 @@ def configuracoes_notificacao():
         settings = {
             "remetente_email": remetente_email,
             "remetente_senha": remetente_senha,
+            "smtp_host": smtp_host,
+            "smtp_porta": smtp_porta,
+            "smtp_seguranca": smtp_seguranca if smtp_seguranca in SMTP_SEGURANCA_OPCOES else SMTP_SEGURANCA_OPCOES[0],
+            "email_agrupamento": email_agrupamento if email_agrupamento in AGRUPAMENTO_EMAIL_OPCOES else AGRUPAMENTO_EMAIL_OPCOES[0],
+            "email_destinatarios_localizacao": email_destinatarios_localizacao,
             "para": para,
             "cc": cc,
             "assunto": assunto,
             "corpo_template_email": corpo_template_email,
+            "zapi_base_url": zapi_base_url,
             "zapi_instancia": zapi_instancia,
             "zapi_token_instancia": zapi_token_instancia,
             "zapi_client_token": zapi_client_token,
@@ -878,11 +1211,21 @@ def configuracoes_notificacao():
         settings['agendamento_horario'] = request.form.get('agendamento_horario', settings['agendamento_horario'])
         settings['criterio_email_manual'] = request.form.get('criterio_email_manual', settings['criterio_email_manual'])
         settings['campos_tabela'] = campos_tabela_selecionados
+        # Alterar o agendamento reinicia a contagem: ocorrências anteriores não são recuperadas
+        settings_anteriores = utils.load_notification_settings()
+        if any(settings[c] != settings_anteriores.get(c) for c in CAMPOS_AGENDAMENTO):
+            settings['agendamento_atualizado_em'] = datetime.datetime.now().isoformat(timespec='seconds')
+        else:
+            settings['agendamento_atualizado_em'] = settings_anteriores.get('agendamento_atualizado_em', "")
 
         try:
             with open(NOTIFICACAO_CONFIG_FILE_PATH, 'w') as f:
                 json.dump(settings, f, indent=4)
             flash("Configurações de notificação salvas!", "success")
+            if settings['agendamento_periodicidade'] in PERIODOS_AGENDAMENTO and not agendador_notificacoes.ativo():
+                print("AVISO: Agendamento de notificações salvo sem agendador ativo neste processo.")
+                flash("O agendador não está ativo neste servidor (CALIBRACAO_WORKERS=0): as notificações agendadas "
+                      "só serão enviadas com o processo de workers (flask --app app workers) em execução.", "warning")
         except IOError as e:
             flash(f"Não foi possível salvar as configurações: {e}", "danger")
         return redirect(url_for('configuracoes_notificacao')) 
@@ -892,6 +1235,8 @@ def configuracoes_notificacao():
                            criterios_vencimento=CRITERIOS_VENCIMENTO_NOTIFICACAO,
                            criterios_vencimento_manual=CRITERIOS_VENCIMENTO_NOTIFICACAO_MANUAL,
                            periodicidades=PERIODICIDADE_NOTIFICACAO,
+                           smtp_seguranca_opcoes=SMTP_SEGURANCA_OPCOES,
+                           agrupamentos_email=AGRUPAMENTO_EMAIL_OPCOES,
                            horarios=HORARIOS_NOTIFICACAO
                            )
 
@@ -902,116 +1247,210 @@ def enviar_notificacao_email_manual():
     settings = utils.load_notification_settings()
     criterio_selecionado = request.form.get('criterio_email_manual', settings['criterio_email_manual']) 
 
-    if not all([settings.get('remetente_email'), settings.get('remetente_senha'), settings.get('para')]):
+    if not _email_configurado(settings):
         return jsonify({"success": False, "message": "Configurações de e-mail (remetente, senha, destinatário) incompletas."}), 400
 
-    dias_limite = None
-    apenas_vencidos = False
-    if "30 dias" in criterio_selecionado: dias_limite = 30
-    elif "45 dias" in criterio_selecionado: dias_limite = 45
-    elif "90 dias" in criterio_selecionado: dias_limite = 90
-    elif "apenas equipamentos vencidos" in criterio_selecionado: apenas_vencidos = True
-    
-    equipamentos_todos = db.fetch_all_equipamentos_completos()
-    equipamentos_para_notificar = []
-
-    if equipamentos_todos:
-        for equip_row in equipamentos_todos:
-            equip = dict(equip_row)
-            if not equip.get('ativo') or equip.get('em_calibracao'):
-                continue
-            
-            dias_venc, _, _ = utils.calcular_dias_para_vencimento(
-                equip.get('proxima_data_calibracao'),
-                equip.get('ativo'),
-                equip.get('em_calibracao')
-            )
-            if dias_venc is not None:
-                if apenas_vencidos and dias_venc <= 0:
-                    equipamentos_para_notificar.append(equip)
-                elif dias_limite is not None and 0 < dias_venc <= dias_limite: 
-                    equipamentos_para_notificar.append(equip)
-                elif dias_limite is not None and dias_venc <= 0 : 
-                    equipamentos_para_notificar.append(equip)
-
+    equipamentos_para_notificar = _selecionar_equipamentos_para_notificacao(criterio_selecionado, settings)
 
     if not equipamentos_para_notificar:
         return jsonify({"success": True, "message": "Nenhum equipamento encontrado para notificação com o critério selecionado."})
 
-    tabela_html = "<table border='1' cellpadding='5' cellspacing='0' style='border-collapse: collapse; width: 100%;'><thead><tr>"
-    colunas_selecionadas = [key for key, val in settings.get('campos_tabela', {}).items() if val]
-    for col_key in colunas_selecionadas:
-        tabela_html += f"<th>{CAMPOS_TABELA_NOTIFICACAO.get(col_key, col_key)}</th>"
-    tabela_html += "</tr></thead><tbody>"
-
-    for equip in equipamentos_para_notificar:
-        tabela_html += "<tr>"
-        for col_key in colunas_selecionadas:
-            valor = equip.get(col_key, 'N/D')
-            if col_key == "proxima_data_calibracao":
-                valor = utils.format_date_for_display(valor)
-            elif col_key == "dias_vencimento": 
-                 dias_v, _, _ = utils.calcular_dias_para_vencimento(equip.get('proxima_data_calibracao'), equip.get('ativo'), equip.get('em_calibracao'))
-                 valor = dias_v if dias_v is not None else "N/A"
-            tabela_html += f"<td>{valor}</td>"
-        tabela_html += "</tr>"
-    tabela_html += "</tbody></table>"
-
-    corpo_email = settings.get('corpo_template_email', "").replace("{tabela_equipamentos}", tabela_html)
+    fila_id = _enfileirar_email(settings, equipamentos_para_notificar)
+    return _resposta_notificacao_enfileirada(fila_id, f"E-mail de notificação ({settings['email_agrupamento'].lower()}) enfileirado para envio.")
+
+def _parametros_criterio_notificacao(criterio_selecionado, settings=None):
+    """(dias_limite, apenas_vencidos) do critério; "Usar configuração padrão do sistema" usa o critério padrão salvo."""
+    if criterio_selecionado not in PARAMETROS_CRITERIO_NOTIFICACAO:
+        settings = settings or utils.load_notification_settings()
+        criterio_selecionado = settings.get('criterio_padrao_vencimento')
+    return PARAMETROS_CRITERIO_NOTIFICACAO.get(criterio_selecionado, PARAMETROS_CRITERIO_NOTIFICACAO[CRITERIOS_VENCIMENTO_NOTIFICACAO[0]])
+
+def _selecionar_equipamentos_para_notificacao(criterio_selecionado, settings=None):
+    """Equipamentos ativos, fora de calibração, que atendem ao critério (mais urgentes primeiro); cada um com 'dias_vencimento'."""
+    dias_limite, apenas_vencidos = _parametros_criterio_notificacao(criterio_selecionado, settings)
+    return db.fetch_equipamentos_para_notificacao(dias_limite=dias_limite, apenas_vencidos=apenas_vencidos)
+
+def _separar_emails(texto):
+    return [e.strip() for e in (texto or "").replace(';', ',').split(',') if e.strip()]
+
+def _destinatarios_por_localizacao(texto):
+    """Lê linhas 'Localização: email1, email2' e retorna {localização em minúsculas: [emails]}."""
+    mapa = {}
+    for linha in (texto or "").splitlines():
+        if ':' not in linha:
+            continue
+        localizacao, emails = linha.split(':', 1)
+        if localizacao.strip() and _separar_emails(emails):
+            mapa[localizacao.strip().lower()] = _separar_emails(emails)
+    return mapa
+
+def _montar_email_notificacao(settings, equipamentos_para_notificar):
+    """Monta as mensagens (assunto, corpo HTML, destinatários) conforme o agrupamento configurado.
+
+    É o conteúdo gravado na fila; as credenciais não. "Por destinatário" envia uma cópia individual a cada
+    endereço de Para/Cc; "Por localização" envia a cada local só os seus equipamentos, para os
+    destinatários mapeados em email_destinatarios_localizacao (ou Para/Cc, se o local não estiver mapeado).
+    """
+    assunto = settings.get('assunto', "Alerta de Calibrações")
+    corpo_template = settings.get('corpo_template_email', "")
+    campos = settings.get('campos_tabela', {})
+    agrupamento = settings.get('email_agrupamento', AGRUPAMENTO_EMAIL_OPCOES[0])
+
+    if agrupamento == "Por localização":
+        mapa = _destinatarios_por_localizacao(settings.get('email_destinatarios_localizacao'))
+        grupos = {}
+        for equip in equipamentos_para_notificar:
+            grupos.setdefault((equip.get('localizacao') or "Sem localização").strip(), []).append(equip)
+        mensagens = []
+        for localizacao, equipamentos in sorted(grupos.items()):
+            destinatarios = mapa.get(localizacao.lower())
+            mensagens.append({
+                "assunto": f"{assunto} - {localizacao}",
+                "html": renderizador.corpo(corpo_template, "{tabela_equipamentos}", renderizador.iter_tabela_html(equipamentos, campos)),
+                "para": ", ".join(destinatarios) if destinatarios else settings['para'],
+                "cc": "" if destinatarios else settings.get('cc', ""),
+            })
+        return {"mensagens": mensagens}
+
+    html = renderizador.corpo(corpo_template, "{tabela_equipamentos}", renderizador.iter_tabela_html(equipamentos_para_notificar, campos))
+    if agrupamento == "Por destinatário":
+        enderecos = list(dict.fromkeys(_separar_emails(settings['para']) + _separar_emails(settings.get('cc'))))
+        return {"mensagens": [{"assunto": assunto, "html": html, "para": endereco, "cc": ""} for endereco in enderecos]}
+    return {"mensagens": [{"assunto": assunto, "html": html, "para": settings['para'], "cc": settings.get('cc', "")}]}
+
+def _email_configurado(settings):
+    if not settings.get('remetente_email') or not settings.get('para'):
+        return False
+    # Sem senha só faz sentido em servidor sem autenticação (sink local ou relay interno)
+    return bool(app.config['SMTP_SINK'] or settings.get('remetente_senha') or settings.get('smtp_seguranca') == "Nenhuma")
+
+def _enfileirar_email(settings, equipamentos_para_notificar, origem="manual"):
+    return db.enfileirar_notificacao('email', _montar_email_notificacao(settings, equipamentos_para_notificar),
+                                     max_tentativas=app.config['NOTIFICACAO_FILA_TENTATIVAS'], origem=origem)
+
+
+class SmtpTransport:
+    """Sessão SMTP reutilizada para todas as mensagens de um lote (um handshake TLS e um login).
+
+    `seguranca`: "SSL" (SMTP_SSL, porta 465), "STARTTLS" (porta 587) ou "Nenhuma". Sem senha não há login.
+    Uso: `with SmtpTransport.from_settings(settings) as smtp: smtp.enviar(msg)`.
+    """
+    def __init__(self, host, porta, seguranca="SSL", usuario=None, senha=None, timeout=30):
+        self.host = host
+        self.porta = int(porta)
+        self.seguranca = seguranca
+        self.usuario = usuario
+        self.senha = senha
+        self.timeout = timeout
+        self._server = None
+        self.enviadas = 0
+
+    @classmethod
+    def from_settings(cls, settings, sink=None):
+        sink = app.config['SMTP_SINK'] if sink is None else sink
+        if sink:
+            host, _, porta = sink.rpartition(':')
+            return cls(host or "127.0.0.1", porta or 1025, seguranca="Nenhuma")
+        return cls(settings.get('smtp_host') or "smtp.gmail.com", settings.get('smtp_porta') or 465,
+                   settings.get('smtp_seguranca') or "SSL", settings.get('remetente_email'), settings.get('remetente_senha'))
+
+    def conectar(self):
+        if self.seguranca == "SSL":
+            server = smtplib.SMTP_SSL(self.host, self.porta, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.porta, timeout=self.timeout)
+            if self.seguranca == "STARTTLS":
+                server.starttls()
+        try:
+            if self.senha:
+                server.login(self.usuario, self.senha)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+
+    def enviar(self, msg):
+        if self._server is None:
+            self.conectar()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Servidor encerrou a sessão ociosa no meio do lote: reconecta uma vez
+            self.conectar()
+            self._server.send_message(msg)
+        self.enviadas += 1
+
+    def fechar(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                self._server.close()
+            self._server = None
+
+    def __enter__(self):
+        self.conectar()
+        return self
 
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = settings.get('assunto', "Alerta de Calibrações")
-    msg['From'] = settings['remetente_email']
-    msg['To'] = settings['para']
-    if settings.get('cc'):
-        msg['Cc'] = settings['cc']
-    
-    msg.attach(MIMEText(corpo_email, 'html', 'utf-8'))
+    def __exit__(self, *exc):
+        self.fechar()
+        return False
 
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server: 
-            server.login(settings['remetente_email'], settings['remetente_senha'])
-            server.send_message(msg)
-        return jsonify({"success": True, "message": f"E-mail de notificação enviado para {settings['para']}!"})
-    except Exception as e:
-        print(f"Erro ao enviar e-mail: {e}")
-        return jsonify({"success": False, "message": f"Erro ao enviar e-mail: {str(e)}"}), 500
+def _mime_email(remetente, mensagem):
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = mensagem['assunto']
+    msg['From'] = remetente
+    msg['To'] = mensagem['para']
+    if mensagem.get('cc'):
+        msg['Cc'] = mensagem['cc']
+    msg.attach(MIMEText(mensagem['html'], 'html', 'utf-8'))
+    return msg
+
+def _entregar_email(payload, settings):
+    """Envia todas as mensagens do item numa única sessão SMTP; as que falharem voltam à fila sozinhas."""
+    if not _email_configurado(settings):
+        return False, "Remetente ou senha de e-mail não configurados.", None
+    mensagens = payload.get('mensagens') or [payload] # itens gravados antes do agrupamento
+    pendentes, erros = [], []
+    with SmtpTransport.from_settings(settings) as smtp:
+        for mensagem in mensagens:
+            try:
+                smtp.enviar(_mime_email(settings['remetente_email'], mensagem))
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                print(f"Erro ao enviar e-mail para {mensagem['para']}: {e}")
+                pendentes.append(mensagem)
+                erros.append(f"{mensagem['para']}: {e}")
+    if not pendentes:
+        return True, f"{len(mensagens)} e-mail(s) enviado(s) em uma sessão SMTP", None
+    detalhe = f"{len(mensagens) - len(pendentes)} enviado(s), {len(pendentes)} falha(s): {'; '.join(erros)}"
+    return False, detalhe, {"mensagens": pendentes}
+
+def _resposta_notificacao_enfileirada(fila_id, mensagem):
+    if not fila_id:
+        return jsonify({"success": False, "message": "Erro ao gravar a notificação na fila de envio."}), 500
+    notificacao_worker.acordar()
+    resposta = {"success": True, "message": mensagem, "fila_id": fila_id,
+                "status_url": url_for('status_notificacao', fila_id=fila_id)}
+    if not notificacao_worker.ativo():
+        # Sem worker neste processo (CALIBRACAO_WORKERS=0) a entrega depende de `flask --app app workers`
+        print(f"AVISO: Notificação {fila_id} enfileirada sem worker da fila ativo neste processo.")
+        resposta["aviso"] = "A fila de envio não está sendo processada por este servidor; o envio depende do processo de workers."
+    return jsonify(resposta), 202
 
 # --- Rota para Envio de WhatsApp Manual ---
 def _gerar_tabela_texto_para_whatsapp(equipamentos_lista, campos_selecionados_config):
-    texto_final = ""
-    for equip in equipamentos_lista:
-        tipo_equip = equip.get('tipo_equipamento_nome', 'Equipamento')
-        texto_final += f"*{tipo_equip.upper()}*\n" 
-
-        if campos_selecionados_config.get("nome"):
-            texto_final += f"  * Nome: {equip.get('nome', 'N/D')}\n"
-        if campos_selecionados_config.get("tag"): 
-            texto_final += f"  * TAG: {equip.get('tag', 'N/D')}\n"
-        if campos_selecionados_config.get("numero_serie"):
-            texto_final += f"  * Nº Série: {equip.get('numero_serie', '(Não informado)')}\n"
-        if campos_selecionados_config.get("proxima_data_calibracao"):
-            texto_final += f"  * Próxima Calibração: {utils.format_date_for_display(equip.get('proxima_data_calibracao'))}\n"
-        if campos_selecionados_config.get("dias_vencimento"):
-            dias_v, _, _ = utils.calcular_dias_para_vencimento(equip.get('proxima_data_calibracao'), equip.get('ativo'), equip.get('em_calibracao'))
-            dias_texto = "N/A"
-            if dias_v is not None:
-                if dias_v < 0:
-                    dias_texto = f"{abs(dias_v)} dia(s) vencido(s)"
-                elif dias_v == 0:
-                    dias_texto = "Vence Hoje"
-                else:
-                    dias_texto = f"Vence em {dias_v} dia(s)"
-            texto_final += f"  * Dias para Venc.: {dias_texto}\n"
-        if campos_selecionados_config.get("status"):
-            texto_final += f"  * Status: {equip.get('status', 'N/D')}\n"
-        if campos_selecionados_config.get("localizacao"):
-            texto_final += f"  * Localização: {equip.get('localizacao', 'N/D')}\n"
-        texto_final += "\n" 
-    return texto_final.strip()
-
-def _gerar_mensagem_whatsapp_com_gemini(tabela_texto, api_key, settings):
-    prompt = (
+    # As linhas de fetch_equipamentos_para_notificacao já trazem os dias calculados no SQL
+    if campos_selecionados_config.get("dias_vencimento") and not all('dias_vencimento' in e for e in equipamentos_lista):
+        dias_lote, _, _ = utils.classificar_equipamentos_em_lote(equipamentos_lista)
+        equipamentos_lista = [dict(equip, dias_vencimento=dias) for equip, dias in zip(equipamentos_lista, dias_lote)]
+    return renderizador.tabela_texto(equipamentos_lista, campos_selecionados_config)
+
+# Incrementar ao alterar o texto do prompt: invalida as mensagens já guardadas no cache
+PROMPT_GEMINI_VERSAO = 1
+GEMINI_MODELO = "gemini-1.5-flash-latest"
+
+def _prompt_gemini_whatsapp(tabela_texto):
+    return (
         "Você é um assistente responsável por notificar sobre calibrações de equipamentos.\n"
         "Gere uma mensagem de WhatsApp amigável e profissional informando sobre os equipamentos abaixo que precisam de atenção. Não precisa ser tão formal\n"
         "Use formatação do WhatsApp como *negrito* para destacar informações importantes e _itálico_ se apropriado.\n"
@@ -1034,78 +1473,185 @@ def _gerar_mensagem_whatsapp_com_gemini(tabela_texto, api_key, settings):
         "    * Status: Calibração Vencida\n"
         "    * Localização: Laboratório"
     )
-    
-    gemini_api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={api_key}"
+
+def _gerar_mensagem_whatsapp_com_gemini(tabela_texto, api_key, timeout=15):
+    """Chama a API do Gemini; retorna (texto, None) ou (None, descrição do erro)."""
+    gemini_api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODELO}:generateContent?key={api_key}"
     payload = {
-        "contents": [{"parts": [{"text": prompt}]}]
+        "contents": [{"parts": [{"text": _prompt_gemini_whatsapp(tabela_texto)}]}]
     } 
     headers = {'Content-Type': 'application/json'}
     
     try:
-        response = requests.post(gemini_api_url, headers=headers, json=payload, timeout=45) 
+        response = requests.post(gemini_api_url, headers=headers, json=payload, timeout=timeout) 
         response.raise_for_status() 
         result = response.json()
         
         if result.get("candidates") and result["candidates"][0].get("content") and result["candidates"][0]["content"].get("parts"):
-            return result["candidates"][0]["content"]["parts"][0].get("text", "Não foi possível gerar a mensagem via Gemini.")
-        else:
-            print(f"DEBUG Gemini Response (estrutura inesperada): {result}")
-            return "Erro ao extrair texto da resposta do Gemini (estrutura inesperada)."
+            texto = result["candidates"][0]["content"]["parts"][0].get("text")
+            if texto:
+                return texto, None
+        print(f"DEBUG Gemini Response (estrutura inesperada): {result}")
+        return None, "Erro ao extrair texto da resposta do Gemini (estrutura inesperada)."
 
     except requests.exceptions.Timeout:
         print("Erro na chamada da API Gemini: Timeout")
-        return "Erro ao comunicar com a API Gemini: Timeout."
+        return None, "Erro ao comunicar com a API Gemini: Timeout."
     except requests.exceptions.RequestException as e:
         print(f"Erro na chamada da API Gemini: {e}")
-        return f"Erro ao comunicar com a API Gemini: {e}"
+        return None, f"Erro ao comunicar com a API Gemini: {e}"
     except Exception as e:
         print(f"Erro inesperado ao processar resposta do Gemini: {e}")
-        return "Erro inesperado ao processar mensagem do Gemini."
+        return None, "Erro inesperado ao processar mensagem do Gemini."
+
+def _mensagem_whatsapp_padrao(tabela_texto):
+    """Mensagem montada localmente, sem o Gemini: mesmo conteúdo para a mesma tabela."""
+    return (
+        "Olá!\n\n"
+        "Os equipamentos abaixo precisam de atenção quanto à *calibração*:\n\n"
+        f"{tabela_texto.strip()}\n\n"
+        "Por favor, programem as calibrações pendentes.\n\n"
+        "_Mensagem automática_"
+    )
 
 
-def _enviar_mensagem_whatsapp_zapi(settings, mensagem):
-    zapi_url = f"https://api.z-api.io/instances/{settings['zapi_instancia']}/token/{settings['zapi_token_instancia']}/send-text"
-    
-    destinatarios = settings.get('whatsapp_para', '').split(',')
-    sucessos = 0
-    falhas = 0
-    mensagens_erro = []
-
-    for destinatario in destinatarios:
-        phone_number = destinatario.strip()
-        if not phone_number:
-            continue
-        
-        payload = {
-            "phone": phone_number,
-            "message": mensagem
-        }
+class GeradorMensagemWhatsapp:
+    """Gera o texto do WhatsApp com o Gemini, guardando o resultado em cache no SQLite.
+
+    A chave é o SHA-256 da versão do prompt, do modelo, da tabela em texto e dos campos selecionados;
+    envios repetidos com o mesmo conteúdo dentro do TTL não chamam a API. Sem API key, com erro/timeout
+    ou com o circuito aberto (após `limite_falhas` falhas seguidas, por `pausa` segundos) usa a mensagem
+    padrão local, que não vai para o cache.
+    """
+    def __init__(self, db_manager, ttl=86400, timeout=15, limite_falhas=3, pausa=300):
+        self.db_manager = db_manager
+        self.ttl = ttl
+        self.timeout = timeout
+        self.limite_falhas = limite_falhas
+        self.pausa = pausa
+        self._lock = threading.Lock()
+        self._falhas_seguidas = 0
+        self._circuito_aberto_ate = 0.0
+        self.stats = {"cache": 0, "gemini": 0, "padrao": 0, "erros_gemini": 0}
+
+    @staticmethod
+    def chave(tabela_texto, settings):
+        conteudo = json.dumps({
+            "prompt": PROMPT_GEMINI_VERSAO, "modelo": GEMINI_MODELO, "tabela": tabela_texto,
+            "campos": sorted(k for k, v in settings.get('campos_tabela', {}).items() if v),
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+    def _circuito_aberto(self):
+        with self._lock:
+            return time.monotonic() < self._circuito_aberto_ate
+
+    def _registrar_resultado_gemini(self, sucesso):
+        with self._lock:
+            if sucesso:
+                self._falhas_seguidas = 0
+                self.stats["gemini"] += 1
+                return
+            self._falhas_seguidas += 1
+            self.stats["erros_gemini"] += 1
+            if self._falhas_seguidas >= self.limite_falhas:
+                self._circuito_aberto_ate = time.monotonic() + self.pausa
+                print(f"AVISO: Gemini indisponível ({self._falhas_seguidas} falhas seguidas); usando a mensagem padrão por {self.pausa}s.")
+
+    def gerar(self, tabela_texto, settings):
+        """Retorna (mensagem, origem), com origem 'cache', 'gemini' ou 'padrao'."""
+        chave = self.chave(tabela_texto, settings)
+        mensagem = self.db_manager.fetch_mensagem_gemini_cache(chave)
+        if mensagem is not None:
+            with self._lock:
+                self.stats["cache"] += 1
+            return mensagem, "cache"
+        if settings.get('gemini_api_key') and not self._circuito_aberto():
+            mensagem, erro = _gerar_mensagem_whatsapp_com_gemini(tabela_texto, settings['gemini_api_key'], self.timeout)
+            self._registrar_resultado_gemini(erro is None)
+            if erro is None:
+                self.db_manager.salvar_mensagem_gemini_cache(chave, mensagem, self.ttl)
+                return mensagem, "gemini"
+        with self._lock:
+            self.stats["padrao"] += 1
+        return _mensagem_whatsapp_padrao(tabela_texto), "padrao"
+
+    def get_status(self):
+        with self._lock:
+            restante = self._circuito_aberto_ate - time.monotonic()
+            return dict(self.stats, falhas_seguidas=self._falhas_seguidas,
+                        circuito_aberto_por_s=round(restante, 1) if restante > 0 else 0)
+
+gerador_mensagem_whatsapp = GeradorMensagemWhatsapp(db, ttl=app.config['GEMINI_CACHE_TTL'], timeout=app.config['GEMINI_TIMEOUT'],
+                                                    limite_falhas=app.config['GEMINI_LIMITE_FALHAS'],
+                                                    pausa=app.config['GEMINI_PAUSA'])
+
+
+class ZapiSender:
+    """Envia uma mensagem a vários números pela Z-API em paralelo.
+
+    Usa uma requests.Session compartilhada (conexões keep-alive no pool do HTTPAdapter), no máximo
+    `concorrencia` envios simultâneos e até `tentativas` por destinatário, com backoff exponencial.
+    O endereço base vem de settings['zapi_base_url'], o que permite apontar para um servidor simulado.
+    """
+    def __init__(self, concorrencia=5, tentativas=3, backoff_base=1.0, timeout=(5, 30)):
+        self.tentativas = max(1, tentativas)
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concorrencia)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=concorrencia, thread_name_prefix="zapi")
+
+    @staticmethod
+    def montar_url(settings):
+        base_url = (settings.get('zapi_base_url') or ZAPI_BASE_URL_PADRAO).rstrip('/')
+        return f"{base_url}/instances/{settings['zapi_instancia']}/token/{settings['zapi_token_instancia']}/send-text"
+
+    def _enviar_para(self, zapi_url, headers, phone_number, mensagem):
+        erro = None
+        for tentativa in range(1, self.tentativas + 1):
+            try:
+                response = self.session.post(zapi_url, headers=headers, json={"phone": phone_number, "message": mensagem},
+                                             timeout=self.timeout)
+                print(f"Z-API response para {phone_number}: {response.status_code} - {response.text}")
+                if response.status_code in (200, 201):
+                    return {"sucesso": True, "tentativas": tentativa, "erro": None}
+                erro = f"Falha Z-API para {phone_number}: {response.status_code} - {response.text}"
+                # Erros do cliente (exceto limite de taxa) não melhoram com nova tentativa
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    return {"sucesso": False, "tentativas": tentativa, "erro": erro}
+            except requests.exceptions.Timeout:
+                print(f"Erro na chamada da Z-API para {phone_number}: Timeout")
+                erro = f"Timeout na Z-API para {phone_number}"
+            except requests.exceptions.RequestException as e:
+                print(f"Erro na chamada da Z-API para {phone_number}: {e}")
+                erro = f"Erro de comunicação com Z-API para {phone_number}: {e}"
+            except Exception as e:
+                print(f"Erro inesperado ao enviar WhatsApp para {phone_number}: {e}")
+                return {"sucesso": False, "tentativas": tentativa, "erro": f"Erro inesperado para {phone_number}: {e}"}
+            if tentativa < self.tentativas:
+                time.sleep(self.backoff_base * (2 ** (tentativa - 1)))
+        return {"sucesso": False, "tentativas": self.tentativas, "erro": erro}
+
+    def enviar(self, settings, mensagem, destinatarios=None):
+        """Retorna {'sucessos', 'falhas', 'erros', 'resultados': {número: {...}}} após todos os envios."""
+        if destinatarios is None:
+            destinatarios = settings.get('whatsapp_para', '').split(',')
+        numeros = list(dict.fromkeys(d.strip() for d in destinatarios if d and d.strip()))
         headers = {"Content-Type": "application/json"}
         if settings.get('zapi_client_token'): 
             headers['Client-Token'] = settings['zapi_client_token']
+        zapi_url = self.montar_url(settings)
 
-        try:
-            response = requests.post(zapi_url, headers=headers, json=payload, timeout=30) 
-            print(f"Z-API response para {phone_number}: {response.status_code} - {response.text}")
-            if response.status_code == 200 or response.status_code == 201: 
-                 sucessos += 1
-            else:
-                falhas += 1
-                mensagens_erro.append(f"Falha Z-API para {phone_number}: {response.status_code} - {response.text}")
-        except requests.exceptions.Timeout:
-            print(f"Erro na chamada da Z-API para {phone_number}: Timeout")
-            falhas += 1
-            mensagens_erro.append(f"Timeout na Z-API para {phone_number}")
-        except requests.exceptions.RequestException as e:
-            print(f"Erro na chamada da Z-API para {phone_number}: {e}")
-            falhas += 1
-            mensagens_erro.append(f"Erro de comunicação com Z-API para {phone_number}: {e}")
-        except Exception as e:
-            print(f"Erro inesperado ao enviar WhatsApp para {phone_number}: {e}")
-            falhas += 1
-            mensagens_erro.append(f"Erro inesperado para {phone_number}: {e}")
-            
-    return sucessos, falhas, mensagens_erro
+        futuros = {numero: self._executor.submit(self._enviar_para, zapi_url, headers, numero, mensagem) for numero in numeros}
+        resultados = {numero: futuro.result() for numero, futuro in futuros.items()}
+        erros = [r['erro'] for r in resultados.values() if not r['sucesso']]
+        return {"sucessos": len(numeros) - len(erros), "falhas": len(erros), "erros": erros, "resultados": resultados}
+
+zapi_sender = ZapiSender(concorrencia=app.config['ZAPI_CONCORRENCIA'], tentativas=app.config['ZAPI_TENTATIVAS'],
+                         backoff_base=app.config['ZAPI_BACKOFF'])
 
 
 @app.route('/enviar_notificacao_whatsapp_manual', methods=['POST'])
@@ -1117,195 +1663,733 @@ def enviar_notificacao_whatsapp_manual():
     if not all([settings.get('zapi_instancia'), settings.get('zapi_token_instancia'), settings.get('whatsapp_para')]):
         return jsonify({"success": False, "message": "Configurações da Z-API (Instância, Token, Destinatários) incompletas."}), 400
     
-    if not settings.get('gemini_api_key'):
-         return jsonify({"success": False, "message": "API Key do Gemini não configurada."}), 400
-
-    dias_limite = None
-    apenas_vencidos = False
-    if "30 dias" in criterio_selecionado: dias_limite = 30
-    elif "45 dias" in criterio_selecionado: dias_limite = 45
-    elif "90 dias" in criterio_selecionado: dias_limite = 90
-    elif "apenas equipamentos vencidos" in criterio_selecionado: apenas_vencidos = True
-    
-    equipamentos_todos = db.fetch_all_equipamentos_completos()
-    equipamentos_para_notificar = []
-
-    if equipamentos_todos:
-        for equip_row in equipamentos_todos:
-            equip = dict(equip_row)
-            if not equip.get('ativo') or equip.get('em_calibracao'):
-                continue
-            
-            dias_venc, _, _ = utils.calcular_dias_para_vencimento(
-                equip.get('proxima_data_calibracao'),
-                equip.get('ativo'),
-                equip.get('em_calibracao')
-            )
-            if dias_venc is not None:
-                if apenas_vencidos and dias_venc <= 0:
-                    equipamentos_para_notificar.append(equip)
-                elif dias_limite is not None and 0 < dias_venc <= dias_limite: 
-                    equipamentos_para_notificar.append(equip)
-                elif dias_limite is not None and dias_venc <= 0 : 
-                    equipamentos_para_notificar.append(equip)
+    equipamentos_para_notificar = _selecionar_equipamentos_para_notificacao(criterio_selecionado, settings)
 
     if not equipamentos_para_notificar:
         return jsonify({"success": True, "message": "Nenhum equipamento encontrado para notificação WhatsApp com o critério selecionado."})
 
-    tabela_texto = _gerar_tabela_texto_para_whatsapp(equipamentos_para_notificar, settings.get('campos_tabela', {}))
-    
-    if not tabela_texto:
+    fila_id = _enfileirar_whatsapp(settings, equipamentos_para_notificar)
+    if fila_id is None:
          return jsonify({"success": True, "message": "Nenhum dado de equipamento para gerar a mensagem."})
 
-    mensagem_gerada_gemini = _gerar_mensagem_whatsapp_com_gemini(tabela_texto, settings['gemini_api_key'], settings)
-    
-    if "Erro" in mensagem_gerada_gemini: 
-        return jsonify({"success": False, "message": mensagem_gerada_gemini}), 500
+    destinatarios = [d for d in settings['whatsapp_para'].split(',') if d.strip()]
+    return _resposta_notificacao_enfileirada(fila_id, f"Mensagem de WhatsApp para {len(destinatarios)} número(s) enfileirada para envio.")
+
+def _enfileirar_whatsapp(settings, equipamentos_para_notificar, origem="manual"):
+    """Grava a tabela em texto e os destinatários na fila; None se não houver conteúdo para a mensagem."""
+    tabela_texto = _gerar_tabela_texto_para_whatsapp(equipamentos_para_notificar, settings.get('campos_tabela', {}))
+    if not tabela_texto:
+        return None
+    destinatarios = [d.strip() for d in settings['whatsapp_para'].split(',') if d.strip()]
+    return db.enfileirar_notificacao('whatsapp', {"tabela_texto": tabela_texto, "destinatarios": destinatarios},
+                                     max_tentativas=app.config['NOTIFICACAO_FILA_TENTATIVAS'], origem=origem)
+
+def _entregar_whatsapp(payload, settings):
+    """Gera a mensagem na primeira tentativa e envia, em partes se passar do limite do WhatsApp.
+
+    Cada número recebe as partes em ordem; numa falha, o item volta à fila só com os números pendentes
+    e a parte a partir da qual cada um deve continuar ('proxima_parte').
+    """
+    mensagem = payload.get('mensagem')
+    if mensagem is None:
+        mensagem_gerada_gemini, _ = gerador_mensagem_whatsapp.gerar(payload['tabela_texto'], settings)
+        mensagem = renderizador.corpo(settings.get('corpo_template_whatsapp'), "{tabela_equipamentos_texto}", mensagem_gerada_gemini)
+
+    partes = renderizador.dividir_whatsapp(mensagem)
+    proxima_parte = payload.get('proxima_parte') or {}
+    progresso = {numero: proxima_parte.get(numero, 0) for numero in payload['destinatarios']}
+    erros = []
+    for indice, parte in enumerate(partes):
+        numeros = [numero for numero, proxima in progresso.items() if proxima == indice]
+        if not numeros:
+            continue
+        resultado = zapi_sender.enviar(settings, parte, numeros)
+        for numero, r in resultado['resultados'].items():
+            if r['sucesso']:
+                progresso[numero] = indice + 1
+            else:
+                erros.append(r['erro'])
+
+    pendentes = {numero: proxima for numero, proxima in progresso.items() if proxima < len(partes)}
+    if not pendentes:
+        return True, f"{len(progresso)} número(s) com a mensagem de WhatsApp enviada ({len(partes)} parte(s))", None
+    # A mensagem já gerada segue no payload: as novas tentativas reenviam o mesmo texto
+    novo_payload = {"mensagem": mensagem, "destinatarios": list(pendentes), "proxima_parte": pendentes}
+    detalhe = f"{len(progresso) - len(pendentes)} enviada(s), {len(pendentes)} falha(s): {'; '.join(erros)}"
+    return False, detalhe, novo_payload
+
+
+class NotificacaoFilaWorker:
+    """Thread que esvazia a fila persistente de notificações (tabela notificacoes_fila).
+
+    Cada item é entregue pelo entregador do seu canal, que devolve (sucesso, detalhe, novo_payload).
+    O resultado vai para o registro de entregas; falhas voltam à fila com backoff exponencial até
+    esgotar as tentativas ('falhou'). Pode rodar em vários processos: a reserva é feita numa transação, e
+    itens 'enviando' há mais de `travada_segundos` (processo que caiu) voltam para a fila periodicamente.
+    """
+    def __init__(self, db_manager, entregadores, intervalo=5, lote=10, backoff_base=60, backoff_max=3600,
+                 travada_segundos=900):
+        self.db_manager = db_manager
+        self.entregadores = entregadores
+        self.intervalo = intervalo
+        self.lote = lote
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.travada_segundos = travada_segundos
+        self._parar = threading.Event()
+        self._acordar = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.ultima_execucao = None
+        self.ultimo_erro = None
+        self.entregues = 0
+        self.falhas = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._loop, name="notificacoes-fila", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._parar.set()
+        self._acordar.set()
+
+    def acordar(self):
+        """Antecipa a próxima varredura (chamado logo após enfileirar)."""
+        self._acordar.set()
+
+    def ativo(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def _entregar(self, item):
+        entregador = self.entregadores.get(item['canal'])
+        if entregador is None:
+            return False, f"Canal de notificação desconhecido: {item['canal']}", None
+        try:
+            return entregador(item['payload'], utils.load_notification_settings())
+        except Exception as e:
+            print(f"Erro ao entregar notificação {item['id']} ({item['canal']}): {e}")
+            return False, f"{type(e).__name__}: {e}", None
 
-    corpo_template_whatsapp = settings.get('corpo_template_whatsapp', "{tabela_equipamentos_texto}")
-    mensagem_final_whatsapp = corpo_template_whatsapp.replace("{tabela_equipamentos_texto}", mensagem_gerada_gemini)
+    def processar_pendentes(self):
+        """Entrega os itens vencidos da fila, em lotes; retorna quantos foram processados."""
+        processados = 0
+        try:
+            while not self._parar.is_set():
+                itens = self.db_manager.reservar_notificacoes(self.lote)
+                if not itens:
+                    break
+                for item in itens:
+                    inicio = time.perf_counter()
+                    sucesso, detalhe, novo_payload = self._entregar(item)
+                    duracao_ms = round((time.perf_counter() - inicio) * 1000, 3)
+                    status = self.db_manager.registrar_entrega_notificacao(
+                        item['id'], sucesso, detalhe, duracao_ms, novo_payload,
+                        backoff_base=self.backoff_base, backoff_max=self.backoff_max)
+                    if status == 'falhou':
+                        print(f"AVISO: Notificação {item['id']} ({item['canal']}) esgotou as tentativas: {detalhe}")
+                    with self._lock:
+                        if sucesso:
+                            self.entregues += 1
+                        else:
+                            self.falhas += 1
+                            self.ultimo_erro = detalhe
+                    processados += 1
+                if len(itens) < self.lote:
+                    break
+        finally:
+            self.db_manager.release_connection()
+        with self._lock:
+            self.ultima_execucao = datetime.datetime.now()
+        return processados
+
+    def _liberar_travadas(self):
+        liberadas = self.db_manager.liberar_notificacoes_travadas(self.travada_segundos)
+        if liberadas:
+            print(f"INFO: {liberadas} notificação(ões) interrompida(s) voltaram para a fila.")
+
+    def _loop(self):
+        proxima_liberacao = 0.0
+        while not self._parar.is_set():
+            if time.monotonic() >= proxima_liberacao:
+                self._liberar_travadas()
+                proxima_liberacao = time.monotonic() + self.travada_segundos
+            self.processar_pendentes()
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+
+    def get_status(self):
+        with self._lock:
+            status = {
+                "ativo": self.ativo(),
+                "intervalo": self.intervalo,
+                "ultima_execucao": self.ultima_execucao.isoformat(timespec='seconds') if self.ultima_execucao else None,
+                "entregues": self.entregues,
+                "falhas": self.falhas,
+                "ultimo_erro": self.ultimo_erro,
+            }
+        status["fila"] = self.db_manager.get_notification_queue_stats()
+        return status
+
+notificacao_worker = NotificacaoFilaWorker(db, {'email': _entregar_email, 'whatsapp': _entregar_whatsapp},
+                                           intervalo=app.config['NOTIFICACAO_FILA_INTERVALO'],
+                                           backoff_base=app.config['NOTIFICACAO_FILA_BACKOFF'],
+                                           backoff_max=app.config['NOTIFICACAO_FILA_BACKOFF_MAX'],
+                                           travada_segundos=app.config['NOTIFICACAO_FILA_TRAVADA'])
+
+def _somar_meses(data_hora, meses):
+    """Soma meses mantendo o dia, limitado ao último dia do mês (31/01 + 1 mês = 28 ou 29/02)."""
+    total = data_hora.month - 1 + meses
+    ano, mes = data_hora.year + total // 12, total % 12 + 1
+    return data_hora.replace(year=ano, month=mes, day=min(data_hora.day, calendar.monthrange(ano, mes)[1]))
+
+def _inicio_agendamento(settings):
+    """Primeira ocorrência do agendamento (data de início + horário) ou None se desativado/incompleto."""
+    if settings.get('agendamento_periodicidade') not in PERIODOS_AGENDAMENTO:
+        return None
+    try:
+        horario = datetime.datetime.strptime(settings.get('agendamento_horario') or "08:00", "%H:%M").time()
+    except ValueError:
+        return None
+    data_inicio = None
+    texto_data = (settings.get('agendamento_data_inicio') or "").strip()
+    for formato in ("%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            data_inicio = datetime.datetime.strptime(texto_data, formato).date()
+            break
+        except ValueError:
+            continue
+    if data_inicio is None and settings.get('agendamento_atualizado_em'):
+        # Sem data de início, a contagem parte do dia em que o agendamento foi salvo
+        data_inicio = datetime.datetime.fromisoformat(settings['agendamento_atualizado_em']).date()
+    if data_inicio is None:
+        return None
+    return datetime.datetime.combine(data_inicio, horario)
+
+def _ocorrencias_agendamento(periodicidade, inicio, agora):
+    """Retorna (última ocorrência <= agora ou None, próxima ocorrência > agora)."""
+    if agora < inicio:
+        return None, inicio
+    unidade, passo = PERIODOS_AGENDAMENTO[periodicidade]
+    if unidade == "dias":
+        intervalo = datetime.timedelta(days=passo)
+        ultima = inicio + ((agora - inicio) // intervalo) * intervalo
+        return ultima, ultima + intervalo
+    n = ((agora.year - inicio.year) * 12 + agora.month - inicio.month) // passo
+    ultima = _somar_meses(inicio, n * passo)
+    if ultima > agora:
+        n -= 1
+        ultima = _somar_meses(inicio, n * passo)
+    return ultima, _somar_meses(inicio, (n + 1) * passo)
+
+
+class AgendadorNotificacoes:
+    """Executa o agendamento configurado em /configuracoes (periodicidade, data de início e horário).
+
+    A cada `intervalo` segundos calcula a última ocorrência devida; se ainda não foi executada (inclusive
+    ocorrências perdidas com o servidor parado), reserva-a em notificacoes_agendamento — só um processo
+    consegue a reserva, mesmo com vários workers do gunicorn — e enfileira e-mail e WhatsApp com o critério
+    padrão. Ocorrências anteriores à última alteração do agendamento não são recuperadas.
+    """
+    def __init__(self, db_manager, intervalo=60):
+        self.db_manager = db_manager
+        self.intervalo = intervalo
+        self.instancia = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._parar = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._proxima_execucao = None
+        self.ultima_ocorrencia = None
+        self.ultimo_resultado = None
+        self.ultimo_erro = None
+        self.execucoes = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._loop, name="notificacoes-agendamento", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._parar.set()
+
+    def ativo(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def verificar(self, agora=None):
+        """Executa a ocorrência devida, se houver; retorna o resultado da execução ou None."""
+        agora = agora or datetime.datetime.now()
+        settings = utils.load_notification_settings()
+        inicio = _inicio_agendamento(settings)
+        if inicio is None:
+            with self._lock:
+                self._proxima_execucao = None
+            return None
+        ultima, proxima = _ocorrencias_agendamento(settings['agendamento_periodicidade'], inicio, agora)
+        with self._lock:
+            self._proxima_execucao = proxima
+        if ultima is None:
+            return None
+        atualizado_em = settings.get('agendamento_atualizado_em')
+        if atualizado_em and ultima < datetime.datetime.fromisoformat(atualizado_em):
+            return None
+        ocorrencia = ultima.isoformat(timespec='seconds')
+        if not self.db_manager.reivindicar_execucao_agendada(ocorrencia, settings['agendamento_periodicidade'], self.instancia):
+            return None
+        return self._executar(ocorrencia, settings)
+
+    def _executar(self, ocorrencia, settings):
+        enfileirados, detalhes = 0, []
+        try:
+            equipamentos = _selecionar_equipamentos_para_notificacao(settings['criterio_padrao_vencimento'], settings)
+            if not equipamentos:
+                detalhes.append("nenhum equipamento atende ao critério")
+            else:
+                if _email_configurado(settings):
+                    if _enfileirar_email(settings, equipamentos, origem="agendamento"):
+                        enfileirados += 1
+                else:
+                    detalhes.append("e-mail não configurado")
+                if all(settings.get(c) for c in ('zapi_instancia', 'zapi_token_instancia', 'whatsapp_para')):
+                    if _enfileirar_whatsapp(settings, equipamentos, origem="agendamento"):
+                        enfileirados += 1
+                else:
+                    detalhes.append("WhatsApp não configurado")
+            erro = None
+        except Exception as e:
+            erro = str(e)
+            detalhes.append(f"erro: {e}")
+            print(f"Erro na execução agendada de notificações ({ocorrencia}): {e}")
+        finally:
+            self.db_manager.release_connection()
+        if erro is None:
+            # Com erro a reserva fica aberta e é retomada quando expirar
+            self.db_manager.concluir_execucao_agendada(ocorrencia, enfileirados, "; ".join(detalhes) or None)
+        if enfileirados:
+            notificacao_worker.acordar()
+        resultado = {"ocorrencia": ocorrencia, "itens_enfileirados": enfileirados, "detalhe": "; ".join(detalhes) or None}
+        with self._lock:
+            self.ultima_ocorrencia = ocorrencia
+            self.ultimo_resultado = resultado
+            self.ultimo_erro = erro
+            self.execucoes += 1
+        print(f"INFO: Notificações agendadas ({ocorrencia}): {enfileirados} item(ns) enfileirado(s).")
+        return resultado
+
+    def _loop(self):
+        while True:
+            try:
+                self.verificar()
+            except Exception as e:
+                print(f"Erro no agendamento de notificações: {e}")
+            finally:
+                self.db_manager.release_connection()
+            if self._parar.wait(self.intervalo):
+                break
+
+    def get_status(self):
+        with self._lock:
+            return {
+                "ativo": self.ativo(),
+                "instancia": self.instancia,
+                "proxima_execucao": self._proxima_execucao.isoformat(timespec='seconds') if self._proxima_execucao else None,
+                "ultima_ocorrencia": self.ultima_ocorrencia,
+                "ultimo_resultado": self.ultimo_resultado,
+                "ultimo_erro": self.ultimo_erro,
+                "execucoes": self.execucoes,
+            }
 
-    sucessos, falhas, erros_envio = _enviar_mensagem_whatsapp_zapi(settings, mensagem_final_whatsapp)
+agendador_notificacoes = AgendadorNotificacoes(db, intervalo=app.config['AGENDAMENTO_INTERVALO'])
 
-    if sucessos > 0 and falhas == 0:
-        return jsonify({"success": True, "message": f"{sucessos} mensagem(ns) de WhatsApp enviada(s) com sucesso!"})
-    elif sucessos > 0 and falhas > 0:
-        return jsonify({"success": True, "message": f"{sucessos} mensagem(ns) enviada(s), {falhas} falha(s). Detalhes: {'; '.join(erros_envio)}"})
-    else:
-        return jsonify({"success": False, "message": f"Nenhuma mensagem de WhatsApp enviada. Falhas: {falhas}. Detalhes: {'; '.join(erros_envio)}"}), 500
+@app.route('/notificacoes/previa/<canal>')
+@login_required
+def previa_notificacao(canal):
+    """Mostra o que seria enviado com o critério informado, sem enfileirar nada (nem chamar o Gemini)."""
+    settings = utils.load_notification_settings()
+    criterio = request.args.get('criterio', settings['criterio_padrao_vencimento'])
+    equipamentos = _selecionar_equipamentos_para_notificacao(criterio, settings)
+    campos = settings.get('campos_tabela', {})
+    if canal == 'email':
+        corpo = renderizador.iter_corpo(settings.get('corpo_template_email'), "{tabela_equipamentos}",
+                                        renderizador.iter_tabela_html(equipamentos, campos))
+        return Response(stream_with_context(corpo), mimetype='text/html')
+    if canal == 'whatsapp':
+        mensagem = renderizador.corpo(settings.get('corpo_template_whatsapp'), "{tabela_equipamentos_texto}",
+                                      _mensagem_whatsapp_padrao(_gerar_tabela_texto_para_whatsapp(equipamentos, campos)))
+        return jsonify({"success": True, "equipamentos": len(equipamentos), "partes": renderizador.dividir_whatsapp(mensagem)})
+    abort(404)
+
+@app.route('/notificacoes/fila')
+@login_required
+def fila_notificacoes():
+    status = request.args.get('status')
+    if status and status not in db.STATUS_FILA_NOTIFICACAO:
+        return jsonify({"success": False, "message": "Status inválido."}), 400
+    itens = [dict(item) for item in db.fetch_notificacoes_fila(status, limite=request.args.get('limite', 50, type=int))]
+    return jsonify({"success": True, "resumo": db.get_notification_queue_stats(), "itens": itens})
+
+@app.route('/notificacoes/fila/<int:fila_id>')
+@login_required
+def status_notificacao(fila_id):
+    item = db.fetch_notificacao_by_id(fila_id)
+    if item is None:
+        return jsonify({"success": False, "message": "Notificação não encontrada."}), 404
+    item = dict(item)
+    item['entregas'] = [dict(e) for e in db.fetch_entregas_notificacao(fila_id)]
+    return jsonify({"success": True, "notificacao": item})
+
+@app.route('/notificacoes/fila/<int:fila_id>/reenviar', methods=['POST'])
+@login_required
+def reenviar_notificacao(fila_id):
+    if not db.reenfileirar_notificacao(fila_id):
+        return jsonify({"success": False, "message": "Só notificações que esgotaram as tentativas podem ser reenviadas."}), 409
+    notificacao_worker.acordar()
+    return jsonify({"success": True, "message": "Notificação recolocada na fila."})
 
 
 # --- Rotas de Exportação Excel ---
+EXPORT_AMOSTRA_LARGURA = 200 # linhas usadas para estimar a largura das colunas
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_PROGRESSO_INTERVALO = 500 # linhas entre atualizações do progresso dos jobs
+EXPORT_MIMETYPE_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+CABECALHOS_EXPORT_EQUIPAMENTOS = ["ID", "Nome", "TAG", "Fabricante", "Modelo", "Nº Série", "Status", "Localização", "Obs. Equip.", 
+                                  "Tipo Equipamento", "Faixa de Uso",
+                                  "Últ. Nº Cert.", "Últ. Data Cal.", "Próx. Data Cal.",
+                                  "Últ. Res. Geral Certificado",
+                                  "Ativo", "Requer Calibração", "Em Calibração", "Destino Inativo"]
+CABECALHOS_EXPORT_ANALISES = ["ID Equip.", "Nome Equip.", "ID Análise", "Data Reg. Sistema", "Data Análise", "Responsável",
+                              "Nº Cert.", "Data Cal. (Cert.)", "Próx. Cal. (Cert.)",
+                              "Resultado Geral Cert.", "Obs. Análise"]
+CABECALHOS_EXPORT_PONTOS = ["ID Análise", "Nº Cert. Análise", "Nome Ponto", "Símbolo", "Valor Nominal",
+                            "Amplitude A", "Desvio B", "Regra Aplicada", "Resultado Ponto", "Obs. Ponto"]
+CABECALHOS_EXPORT_ANEXOS = ["ID Análise", "Nº Cert. Análise", "Nome Original Anexo", "Caminho Armazenado", "Data Anexo"]
+
+
+class AbaExcelStreaming:
+    """Aba de um Workbook write_only que grava as linhas à medida que chegam.
+
+    As primeiras EXPORT_AMOSTRA_LARGURA linhas ficam em memória só para calcular a largura
+    das colunas (no modo write_only ela precisa ser definida antes da primeira linha).
+    """
+    def __init__(self, wb, titulo, cabecalhos, tamanho_amostra=EXPORT_AMOSTRA_LARGURA):
+        self.ws = wb.create_sheet(title=titulo)
+        self.cabecalhos = cabecalhos
+        self.tamanho_amostra = tamanho_amostra
+        self._amostra = []
+        self._iniciada = False
+        self.linhas = 0
+
+    def append(self, linha):
+        self.linhas += 1
+        if self._iniciada:
+            self.ws.append(linha)
+            return
+        self._amostra.append(linha)
+        if len(self._amostra) >= self.tamanho_amostra:
+            self._iniciar()
+
+    def fechar(self):
+        if not self._iniciada:
+            self._iniciar()
+
+    def _iniciar(self):
+        larguras = [len(str(titulo)) for titulo in self.cabecalhos]
+        for linha in self._amostra:
+            for idx, valor in enumerate(linha[:len(larguras)]):
+                if valor is not None:
+                    larguras[idx] = max(larguras[idx], len(str(valor)))
+        for idx, largura in enumerate(larguras, 1):
+            self.ws.column_dimensions[get_column_letter(idx)].width = min(largura + 2 if largura > 0 else 12, 80)
+
+        celulas_cabecalho = []
+        for titulo in self.cabecalhos:
+            celula = WriteOnlyCell(self.ws, value=titulo)
+            celula.font = Font(bold=True)
+            celula.alignment = Alignment(horizontal="center")
+            celulas_cabecalho.append(celula)
+        self.ws.append(celulas_cabecalho)
+        for linha in self._amostra:
+            self.ws.append(linha)
+        self._amostra = []
+        self._iniciada = True
+
+
+def _linha_export_equipamento(equip):
+    return [
+        equip.get('id'), equip.get('nome'), equip.get('tag'), equip.get('fabricante'), equip.get('modelo'), equip.get('numero_serie'), 
+        equip.get('status'), equip.get('localizacao'), equip.get('observacoes_equipamento'),
+        equip.get('tipo_equipamento_nome'), equip.get('faixa_de_uso'),
+        equip.get('ultimo_numero_certificado'), 
+        utils.format_date_for_display(equip.get('ultima_data_calibracao')), 
+        utils.format_date_for_display(equip.get('proxima_data_calibracao')),
+        equip.get('ultimo_resultado_geral_certificado'),
+        "Sim" if equip.get('ativo') else "Não",
+        "Sim" if equip.get('requer_calibracao') else "Não",
+        "Sim" if equip.get('em_calibracao') else "Não",
+        equip.get('destino_inativo') or ""
+    ]
+
+def _linha_export_analise(analise):
+    return [
+        analise.get('equipamento_id'), analise.get('equipamento_nome'), analise.get('id'),
+        utils.format_date_for_display(analise.get('data_registro_sistema')), 
+        utils.format_date_for_display(analise.get('data_analise_manual')),
+        analise.get('responsavel_analise'),
+        analise.get('numero_certificado_analisado'),
+        utils.format_date_for_display(analise.get('data_calibracao_analisada')),
+        utils.format_date_for_display(analise.get('data_prox_calibracao_analisada')),
+        analise.get('resultado_geral_certificado'),
+        analise.get('observacoes_analise')
+    ]
+
+def _linha_export_ponto(ponto):
+    return [
+        ponto.get('analise_certificado_id'), ponto.get('numero_certificado_analisado'),
+        ponto.get('nome_ponto'), ponto.get('simbolo_ponto'), ponto.get('valor_nominal_ponto'),
+        ponto.get('amplitude_A_ponto'), ponto.get('desvio_B_ponto'),
+        ponto.get('regra_aplicada_ponto'), ponto.get('resultado_ponto'),
+        ponto.get('observacoes_ponto')
+    ]
+
+def _linha_export_anexo(anexo):
+    return [
+        anexo.get('analise_id'), anexo.get('numero_certificado_analisado'),
+        anexo.get('nome_arquivo_original'),
+        anexo.get('caminho_relativo_armazenado'),
+        utils.format_date_for_display(anexo.get('data_anexo'))
+    ]
+
+def _datasets_exportacao(equipamentos):
+    """Conjuntos de dados do relatório: (chave, título da aba, cabeçalhos, gerador de linhas).
+
+    Cada conjunto vem de uma única consulta em lote sobre os IDs dos equipamentos,
+    lida sob demanda, em vez de consultas por equipamento/análise.
+    """
+    equip_ids = [equip['id'] for equip in equipamentos]
+    return [
+        ("equipamentos", "Equipamentos", CABECALHOS_EXPORT_EQUIPAMENTOS,
+         (_linha_export_equipamento(dict(equip)) for equip in equipamentos)),
+        ("analises", "Historico Análises", CABECALHOS_EXPORT_ANALISES,
+         (_linha_export_analise(dict(row)) for row in db.iter_analises_por_equipamentos(equip_ids))),
+        ("pontos", "Pontos Analisados", CABECALHOS_EXPORT_PONTOS,
+         (_linha_export_ponto(dict(row)) for row in db.iter_pontos_por_equipamentos(equip_ids))),
+        ("anexos", "Anexos", CABECALHOS_EXPORT_ANEXOS,
+         (_linha_export_anexo(dict(row)) for row in db.iter_anexos_por_equipamentos(equip_ids))),
+    ]
+
+def _escrever_workbook_equipamentos(equipamentos, progresso=None, ao_progredir=None):
+    """Monta o relatório (4 abas) em modo write_only, sem manter as linhas em memória.
+
+    Se `progresso` (dict) for informado, recebe o número de linhas gravadas por aba; `ao_progredir`
+    é chamado a cada atualização.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    for chave, titulo, cabecalhos, linhas in _datasets_exportacao(equipamentos):
+        aba = AbaExcelStreaming(wb, titulo, cabecalhos)
+        for linha in linhas:
+            aba.append(linha)
+            if progresso is not None and aba.linhas % EXPORT_PROGRESSO_INTERVALO == 0:
+                progresso[chave] = aba.linhas
+                if ao_progredir:
+                    ao_progredir()
+        aba.fechar()
+        if progresso is not None:
+            progresso[chave] = aba.linhas
+            if ao_progredir:
+                ao_progredir()
+    return wb
+
+def _resposta_arquivo_temporario(gravar, sufixo, nome_arquivo, mimetype):
+    """Grava o arquivo com `gravar(caminho)` em um temporário e o envia em blocos, apagando-o ao final."""
+    arquivo_tmp = tempfile.NamedTemporaryFile(suffix=sufixo, delete=False)
+    arquivo_tmp.close()
+    try:
+        gravar(arquivo_tmp.name)
+    except Exception:
+        os.remove(arquivo_tmp.name)
+        raise
+
+    def gerar_blocos():
+        try:
+            with open(arquivo_tmp.name, 'rb') as f:
+                while True:
+                    bloco = f.read(EXPORT_CHUNK_BYTES)
+                    if not bloco:
+                        break
+                    yield bloco
+        finally:
+            os.remove(arquivo_tmp.name)
+
+    return Response(
+        gerar_blocos(),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f"attachment;filename={nome_arquivo}",
+            "Content-Length": str(os.path.getsize(arquivo_tmp.name))
+        }
+    )
+
+def _resposta_workbook_streaming(wb, nome_arquivo):
+    return _resposta_arquivo_temporario(wb.save, ".xlsx", nome_arquivo, EXPORT_MIMETYPE_XLSX)
+
+def _equipamentos_para_exportacao(search_query):
+    if search_query:
+        return db.search_equipamentos(search_query)
+    return db.fetch_all_equipamentos_completos()
+
+class ExportJobManager:
+    """Gera o relatório geral em threads de um pool, fora da requisição HTTP.
+
+    O estado dos jobs fica na tabela exportacoes_jobs e os arquivos em `diretorio`, então
+    qualquer processo responde ao status e ao download. Um arquivo pronto é reaproveitado
+    para a mesma pesquisa enquanto a versão dos dados não mudar e o TTL não expirar.
+    """
+    PROGRESSO_INTERVALO_SEGUNDOS = 1.0 # no máximo uma gravação de progresso por segundo e job
+
+    def __init__(self, db_manager_instance, diretorio, max_workers=2, ttl_segundos=3600, inativo_segundos=300):
+        self.db_manager = db_manager_instance
+        self.diretorio = diretorio
+        self.ttl_segundos = ttl_segundos
+        self.inativo_segundos = inativo_segundos
+        self.instancia = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="exportacao")
+        self._orfaos_verificados = False
+        os.makedirs(self.diretorio, exist_ok=True)
+
+    def _remover_orfaos(self):
+        """Apaga .xlsx/.tmp mais antigos que o TTL (sem job que os referencie); os recentes podem ser de outro processo."""
+        self._orfaos_verificados = True
+        limite = time.time() - self.ttl_segundos
+        for nome in os.listdir(self.diretorio):
+            if not (nome.endswith(".xlsx") or nome.endswith(".tmp")):
+                continue
+            caminho = os.path.join(self.diretorio, nome)
+            try:
+                if os.path.getmtime(caminho) < limite:
+                    os.remove(caminho)
+            except OSError:
+                pass
+
+    def submeter(self, search_query=""):
+        """Retorna (job, reutilizado). Reaproveita job pendente/concluído com a mesma pesquisa e dados."""
+        self.limpar_expirados()
+        if not self._orfaos_verificados:
+            self._remover_orfaos()
+        job_id = uuid.uuid4().hex
+        job, reutilizado = self.db_manager.criar_job_exportacao(
+            job_id, search_query, self.db_manager.get_data_version(),
+            {chave: 0 for chave in ('equipamentos', 'analises', 'pontos', 'anexos')},
+            os.path.join(self.diretorio, f"{job_id}.xlsx"), self.instancia, inativo_segundos=self.inativo_segundos)
+        if job is None:
+            raise RuntimeError("Não foi possível registrar o job de exportação.")
+        if not reutilizado:
+            self._executor.submit(self._executar, job)
+        return job, reutilizado
+
+    def _executar(self, job):
+        job_id = job['id']
+        arquivo_tmp = job['arquivo'] + ".tmp"
+        progresso = dict(job['progresso'])
+        ultima_gravacao = [0.0]
+
+        def gravar_progresso():
+            agora = time.time()
+            if agora - ultima_gravacao[0] >= self.PROGRESSO_INTERVALO_SEGUNDOS:
+                ultima_gravacao[0] = agora
+                self.db_manager.atualizar_job_exportacao(job_id, progresso=progresso)
+
+        try:
+            self.db_manager.atualizar_job_exportacao(job_id, status='executando')
+            equipamentos = _equipamentos_para_exportacao(job['search'])
+            if not equipamentos:
+                raise ValueError("Nenhum equipamento para exportar.")
+            wb = _escrever_workbook_equipamentos(equipamentos, progresso=progresso, ao_progredir=gravar_progresso)
+            wb.save(arquivo_tmp)
+            os.replace(arquivo_tmp, job['arquivo'])
+            self.db_manager.atualizar_job_exportacao(job_id, status='concluido', progresso=progresso,
+                                                     expira_em=time.time() + self.ttl_segundos)
+        except Exception as e:
+            print(f"Erro na exportação {job_id}: {e}")
+            self.db_manager.atualizar_job_exportacao(job_id, status='erro', progresso=progresso, erro=str(e),
+                                                     expira_em=time.time() + self.ttl_segundos)
+            if os.path.exists(arquivo_tmp):
+                os.remove(arquivo_tmp)
+        finally:
+            self.db_manager.release_connection()
+
+    def get_job(self, job_id):
+        job = self.db_manager.fetch_job_exportacao(job_id)
+        if job and job['expira_em'] is not None and job['expira_em'] <= time.time():
+            return None
+        return job
+
+    def limpar_expirados(self):
+        for arquivo in self.db_manager.remover_jobs_exportacao_expirados(inativo_segundos=self.inativo_segundos):
+            if os.path.exists(arquivo):
+                try:
+                    os.remove(arquivo)
+                except OSError as e:
+                    print(f"Erro ao remover exportação expirada {arquivo}: {e}")
+
+export_jobs = ExportJobManager(db, app.config['EXPORT_FOLDER'], max_workers=app.config['EXPORT_JOB_WORKERS'],
+                               ttl_segundos=app.config['EXPORT_JOB_TTL'])
+
+def _job_exportacao_para_json(job):
+    dados = {
+        "job_id": job['id'], "status": job['status'], "search": job['search'],
+        "progresso": job['progresso'], "criado_em": job['criado_em'],
+        "concluido_em": job['concluido_em'], "erro": job['erro']
+    }
+    if job['status'] == 'concluido':
+        dados["download_url"] = url_for('baixar_exportacao', job_id=job['id'])
+    return dados
+
+@app.route('/exportacoes', methods=['POST'])
+@login_required
+def criar_exportacao():
+    search_query = request.form.get('search', request.args.get('search', ''))
+    try:
+        job, reutilizado = export_jobs.submeter(search_query)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 500
+    dados = _job_exportacao_para_json(job)
+    dados["reutilizado"] = reutilizado
+    dados["status_url"] = url_for('status_exportacao', job_id=job['id'])
+    return jsonify(dados), 202
+
+@app.route('/exportacoes/<job_id>')
+@login_required
+def status_exportacao(job_id):
+    job = export_jobs.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Exportação não encontrada ou expirada."}), 404
+    return jsonify(_job_exportacao_para_json(job))
+
+@app.route('/exportacoes/<job_id>/download')
+@login_required
+def baixar_exportacao(job_id):
+    job = export_jobs.get_job(job_id)
+    if not job or job['status'] != 'concluido' or not os.path.exists(job['arquivo']):
+        abort(404)
+    return send_file(job['arquivo'], mimetype=EXPORT_MIMETYPE_XLSX, as_attachment=True,
+                     download_name="relatorio_equipamentos_completo.xlsx")
+
 @app.route('/exportar_geral_excel')
 @login_required
 def exportar_geral_excel():
     search_query = request.args.get('search', '') 
-    if search_query:
-        equipamentos_data_raw = db.search_equipamentos(search_query)
-    else:
-        equipamentos_data_raw = db.fetch_all_equipamentos_completos()
+    equipamentos_data_raw = _equipamentos_para_exportacao(search_query)
 
     if not equipamentos_data_raw:
         flash("Nenhum equipamento para exportar.", "info")
         return redirect(url_for('lista_equipamentos'))
 
-    output = BytesIO()
-    wb = openpyxl.Workbook() 
-    
-    ws_equip = wb.active
-    ws_equip.title = "Equipamentos"
-    headers_equip = ["ID", "Nome", "TAG", "Fabricante", "Modelo", "Nº Série", "Status", "Localização", "Obs. Equip.", 
-                     "Tipo Equipamento", "Faixa de Uso",
-                     "Últ. Nº Cert.", "Últ. Data Cal.", "Próx. Data Cal.",
-                     "Últ. Res. Geral Certificado",
-                     "Ativo", "Requer Calibração", "Em Calibração", "Destino Inativo"]
-    ws_equip.append(headers_equip)
-    for col_num, header_title in enumerate(headers_equip, 1):
-        cell = ws_equip.cell(row=1, column=col_num)
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal="center")
-
-    for equip_row in equipamentos_data_raw:
-        equip = dict(equip_row)
-        dados_linha = [
-            equip.get('id'), equip.get('nome'), equip.get('tag'), equip.get('fabricante'), equip.get('modelo'), equip.get('numero_serie'), 
-            equip.get('status'), equip.get('localizacao'), equip.get('observacoes_equipamento'),
-            equip.get('tipo_equipamento_nome'), equip.get('faixa_de_uso'),
-            equip.get('ultimo_numero_certificado'), 
-            utils.format_date_for_display(equip.get('ultima_data_calibracao')), 
-            utils.format_date_for_display(equip.get('proxima_data_calibracao')),
-            equip.get('ultimo_resultado_geral_certificado'),
-            "Sim" if equip.get('ativo') else "Não",
-            "Sim" if equip.get('requer_calibracao') else "Não",
-            "Sim" if equip.get('em_calibracao') else "Não",
-            equip.get('destino_inativo') or ""
-        ]
-        ws_equip.append(dados_linha)
-    
-    ws_analises = wb.create_sheet(title="Historico Análises")
-    headers_analises = ["ID Equip.", "Nome Equip.", "ID Análise", "Data Reg. Sistema", "Data Análise", "Responsável",
-                        "Nº Cert.", "Data Cal. (Cert.)", "Próx. Cal. (Cert.)",
-                        "Resultado Geral Cert.", "Obs. Análise"]
-    ws_analises.append(headers_analises)
-    for col_num, header_title in enumerate(headers_analises, 1):
-        ws_analises.cell(row=1, column=col_num).font = Font(bold=True)
-        ws_analises.cell(row=1, column=col_num).alignment = Alignment(horizontal="center")
-
-    ws_pontos = wb.create_sheet(title="Pontos Analisados")
-    headers_pontos = ["ID Análise", "Nº Cert. Análise", "Nome Ponto", "Símbolo", "Valor Nominal",
-                      "Amplitude A", "Desvio B", "Regra Aplicada", "Resultado Ponto", "Obs. Ponto"]
-    ws_pontos.append(headers_pontos)
-    for col_num, header_title in enumerate(headers_pontos, 1):
-        ws_pontos.cell(row=1, column=col_num).font = Font(bold=True)
-        ws_pontos.cell(row=1, column=col_num).alignment = Alignment(horizontal="center")
-
-    ws_anexos = wb.create_sheet(title="Anexos")
-    headers_anexos = ["ID Análise", "Nº Cert. Análise", "Nome Original Anexo", "Caminho Armazenado", "Data Anexo"]
-    ws_anexos.append(headers_anexos)
-    for col_num, header_title in enumerate(headers_anexos, 1):
-        ws_anexos.cell(row=1, column=col_num).font = Font(bold=True)
-        ws_anexos.cell(row=1, column=col_num).alignment = Alignment(horizontal="center")
-
-    if equipamentos_data_raw:
-        for equip_row in equipamentos_data_raw:
-            equip = dict(equip_row)
-            equip_id = equip.get('id')
-            equip_nome = equip.get('nome')
-            
-            hist_analises = db.fetch_analises_by_equipamento_id(equip_id, app_utils_instance=utils) 
-            for analise_dict_from_db in hist_analises:
-                analise = dict(analise_dict_from_db) 
-                ws_analises.append([
-                    equip_id, equip_nome, analise.get('id'),
-                    analise.get('data_registro_sistema_fmt'), 
-                    analise.get('data_analise_manual_fmt'),
-                    analise.get('responsavel_analise'),
-                    analise.get('numero_certificado_analisado'),
-                    analise.get('data_calibracao_analisada_fmt'),
-                    analise.get('data_prox_calibracao_analisada_fmt'),
-                    analise.get('resultado_geral_certificado'),
-                    analise.get('observacoes_analise')
-                ])
-
-                pontos_da_analise = db.fetch_pontos_by_analise_id(analise['id'])
-                for ponto_row in pontos_da_analise:
-                    ponto = dict(ponto_row)
-                    ws_pontos.append([
-                        analise.get('id'), analise.get('numero_certificado_analisado'),
-                        ponto.get('nome_ponto'), ponto.get('simbolo_ponto'), ponto.get('valor_nominal_ponto'),
-                        ponto.get('amplitude_A_ponto'), ponto.get('desvio_B_ponto'),
-                        ponto.get('regra_aplicada_ponto'), ponto.get('resultado_ponto'),
-                        ponto.get('observacoes_ponto')
-                    ])
-                
-                anexos_da_an = db.fetch_anexos_by_analise_id(analise['id'])
-                for anexo_row in anexos_da_an:
-                    anexo = dict(anexo_row)
-                    ws_anexos.append([
-                        analise.get('id'), 
-                        analise.get('numero_certificado_analisado'),
-                        anexo.get('nome_arquivo_original'),
-                        anexo.get('caminho_relativo_armazenado'),
-                        utils.format_date_for_display(anexo.get('data_anexo'))
-                ])
-            for cell in column_cells_tuple:
-                try:
-                    if cell.value is not None and len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-
-                except:
-                    pass
-            adjusted_width = (max_length + 2 if max_length > 0 else 12) 
-            ws.column_dimensions[column_letter].width = adjusted_width
-            
-    wb.save(output) 
-    output.seek(0)
-
-    return Response(
-        output,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment;filename=relatorio_equipamentos_completo.xlsx"}
-    )
+    wb = _escrever_workbook_equipamentos(equipamentos_data_raw)
+    return _resposta_workbook_streaming(wb, "relatorio_equipamentos_completo.xlsx")
 
 
 @app.route('/exportar_individual_excel/<int:equip_id>')
@@ -1317,135 +2401,126 @@ def exportar_individual_excel(equip_id):
         return redirect(url_for('lista_equipamentos'))
 
     equip = dict(equip_data)
-    
-    output = BytesIO()
-    wb = openpyxl.Workbook() 
-    
-    ws_equip = wb.active
-    ws_equip.title = "Equipamentos"
-    headers_equip = ["ID", "Nome", "TAG", "Fabricante", "Modelo", "Nº Série", "Status", "Localização", "Obs. Equip.", 
-                     "Tipo Equipamento", "Faixa de Uso",
-                     "Últ. Nº Cert.", "Últ. Data Cal.", "Próx. Data Cal.",
-                     "Últ. Res. Geral Certificado",
-                     "Ativo", "Requer Calibração", "Em Calibração", "Destino Inativo"]
-    ws_equip.append(headers_equip)
-    for col_num, header_title in enumerate(headers_equip, 1):
-        cell = ws_equip.cell(row=1, column=col_num)
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal="center")
-
-    dados_linha_equip = [
-        equip.get('id'), equip.get('nome'), equip.get('tag'), equip.get('fabricante'), equip.get('modelo'), equip.get('numero_serie'), 
-        equip.get('status'), equip.get('localizacao'), equip.get('observacoes_equipamento'),
-        equip.get('tipo_equipamento_nome'), equip.get('faixa_de_uso'),
-        equip.get('ultimo_numero_certificado'), 
-        utils.format_date_for_display(equip.get('ultima_data_calibracao')), 
-        utils.format_date_for_display(equip.get('proxima_data_calibracao')),
-        equip.get('ultimo_resultado_geral_certificado'),
-        "Sim" if equip.get('ativo') else "Não",
-        "Sim" if equip.get('requer_calibracao') else "Não",
-        "Sim" if equip.get('em_calibracao') else "Não",
-        equip.get('destino_inativo') or ""
-    ]
-    ws_equip.append(dados_linha_equip)
-    
-    ws_analises = wb.create_sheet(title="Historico Análises")
-    headers_analises = ["ID Equip.", "Nome Equip.", "ID Análise", "Data Reg. Sistema", "Data Análise", "Responsável",
-                        "Nº Cert.", "Data Cal. (Cert.)", "Próx. Cal. (Cert.)",
-                        "Resultado Geral Cert.", "Obs. Análise"]
-    ws_analises.append(headers_analises)
-    for col_num, header_title in enumerate(headers_analises, 1):
-        ws_analises.cell(row=1, column=col_num).font = Font(bold=True)
-        ws_analises.cell(row=1, column=col_num).alignment = Alignment(horizontal="center")
-
-    ws_pontos = wb.create_sheet(title="Pontos Analisados")
-    headers_pontos = ["ID Análise", "Nº Cert. Análise", "Nome Ponto", "Símbolo", "Valor Nominal",
-                      "Amplitude A", "Desvio B", "Regra Aplicada", "Resultado Ponto", "Obs. Ponto"]
-    ws_pontos.append(headers_pontos)
-    for col_num, header_title in enumerate(headers_pontos, 1):
-        ws_pontos.cell(row=1, column=col_num).font = Font(bold=True)
-       
-        ws_pontos.cell(row=1, column=col_num).alignment = Alignment(horizontal="center")
-
-    ws_anexos = wb.create_sheet(title="Anexos")
-    headers_anexos = ["ID Análise", "Nº Cert. Análise", "Nome Original Anexo", "Caminho Armazenado", "Data Anexo"]
-    ws_anexos.append(headers_anexos)
-    for col_num, header_title in enumerate(headers_anexos, 1):
-        ws_anexos.cell(row=1, column=col_num).font = Font(bold=True)
-        ws_anexos.cell(row=1, column=col_num).alignment = Alignment(horizontal="center")
-    
-    equip_id_atual = equip.get('id')
-    equip_nome_atual = equip.get('nome')
-    
-    hist_analises_individuais = db.fetch_analises_by_equipamento_id(equip_id_atual, app_utils_instance=utils) 
-    for analise_dict_from_db in hist_analises_individuais:
-        analise = dict(analise_dict_from_db)
-        ws_analises.append([
-            equip_id_atual, equip_nome_atual, analise.get('id'),
-            analise.get('data_registro_sistema_fmt'), 
-            analise.get('data_analise_manual_fmt'),
-            analise.get('responsavel_analise'),
-            analise.get('numero_certificado_analisado'),
-            analise.get('data_calibracao_analisada_fmt'),
-            analise.get('data_prox_calibracao_analisada_fmt'),
-            analise.get('resultado_geral_certificado'),
-            analise.get('observacoes_analise')
-        ])
-
-        pontos_da_analise = db.fetch_pontos_by_analise_id(analise['id'])
-        for ponto_row in pontos_da_analise:
-            ponto = dict(ponto_row)
-            ws_pontos.append([
-                analise.get('id'), analise.get('numero_certificado_analisado'),
-                ponto.get('nome_ponto'), ponto.get('simbolo_ponto'), ponto.get('valor_nominal_ponto'),
-                ponto.get('amplitude_A_ponto'), ponto.get('desvio_B_ponto'),
-                ponto.get('regra_aplicada_ponto'), ponto.get('resultado_ponto'),
-                ponto.get('observacoes_ponto')
-            ])
-
-        anexos_da_an = db.fetch_anexos_by_analise_id(analise['id'])
-        for anexo_row in anexos_da_an:
-            anexo = dict(anexo_row)
-            ws_anexos.append([
-                analise.get('id'), analise.get('numero_certificado_analisado'),
-                anexo.get('nome_arquivo_original'),
-                anexo.get('caminho_relativo_armazenado'),
-                utils.format_date_for_display(anexo.get('data_anexo')) 
-            ])
-
-    for sheet_name in wb.sheetnames:
-        ws = wb[sheet_name]
-        for col_idx, column_cells_tuple in enumerate(ws.columns):
-            max_length = 0
-            column_letter = get_column_letter(col_idx + 1)
-            for cell in column_cells_tuple:
-                try:
-                    if cell.value is not None and len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2 if max_length > 0 else 12) 
-            ws.column_dimensions[column_letter].width = adjusted_width
-            
-    wb.save(output) 
-    output.seek(0)
-    return Response(
-        output,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment;filename=relatorio_equip_{equip_id}_{equip.get('nome', '')}.xlsx"}
- )
+    wb = _escrever_workbook_equipamentos([equip])
+    return _resposta_workbook_streaming(wb, f"relatorio_equip_{equip_id}_{equip.get('nome', '')}.xlsx")
+
+# --- Exportação em formatos colunares (CSV/Parquet) para integração com BI ---
+FORMATOS_EXPORTACAO_DADOS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+def _gerar_csv_streaming(cabecalhos, linhas):
+    buffer = StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(cabecalhos)
+    for contador, linha in enumerate(linhas, 1):
+        escritor.writerow(linha)
+        if contador % EXPORT_PROGRESSO_INTERVALO == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+def _gravar_parquet(caminho, cabecalhos, linhas):
+    """Grava o Parquet em row groups de EXPORT_PROGRESSO_INTERVALO linhas (memória limitada ao lote).
+
+    Colunas "ID ..." saem como inteiro e as demais como texto, já no formato das outras exportações,
+    para que o schema seja o mesmo em todos os lotes.
+    """
+    colunas_id = {titulo for titulo in cabecalhos if titulo.startswith("ID")}
+    schema = pa.schema([(titulo, pa.int64() if titulo in colunas_id else pa.string()) for titulo in cabecalhos])
+    linhas = iter(linhas)
+    with pq.ParquetWriter(caminho, schema) as escritor:
+        while True:
+            lote = list(itertools.islice(linhas, EXPORT_PROGRESSO_INTERVALO))
+            if not lote:
+                break
+            df = pd.DataFrame(lote, columns=cabecalhos, dtype=object)
+            for titulo in cabecalhos:
+                if titulo in colunas_id:
+                    df[titulo] = pd.to_numeric(df[titulo], errors='coerce').astype('Int64')
+                else:
+                    df[titulo] = df[titulo].map(lambda valor: None if valor is None else str(valor))
+            escritor.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+@app.route('/exportar_dados/<dataset>/<formato>')
+@login_required
+def exportar_dados(dataset, formato):
+    """Exporta um dos conjuntos do relatório geral (mesmos filtros e colunas) em CSV ou Parquet."""
+    if formato not in FORMATOS_EXPORTACAO_DADOS:
+        return jsonify({"error": f"Formato inválido. Use: {', '.join(FORMATOS_EXPORTACAO_DADOS)}."}), 400
+    if formato == "parquet" and pq is None:
+        return jsonify({"error": "Exportação Parquet indisponível: instale o pacote pyarrow."}), 501
+
+    equipamentos = _equipamentos_para_exportacao(request.args.get('search', ''))
+    datasets = {chave: (cabecalhos, linhas) for chave, _, cabecalhos, linhas in _datasets_exportacao(equipamentos)}
+    if dataset not in datasets:
+        return jsonify({"error": f"Conjunto de dados inválido. Use: {', '.join(datasets)}."}), 400
+
+    cabecalhos, linhas = datasets[dataset]
+    nome_arquivo = f"{dataset}.{formato}"
+    if formato == "csv":
+        return Response(
+            stream_with_context(_gerar_csv_streaming(cabecalhos, linhas)),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment;filename={nome_arquivo}"}
+        )
+    return _resposta_arquivo_temporario(lambda caminho: _gravar_parquet(caminho, cabecalhos, linhas),
+                                        ".parquet", nome_arquivo, FORMATOS_EXPORTACAO_DADOS["parquet"])
+
 @app.route('/equipamento/<int:equip_id>/analise/nova_form')
 def nova_analise_form(equip_id):
     equip = db.fetch_equipamento_completo_by_id(equip_id)
     if not equip:
         return jsonify({"error": "Equipamento não encontrado"}), 404
 
-    # Adicionei a chamada get_db() aqui também, caso seja usada nesta rota.
-    if 'db' not in g:
-        g.db = DatabaseManager(DB_FULL_PATH)
-    db = g.db
-
     return render_template('nova_analise.html', equipamento=equip)
 
+_workers_lock = threading.Lock()
+_workers_verificados = threading.Event()
+
+def _iniciar_workers():
+    status_worker.start()
+    notificacao_worker.start()
+    agendador_notificacoes.start()
+
+def iniciar_workers_background():
+    """Inicia as threads de status, fila de notificações e agendamento (idempotente).
+
+    Importar o módulo não inicia nada: chamam esta função `python app.py`, o comando
+    `flask --app app workers` e a primeira requisição de cada processo (exceto com CALIBRACAO_WORKERS=0).
+    """
+    with _workers_lock:
+        _iniciar_workers()
+
+@app.before_request
+def iniciar_workers_se_configurado():
+    # Uma verificação por processo; depois disso custa só o is_set()
+    if _workers_verificados.is_set():
+        return
+    with _workers_lock:
+        if _workers_verificados.is_set():
+            return
+        if app.config['WORKERS_BACKGROUND']:
+            _iniciar_workers()
+        else:
+            print("AVISO: CALIBRACAO_WORKERS=0 — este processo não atualiza status, não envia notificações da fila "
+                  "nem executa o agendamento. Rode `flask --app app workers` em um processo separado.")
+        _workers_verificados.set()
+
+@app.cli.command('workers')
+def comando_workers():
+    """Executa só as threads em segundo plano, em primeiro plano (um processo por implantação)."""
+    iniciar_workers_background()
+    print("INFO: Workers em execução (status, fila de notificações, agendamento). Ctrl+C para encerrar.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        status_worker.stop()
+        notificacao_worker.stop()
+        agendador_notificacoes.stop()
+
 if __name__ == "__main__":
+    # Com o reloader do modo debug, só o processo filho (WERKZEUG_RUN_MAIN) atende requisições
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' and app.config['WORKERS_BACKGROUND']:
+        iniciar_workers_background()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,76 @@
+"""Benchmark do histórico de análises por equipamento, sem e com os índices da migração 2.
+
+Uso: python benchmarks/benchmark_historico_analises.py [n_equipamentos] [analises_por_equip]
+
+Cria um banco temporário com dados sintéticos, mede fetch_analises_by_equipamento_id
+(com as contagens de anexos/pontos) e fetch_pontos/anexos_by_analise_id para uma
+amostra de equipamentos, primeiro sem os índices secundários e depois com eles.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from database import DatabaseManager  # noqa: E402
+
+INDICES = ("idx_analises_equipamento", "idx_anexos_analise", "idx_pontos_analise")
+
+
+def popular(db, n_equip, n_analises, n_pontos=5):
+    conn = db._acquire_writer()
+    try:
+        cur = conn.cursor()
+        cur.executemany("INSERT INTO equipamentos (nome, numero_serie, ativo) VALUES (?, ?, 1)",
+                        [(f"EQ-{i:05d}", f"NS-{i:05d}") for i in range(n_equip)])
+        analises = [(e, "2024-01-01", f"CERT-{e}-{a}") for e in range(1, n_equip + 1) for a in range(n_analises)]
+        random.shuffle(analises)  # histórico intercalado entre equipamentos, como em produção
+        cur.executemany("INSERT INTO analises_certificado (equipamento_id, data_registro_sistema, numero_certificado_analisado) "
+                        "VALUES (?, ?, ?)", analises)
+        total_analises = len(analises)
+        cur.executemany("INSERT INTO pontos_analisados_certificado (analise_certificado_id, nome_ponto) VALUES (?, ?)",
+                        [(a, f"P{p}") for a in range(1, total_analises + 1) for p in range(n_pontos)])
+        cur.executemany("INSERT INTO anexos_analise (analise_id, nome_arquivo_original, nome_arquivo_armazenado, "
+                        "caminho_relativo_armazenado, data_anexo) VALUES (?, 'c.pdf', 'c.pdf', ?, '2024-01-01')",
+                        [(a, f"{a}/c.pdf") for a in range(1, total_analises + 1)])
+        conn.commit()
+    finally:
+        db._writer_lock.release()
+
+
+def medir(db, amostra):
+    inicio = time.perf_counter()
+    for equip_id in amostra:
+        for analise in db.fetch_analises_by_equipamento_id(equip_id):
+            db.fetch_pontos_by_analise_id(analise["id"])
+            db.fetch_anexos_by_analise_id(analise["id"])
+    return (time.perf_counter() - inicio) / len(amostra) * 1000
+
+
+def main():
+    n_equip = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_analises = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "bench.db"))
+        popular(db, n_equip, n_analises)
+        amostra = random.sample(range(1, n_equip + 1), min(200, n_equip))
+
+        for indice in INDICES:
+            db.execute_query(f"DROP INDEX IF EXISTS {indice}", is_ddl=True)
+        antes = medir(db, amostra)
+
+        db.execute_query("DELETE FROM schema_version WHERE version >= 2", commit=True)
+        db.run_migrations()
+        depois = medir(db, amostra)
+
+        print(f"{n_equip} equipamentos x {n_analises} análises (amostra de {len(amostra)} equipamentos)")
+        print(f"  sem índices: {antes:8.3f} ms por histórico de equipamento")
+        print(f"  com índices: {depois:8.3f} ms por histórico de equipamento")
+        print(f"  ganho:       {antes / depois:8.1f}x")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,89 @@ import sqlite3
 import os
 import json
 import datetime
+import threading
+import time
+import pathlib
+from collections import OrderedDict
+from contextlib import contextmanager
 
 class DatabaseManager:
-    def __init__(self, db_file_path):
+    # PRAGMAs padrão; podem ser sobrescritos pelo parâmetro `pragmas` do construtor.
+    DEFAULT_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,       # valores negativos = KiB (aprox. 16 MB)
+        "mmap_size": 134217728,     # 128 MB
+        "busy_timeout": 5000,       # ms
+    }
+    SYNCHRONOUS_VALIDOS = ("OFF", "NORMAL", "FULL", "EXTRA")
+    # Migrações versionadas (versão, descrição, método). Cada uma roda uma única vez,
+    # em transação própria, e fica registrada na tabela schema_version.
+    MIGRATIONS = (
+        (1, "Colunas adicionadas após a criação inicial do esquema", "_migracao_001_colunas_legadas"),
+        (2, "Índices secundários para consultas por chave estrangeira e vencimento", "_migracao_002_indices"),
+        (3, "Índice de texto completo (FTS5) para a pesquisa de equipamentos", "_migracao_003_fts_equipamentos"),
+        (4, "Agregados materializados do dashboard", "_migracao_004_agregados_dashboard"),
+        (5, "Fila persistente de notificações e registro de entregas", "_migracao_005_fila_notificacoes"),
+        (6, "Execuções do agendamento de notificações", "_migracao_006_agendamento_notificacoes"),
+        (7, "Cache das mensagens de WhatsApp geradas pelo Gemini", "_migracao_007_cache_mensagens_gemini"),
+        (8, "Jobs de exportação compartilhados entre processos", "_migracao_008_exportacoes_jobs"),
+        (9, "Geração de sessão dos usuários", "_migracao_009_geracao_sessao_usuarios"),
+    )
+    # Colunas indexadas no FTS, na ordem da tabela virtual, com o peso usado no bm25().
+    FTS_COLUNAS_EQUIPAMENTOS = (
+        ("nome", 10.0), ("tag", 8.0), ("numero_serie", 6.0), ("modelo", 3.0), ("fabricante", 3.0),
+        ("tipo_equipamento_nome", 3.0), ("localizacao", 2.0), ("ultimo_numero_certificado", 2.0),
+        ("ultimo_resultado_geral_certificado", 1.0), ("faixa_de_uso", 1.0), ("status", 1.0),
+        ("destino_inativo", 1.0),
+    )
+
+    GRUPOS_REFERENCIA = ("tipos", "unidades", "empresas")
+    # Data 'AAAA-MM-DD' válida, como o strptime do app: date() sozinho normaliza '2025-02-30' em vez de rejeitar
+    SQL_DATA_VALIDA = "date(julianday({coluna})) = {coluna}"
+    # 'falhou' é a fila de mensagens mortas: esgotou as tentativas e só volta com reenfileirar_notificacao().
+    STATUS_FILA_NOTIFICACAO = ("pendente", "enviando", "enviado", "falhou")
+    # Contador em metadados_sistema incrementado na mesma transação de cada escrita que altera dados;
+    # por estar no banco, todos os processos (workers do gunicorn, reinícios) enxergam a mesma versão.
+    CHAVE_VERSAO_DADOS = "versao_dados"
+
+    def __init__(self, db_file_path, pool_size=5, pool_timeout=10.0, pragmas=None, regras_cores=None,
+                 user_cache_size=256, user_cache_ttl=300):
         self.db_path = db_file_path
+        # Faixas de cor por dias para o vencimento (mesmo formato de COLOR_RULES_FIXED no app)
+        self.regras_cores = regras_cores or []
+        self.pragmas = self._validar_pragmas(pragmas)
+        # Escritas passam por uma única conexão serializada; leituras usam o pool somente-leitura.
+        self._writer_conn = None
+        self._writer_lock = threading.RLock()
+        self._writer_stats = {"writes": 0, "waits": 0, "wait_time": 0.0}
+        # Pool de conexões: cada thread (ou requisição Flask) reutiliza a mesma conexão
+        # até liberá-la com release_connection(); conexões ociosas voltam para o pool.
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self._pool_ociosas = []
+        self._pool_em_uso = 0
+        self._pool_cond = threading.Condition()
+        self._local = threading.local()
+        self._pool_stats = {"hits": 0, "opens": 0, "waits": 0, "wait_time": 0.0, "releases": 0, "overflow": 0}
+        # Cache dos cadastros de referência (tipos, unidades, empresas) compartilhado entre requisições.
+        # Cada entrada guarda a versão dos grupos de que depende; as versões ficam em metadados_sistema,
+        # então uma escrita em qualquer processo invalida o cache de todos.
+        self._cache_lock = threading.Lock()
+        self._cache_referencia = {}
+        self._cache_stats = {"hits": 0, "misses": 0, "invalidacoes": 0}
+        # Cache LRU com TTL dos usuários (user_loader do Flask-Login). A geração (usuarios.geracao_sessao)
+        # muda a cada alteração de senha/flags/ativação e invalida entradas e claims de sessão em todos os processos.
+        self.user_cache_size = user_cache_size
+        self.user_cache_ttl = user_cache_ttl
+        self._user_cache = OrderedDict()
+        self._user_cache_lock = threading.Lock()
+        self._user_cache_stats = {"hits": 0, "misses": 0, "expirados": 0, "invalidacoes": 0}
+        self._ensure_db_dir()
         self.create_tables_if_not_exist() # Ensure tables exist on initialization
+        self.run_migrations()
 
-    def _get_conn(self):
+    def _ensure_db_dir(self):
         db_dir_path = os.path.dirname(self.db_path)
         if db_dir_path and not os.path.exists(db_dir_path):
             try:
@@ -17,12 +93,239 @@ class DatabaseManager:
             except OSError as e:
                 print(f"AVISO: Não foi possível criar o diretório do banco de dados {db_dir_path}. Erro: {e}")
 
-        conn = sqlite3.connect(self.db_path)
+    def _validar_pragmas(self, pragmas):
+        config = dict(self.DEFAULT_PRAGMAS)
+        config.update(pragmas or {})
+        config["journal_mode"] = str(config["journal_mode"]).upper()
+        config["synchronous"] = str(config["synchronous"]).upper()
+        if config["synchronous"] not in self.SYNCHRONOUS_VALIDOS:
+            raise ValueError(f"PRAGMA synchronous inválido: {config['synchronous']}")
+        for chave in ("cache_size", "mmap_size", "busy_timeout"):
+            config[chave] = int(config[chave])
+        return config
+
+    def _open_conn(self, read_only=True):
+        if read_only:
+            uri = pathlib.Path(os.path.abspath(self.db_path)).as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        self._configure_conn(conn, read_only)
+        return conn
+
+    def _configure_conn(self, conn, read_only=True):
+        """Aplica os PRAGMAs uma única vez, na abertura da conexão."""
+        conn.execute(f"PRAGMA busy_timeout = {self.pragmas['busy_timeout']}")
+        conn.execute(f"PRAGMA cache_size = {self.pragmas['cache_size']}")
+        conn.execute(f"PRAGMA mmap_size = {self.pragmas['mmap_size']}")
+        if not read_only:
+            modo = conn.execute(f"PRAGMA journal_mode = {self.pragmas['journal_mode']}").fetchone()[0]
+            if modo.upper() != self.pragmas["journal_mode"]:
+                print(f"AVISO: journal_mode {self.pragmas['journal_mode']} não aplicado (atual: {modo}).")
+            conn.execute(f"PRAGMA synchronous = {self.pragmas['synchronous']}")
+
+    def _get_write_conn(self):
+        """Conexão única de escrita. Deve ser usada com self._writer_lock adquirido."""
+        if self._writer_conn is None:
+            self._writer_conn = self._open_conn(read_only=False)
+        return self._writer_conn
+
+    def _acquire_writer(self):
+        inicio = time.perf_counter()
+        if not self._writer_lock.acquire(blocking=False):
+            self._writer_lock.acquire()
+            with self._pool_cond:
+                self._writer_stats["waits"] += 1
+                self._writer_stats["wait_time"] += time.perf_counter() - inicio
+        return self._get_write_conn()
+
+    def _get_conn(self):
+        """Retorna a conexão somente-leitura da thread atual, obtendo-a do pool se necessário."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with self._pool_cond:
+                self._pool_stats["hits"] += 1
+            return conn
+
+        with self._pool_cond:
+            if not self._pool_ociosas and self._pool_em_uso >= self.pool_size:
+                inicio = time.perf_counter()
+                self._pool_stats["waits"] += 1
+                self._pool_cond.wait_for(lambda: self._pool_ociosas or self._pool_em_uso < self.pool_size,
+                                         timeout=self.pool_timeout)
+                self._pool_stats["wait_time"] += time.perf_counter() - inicio
+            if self._pool_ociosas:
+                conn = self._pool_ociosas.pop()
+                self._pool_stats["hits"] += 1
+            elif self._pool_em_uso >= self.pool_size:
+                # Timeout esgotado: abre uma conexão extra em vez de travar a requisição.
+                self._pool_stats["overflow"] += 1
+            self._pool_em_uso += 1
+
+        if conn is None:
+            try:
+                conn = self._open_conn()
+            except sqlite3.Error:
+                with self._pool_cond:
+                    self._pool_em_uso -= 1
+                    self._pool_cond.notify()
+                raise
+            with self._pool_cond:
+                self._pool_stats["opens"] += 1
+        self._local.conn = conn
         return conn
 
+    def release_connection(self):
+        """Devolve ao pool a conexão da thread atual (chamar ao fim de cada requisição)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            conn = None
+        with self._pool_cond:
+            self._pool_em_uso -= 1
+            self._pool_stats["releases"] += 1
+            if conn is not None:
+                if len(self._pool_ociosas) < self.pool_size:
+                    self._pool_ociosas.append(conn)
+                else:
+                    conn.close()
+            self._pool_cond.notify()
+
+    def get_pool_stats(self):
+        with self._pool_cond:
+            stats = dict(self._pool_stats)
+            stats["wait_time_ms"] = round(stats.pop("wait_time") * 1000, 3)
+            stats["idle"] = len(self._pool_ociosas)
+            stats["in_use"] = self._pool_em_uso
+            stats["pool_size"] = self.pool_size
+            writer = dict(self._writer_stats)
+            writer["wait_time_ms"] = round(writer.pop("wait_time") * 1000, 3)
+            stats["writer"] = writer
+        stats["pragmas"] = dict(self.pragmas)
+        return stats
+
     def execute_query(self, query, params=None, fetch_one=False, fetch_all=False, commit=False, is_ddl=False):
-        conn = self._get_conn()
+        if commit or is_ddl:
+            conn = self._acquire_writer()
+            try:
+                self._writer_stats["writes"] += 1
+                alteracoes_antes = conn.total_changes
+
+                def versionar(conn):
+                    if conn.total_changes != alteracoes_antes:
+                        self._incrementar_versoes(conn, self.CHAVE_VERSAO_DADOS)
+
+                return self._run_query(conn, query, params, fetch_one, fetch_all, commit, is_ddl, antes_do_commit=versionar)
+            finally:
+                self._writer_lock.release()
+        return self._run_query(self._get_conn(), query, params, fetch_one, fetch_all, commit, is_ddl)
+
+    def iter_query(self, query, params=None, tamanho_lote=500):
+        """Executa um SELECT na conexão de leitura e entrega as linhas em lotes (fetchmany), sem montar a lista inteira."""
+        cursor = self._get_conn().cursor()
+        try:
+            cursor.execute(query, params or ())
+            while True:
+                linhas = cursor.fetchmany(tamanho_lote)
+                if not linhas:
+                    break
+                yield from linhas
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite: {e} | Query: {query} | Params: {params}")
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def transaction(self, versionar=True):
+        """Executa várias escritas numa única transação na conexão de escrita.
+
+        Uso: `with db.transaction() as cursor: ...` — commit ao sair, rollback em exceção.
+        Com versionar=False (tabelas operacionais, como a fila de notificações) a versão dos dados não muda.
+        """
+        conn = self._acquire_writer()
+        cursor = conn.cursor()
+        alteracoes_antes = conn.total_changes
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            yield cursor
+            if versionar and conn.total_changes != alteracoes_antes:
+                self._incrementar_versoes(cursor, self.CHAVE_VERSAO_DADOS)
+            conn.commit()
+            self._writer_stats["writes"] += 1
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            self._writer_lock.release()
+
+    @staticmethod
+    def _incrementar_versoes(cursor, *chaves):
+        """Incrementa os contadores de versão em metadados_sistema, dentro da transação corrente."""
+        cursor.executemany("""INSERT INTO metadados_sistema (chave, valor) VALUES (?, '1')
+                              ON CONFLICT (chave) DO UPDATE SET valor = CAST(valor AS INTEGER) + 1""",
+                           [(chave,) for chave in chaves])
+
+    def _ler_versoes(self, *chaves):
+        """Versões atuais (0 se ainda não gravada) das chaves, na ordem pedida."""
+        marcadores = ", ".join("?" for _ in chaves)
+        linhas = self.execute_query(f"SELECT chave, CAST(valor AS INTEGER) AS versao FROM metadados_sistema WHERE chave IN ({marcadores})",
+                                    chaves, fetch_all=True) or []
+        versoes = {linha['chave']: linha['versao'] for linha in linhas}
+        return tuple(versoes.get(chave, 0) for chave in chaves)
+
+    def get_data_version(self):
+        return self._ler_versoes(self.CHAVE_VERSAO_DADOS)[0]
+
+    def _cache_consulta(self, grupos, chave, carregar):
+        """Retorna a consulta de referência do cache, recarregando-a se algum dos grupos mudou.
+
+        A versão é lida (uma consulta por chave primária) antes de carregar: uma escrita concorrente
+        deixa a entrada já desatualizada.
+        """
+        versao = self._ler_versoes(*(f"versao_referencia_{grupo}" for grupo in grupos))
+        with self._cache_lock:
+            entrada = self._cache_referencia.get(chave)
+            if entrada is not None and entrada[0] == versao:
+                self._cache_stats["hits"] += 1
+                return list(entrada[1])
+            self._cache_stats["misses"] += 1
+        valor = carregar()
+        with self._cache_lock:
+            self._cache_referencia[chave] = (versao, valor)
+        return list(valor)
+
+    def _invalidar_referencia(self, *grupos):
+        """Chamar após o commit de qualquer escrita em tipos, unidades ou empresas."""
+        try:
+            with self.transaction(versionar=False) as cursor:
+                self._incrementar_versoes(cursor, *(f"versao_referencia_{grupo}" for grupo in grupos))
+        except sqlite3.Error as e:
+            print(f"Erro ao invalidar o cache de referência ({', '.join(grupos)}): {e}")
+            with self._cache_lock:
+                self._cache_referencia.clear()
+        with self._cache_lock:
+            self._cache_stats["invalidacoes"] += 1
+
+    def get_cache_stats(self):
+        with self._cache_lock:
+            stats = dict(self._cache_stats)
+            consultas = stats["hits"] + stats["misses"]
+            stats["taxa_acerto"] = round(stats["hits"] / consultas, 3) if consultas else None
+            stats["entradas"] = len(self._cache_referencia)
+        stats["versoes"] = dict(zip(self.GRUPOS_REFERENCIA,
+                                    self._ler_versoes(*(f"versao_referencia_{grupo}" for grupo in self.GRUPOS_REFERENCIA))))
+        return stats
+
+    def _run_query(self, conn, query, params, fetch_one, fetch_all, commit, is_ddl, antes_do_commit=None):
         cursor = conn.cursor()
         last_row_id = None
         success = False
@@ -30,6 +333,8 @@ class DatabaseManager:
         try:
             cursor.execute(query, params or ())
             if commit or is_ddl: 
+                if antes_do_commit:
+                    antes_do_commit(conn)
                 conn.commit()
                 if "INSERT" in query.upper(): 
                     last_row_id = cursor.lastrowid
@@ -47,9 +352,11 @@ class DatabaseManager:
 
         except sqlite3.Error as e:
             print(f"Erro BD SQLite: {e} | Query: {query} | Params: {params}")
+            if conn.in_transaction:
+                conn.rollback()
             success = False
         finally:
-            conn.close() 
+            cursor.close()
         
         if commit and success: return last_row_id if last_row_id is not None else True
         if (fetch_one or fetch_all) and success: return result_data
@@ -68,6 +375,10 @@ class DatabaseManager:
         );
         """
         queries = [
+            # Criada antes das demais: guarda a versão dos dados incrementada por toda escrita
+            """CREATE TABLE IF NOT EXISTS metadados_sistema (
+                chave TEXT PRIMARY KEY, valor TEXT
+            )""",
             """CREATE TABLE IF NOT EXISTS equipamentos (
                 id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT NOT NULL, fabricante TEXT, modelo TEXT, 
                 numero_serie TEXT UNIQUE, tag TEXT, status TEXT, localizacao TEXT, observacoes_equipamento TEXT,
@@ -125,8 +436,8 @@ class DatabaseManager:
                 certificado_iso_path TEXT 
             )"""
         ]
-        conn = self._get_conn()
         self.execute_query(create_usuarios_table_query, is_ddl=True) # Create users table
+        conn = self._acquire_writer()
         cursor = conn.cursor()
         try:
             for query in queries:
@@ -137,69 +448,171 @@ class DatabaseManager:
             print(f"Erro BD SQLite ao criar tabelas: {e}")
             conn.rollback()
         finally:
-            conn.close()
+            cursor.close()
+            self._writer_lock.release()
 
     def update_schema(self):
-        conn = self._get_conn()
+        """Mantido por compatibilidade: aplica as migrações pendentes."""
+        return self.run_migrations()
+
+    def get_schema_version(self):
+        row = self.execute_query("SELECT MAX(version) AS version FROM schema_version", fetch_one=True)
+        return (row['version'] or 0) if row else 0
+
+    def get_schema_status(self):
+        """Versão do esquema, migrações não registradas e o modo de pesquisa em uso (FTS5 ou LIKE)."""
+        aplicadas = {row['version'] for row in self.execute_query("SELECT version FROM schema_version", fetch_all=True) or []}
+        return {
+            "versao": max(aplicadas, default=0),
+            "migracoes_pendentes": [versao for versao, _, _ in self.MIGRATIONS if versao not in aplicadas],
+            "pesquisa": "fts5" if self._fts_disponivel() else "like",
+        }
+
+    def run_migrations(self):
+        """Aplica as migrações ainda não registradas em schema_version.
+
+        Com o esquema atualizado custa uma única consulta. Uma migração que retorna False foi adiada
+        (ex.: FTS5 indisponível): não é registrada e volta a ser tentada na próxima inicialização.
+        """
+        conn = self._acquire_writer()
         cursor = conn.cursor()
         try:
-            cursor.execute("PRAGMA table_info(equipamentos)")
-            cols_equip_rows = cursor.fetchall()
-            cols_equip = {row['name']: dict(row) for row in cols_equip_rows} if cols_equip_rows else {}
-
-            if 'observacoes' in cols_equip and 'observacoes_equipamento' not in cols_equip:
-                 cursor.execute("ALTER TABLE equipamentos RENAME COLUMN observacoes TO observacoes_equipamento")
-
-            campos_equip = {
-                "tag": "TEXT", 
-                "tipo_equipamento_id": "INTEGER", "faixa_de_uso": "TEXT",
-                "ultimo_numero_certificado": "TEXT", "ultima_data_calibracao": "TEXT",
-                "proxima_data_calibracao": "TEXT",
-                "ultimo_resultado_geral_certificado": "TEXT",
-                "observacoes_equipamento": "TEXT",
-                "empresa_id": "INTEGER",
-                "ativo": "INTEGER DEFAULT 1",
-                "requer_calibracao": "INTEGER DEFAULT 1",
-                "em_calibracao": "INTEGER DEFAULT 0",
-                "destino_inativo": "TEXT"
-            }
-            for col_name, col_type in campos_equip.items():
-                if col_name not in cols_equip:
-                    cursor.execute(f"ALTER TABLE equipamentos ADD COLUMN {col_name} {col_type}")
-
-            cursor.execute("PRAGMA table_info(analises_certificado)")
-            cols_analise_rows = cursor.fetchall()
-            cols_analise = {row['name']: dict(row) for row in cols_analise_rows} if cols_analise_rows else {}
-            
-            novas_cols_analise = {"data_analise_manual": "TEXT", "responsavel_analise": "TEXT", "resultado_geral_certificado": "TEXT"}
-            if "data_registro_analise" in cols_analise and "data_registro_sistema" not in cols_analise:
-                cursor.execute("ALTER TABLE analises_certificado RENAME COLUMN data_registro_analise TO data_registro_sistema")
-            for col_name, col_type in novas_cols_analise.items():
-                if col_name not in cols_analise:
-                    cursor.execute(f"ALTER TABLE analises_certificado ADD COLUMN {col_name} {col_type}")
-            
-            cursor.execute("PRAGMA table_info(empresas)")
-            cols_empresas_rows = cursor.fetchall()
-            cols_empresas = {row['name']: dict(row) for row in cols_empresas_rows} if cols_empresas_rows else {}
-            campos_empresas = {
-                "razao_social": "TEXT", "nome_fantasia": "TEXT", "cnpj": "TEXT UNIQUE NOT NULL",
-                "logradouro": "TEXT", "numero": "TEXT", "complemento": "TEXT", "bairro": "TEXT",
-                "cep": "TEXT", "municipio": "TEXT", "uf": "TEXT", "telefone": "TEXT", "email": "TEXT",
-                "categoria": "TEXT NOT NULL CHECK(categoria IN ('Calibração', 'Unidade'))",
-                "certificado_iso_path": "TEXT" 
-            }
-            for col_name, col_type in campos_empresas.items():
-                if col_name not in cols_empresas:
-                    if "CHECK" in col_type:
-                        col_type_only = col_type.split(" CHECK")[0]
-                        cursor.execute(f"ALTER TABLE empresas ADD COLUMN {col_name} {col_type_only}")
-                    else:
-                         cursor.execute(f"ALTER TABLE empresas ADD COLUMN {col_name} {col_type}")
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"Erro ao atualizar esquema SQLite: {e}")
+            cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY, descricao TEXT, aplicada_em TEXT NOT NULL
+            )""")
+            aplicadas = {row[0] for row in cursor.execute("SELECT version FROM schema_version")}
+            pendentes = [m for m in self.MIGRATIONS if m[0] not in aplicadas]
+            if not pendentes:
+                return max(aplicadas)
+            for versao, descricao, nome_metodo in pendentes:
+                try:
+                    cursor.execute("BEGIN")
+                    if getattr(self, nome_metodo)(cursor) is False:
+                        conn.rollback()
+                        print(f"AVISO: Migração {versao} adiada ({descricao}); será tentada novamente na próxima inicialização.")
+                        continue
+                    cursor.execute("INSERT INTO schema_version (version, descricao, aplicada_em) VALUES (?, ?, ?)",
+                                   (versao, descricao, datetime.datetime.now().isoformat(timespec='seconds')))
+                    conn.commit()
+                    aplicadas.add(versao)
+                    print(f"INFO: Migração {versao} aplicada: {descricao}")
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    print(f"Erro ao aplicar migração {versao} ({descricao}): {e}")
+                    break
+            return max(aplicadas, default=0)
         finally:
-            conn.close()
+            cursor.close()
+            self._writer_lock.release()
+
+    def _migracao_001_colunas_legadas(self, cursor):
+        cursor.execute("PRAGMA table_info(equipamentos)")
+        cols_equip_rows = cursor.fetchall()
+        cols_equip = {row['name']: dict(row) for row in cols_equip_rows} if cols_equip_rows else {}
+
+        if 'observacoes' in cols_equip and 'observacoes_equipamento' not in cols_equip:
+             cursor.execute("ALTER TABLE equipamentos RENAME COLUMN observacoes TO observacoes_equipamento")
+
+        campos_equip = {
+            "tag": "TEXT", 
+            "tipo_equipamento_id": "INTEGER", "faixa_de_uso": "TEXT",
+            "ultimo_numero_certificado": "TEXT", "ultima_data_calibracao": "TEXT",
+            "proxima_data_calibracao": "TEXT",
+            "ultimo_resultado_geral_certificado": "TEXT",
+            "observacoes_equipamento": "TEXT",
+            "empresa_id": "INTEGER",
+            "ativo": "INTEGER DEFAULT 1",
+            "requer_calibracao": "INTEGER DEFAULT 1",
+            "em_calibracao": "INTEGER DEFAULT 0",
+            "destino_inativo": "TEXT"
+        }
+        for col_name, col_type in campos_equip.items():
+            if col_name not in cols_equip:
+                cursor.execute(f"ALTER TABLE equipamentos ADD COLUMN {col_name} {col_type}")
+
+        cursor.execute("PRAGMA table_info(analises_certificado)")
+        cols_analise_rows = cursor.fetchall()
+        cols_analise = {row['name']: dict(row) for row in cols_analise_rows} if cols_analise_rows else {}
+        
+        novas_cols_analise = {"data_analise_manual": "TEXT", "responsavel_analise": "TEXT", "resultado_geral_certificado": "TEXT"}
+        if "data_registro_analise" in cols_analise and "data_registro_sistema" not in cols_analise:
+            cursor.execute("ALTER TABLE analises_certificado RENAME COLUMN data_registro_analise TO data_registro_sistema")
+        for col_name, col_type in novas_cols_analise.items():
+            if col_name not in cols_analise:
+                cursor.execute(f"ALTER TABLE analises_certificado ADD COLUMN {col_name} {col_type}")
+        
+        cursor.execute("PRAGMA table_info(empresas)")
+        cols_empresas_rows = cursor.fetchall()
+        cols_empresas = {row['name']: dict(row) for row in cols_empresas_rows} if cols_empresas_rows else {}
+        campos_empresas = {
+            "razao_social": "TEXT", "nome_fantasia": "TEXT", "cnpj": "TEXT UNIQUE NOT NULL",
+            "logradouro": "TEXT", "numero": "TEXT", "complemento": "TEXT", "bairro": "TEXT",
+            "cep": "TEXT", "municipio": "TEXT", "uf": "TEXT", "telefone": "TEXT", "email": "TEXT",
+            "categoria": "TEXT NOT NULL CHECK(categoria IN ('Calibração', 'Unidade'))",
+            "certificado_iso_path": "TEXT" 
+        }
+        for col_name, col_type in campos_empresas.items():
+            if col_name not in cols_empresas:
+                if "CHECK" in col_type:
+                    col_type_only = col_type.split(" CHECK")[0]
+                    cursor.execute(f"ALTER TABLE empresas ADD COLUMN {col_name} {col_type_only}")
+                else:
+                     cursor.execute(f"ALTER TABLE empresas ADD COLUMN {col_name} {col_type}")
+
+    def _migracao_002_indices(self, cursor):
+        # unidades_medida_config.tipo_equipamento_id já é atendida pelo índice do
+        # UNIQUE (tipo_equipamento_id, nome_unidade), inclusive no ORDER BY nome_unidade.
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_analises_equipamento ON analises_certificado (equipamento_id, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_anexos_analise ON anexos_analise (analise_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pontos_analise ON pontos_analisados_certificado (analise_certificado_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_equipamentos_proxima_cal ON equipamentos (proxima_data_calibracao)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_equipamentos_tipo ON equipamentos (tipo_equipamento_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_empresas_categoria ON empresas (categoria)")
+
+    def _migracao_003_fts_equipamentos(self, cursor):
+        colunas = [nome for nome, _ in self.FTS_COLUNAS_EQUIPAMENTOS]
+        try:
+            # remove_diacritics 2: "calibracao" encontra "Calibração"
+            cursor.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS equipamentos_fts USING fts5(
+                {', '.join(colunas)}, tokenize = 'unicode61 remove_diacritics 2'
+            )""")
+        except sqlite3.OperationalError as e:
+            print(f"AVISO: FTS5 indisponível nesta versão do SQLite ({e}); a pesquisa usará LIKE.")
+            return False
+
+        colunas_sql = ", ".join(colunas)
+        valores_new = ", ".join(
+            "(SELECT nome_tipo FROM tipos_equipamento WHERE id = NEW.tipo_equipamento_id)"
+            if nome == "tipo_equipamento_nome" else f"NEW.{nome}" for nome in colunas
+        )
+        colunas_equip_update = ", ".join(nome for nome in colunas if nome != "tipo_equipamento_nome")
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_equipamentos_fts_insert AFTER INSERT ON equipamentos BEGIN
+            INSERT INTO equipamentos_fts (rowid, {colunas_sql}) VALUES (NEW.id, {valores_new});
+        END""")
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_equipamentos_fts_update
+            AFTER UPDATE OF {colunas_equip_update}, tipo_equipamento_id ON equipamentos BEGIN
+            DELETE FROM equipamentos_fts WHERE rowid = OLD.id;
+            INSERT INTO equipamentos_fts (rowid, {colunas_sql}) VALUES (NEW.id, {valores_new});
+        END""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_equipamentos_fts_delete AFTER DELETE ON equipamentos BEGIN
+            DELETE FROM equipamentos_fts WHERE rowid = OLD.id;
+        END""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_tipos_fts_update AFTER UPDATE OF nome_tipo ON tipos_equipamento BEGIN
+            UPDATE equipamentos_fts SET tipo_equipamento_nome = NEW.nome_tipo
+             WHERE rowid IN (SELECT id FROM equipamentos WHERE tipo_equipamento_id = NEW.id);
+        END""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_tipos_fts_delete AFTER DELETE ON tipos_equipamento BEGIN
+            UPDATE equipamentos_fts SET tipo_equipamento_nome = NULL
+             WHERE rowid IN (SELECT id FROM equipamentos WHERE tipo_equipamento_id = OLD.id);
+        END""")
+
+        colunas_select = ", ".join(
+            "te.nome_tipo" if nome == "tipo_equipamento_nome" else f"e.{nome}" for nome in colunas
+        )
+        cursor.execute("DELETE FROM equipamentos_fts")
+        cursor.execute(f"""INSERT INTO equipamentos_fts (rowid, {colunas_sql})
+                           SELECT e.id, {colunas_select}
+                           FROM equipamentos e LEFT JOIN tipos_equipamento te ON e.tipo_equipamento_id = te.id""")
 
     def fetch_all_equipamentos_completos(self):
         query = """SELECT e.*, te.nome_tipo as tipo_equipamento_nome, emp.nome_fantasia as empresa_nome 
@@ -209,6 +622,127 @@ class DatabaseManager:
                    ORDER BY e.nome"""
         return self.execute_query(query, fetch_all=True) or []
 
+    def fetch_equipamentos_para_notificacao(self, dias_limite=None, apenas_vencidos=False, hoje=None):
+        """Equipamentos ativos, fora de calibração, que vencem até hoje + dias_limite (ou já vencidos).
+
+        Faixa na própria coluna indexada (idx_equipamentos_proxima_cal), que também entrega a ordem por
+        urgência: o custo acompanha a quantidade de equipamentos a vencer, não o total cadastrado. Sem
+        dias_limite nem apenas_vencidos, traz todos os que têm data. Cada dict inclui 'dias_vencimento'
+        (negativo = vencido), com a mesma regra de AppUtils.calcular_dias_para_vencimento.
+        """
+        hoje = hoje or datetime.date.today()
+        if apenas_vencidos:
+            limite = hoje
+        elif dias_limite is not None:
+            limite = hoje + datetime.timedelta(days=int(dias_limite))
+        else:
+            limite = datetime.date.max
+        query = f"""SELECT e.*, te.nome_tipo as tipo_equipamento_nome, emp.nome_fantasia as empresa_nome,
+                          CAST(julianday(e.proxima_data_calibracao) - julianday(?) AS INTEGER) AS dias_vencimento
+                   FROM equipamentos e
+                   LEFT JOIN tipos_equipamento te ON e.tipo_equipamento_id = te.id
+                   LEFT JOIN empresas emp ON e.empresa_id = emp.id
+                   WHERE e.proxima_data_calibracao <= ?
+                     AND {self.SQL_DATA_VALIDA.format(coluna="e.proxima_data_calibracao")}
+                     AND e.ativo AND NOT COALESCE(e.em_calibracao, 0)
+                   ORDER BY e.proxima_data_calibracao, e.nome"""
+        linhas = self.execute_query(query, (hoje.isoformat(), limite.isoformat()), fetch_all=True) or []
+        return [dict(linha) for linha in linhas]
+
+    # Colunas da listagem paginada: nome exposto na API -> expressão SQL (lista branca para ORDER BY/filtros)
+    COLUNAS_LISTA_EQUIPAMENTOS = {
+        "id": "e.id",
+        "nome": "e.nome",
+        "tag": "e.tag",
+        "tipo_equipamento_nome": "te.nome_tipo",
+        "proxima_data_calibracao": "e.proxima_data_calibracao",
+        "dias_vencimento": "e.proxima_data_calibracao",
+        "status": "CASE WHEN NOT e.ativo THEN 'Inativo' WHEN e.em_calibracao THEN 'Em Calibração' ELSE e.status END",
+        "localizacao": "e.localizacao",
+        "numero_serie": "e.numero_serie",
+    }
+    # Dias para o vencimento como exibidos na lista (NULL onde a tela mostra "N/A"): só equipamentos
+    # ativos, fora de calibração e com data válida, contando a partir da data local de hoje.
+    SQL_DIAS_VENCIMENTO = ("CASE WHEN e.ativo AND NOT COALESCE(e.em_calibracao, 0) AND "
+                           + SQL_DATA_VALIDA.format(coluna="e.proxima_data_calibracao")
+                           + " THEN CAST(julianday(e.proxima_data_calibracao) - julianday(date('now', 'localtime')) AS INTEGER) END")
+
+    def fetch_equipamentos_pagina(self, inicio=0, limite=10, ordenar_por="nome", direcao="asc",
+                                  filtros_coluna=None, busca_global="", cursor=None):
+        """Uma página da lista de equipamentos, com ordenação, filtros e busca feitos no SQL.
+
+        `cursor` (valor de ordenação, id) da última linha da página anterior ativa a
+        paginação por keyset, que não degrada com o avanço das páginas como o OFFSET.
+        Retorna (total, total_filtrado, linhas, cursor_proxima_pagina).
+        """
+        expr_ordem = self.COLUNAS_LISTA_EQUIPAMENTOS.get(ordenar_por, "e.nome")
+        if expr_ordem != "e.id":
+            expr_ordem = f"COALESCE({expr_ordem}, '')"
+        desc = str(direcao).lower() == "desc"
+
+        condicoes, params = [], []
+        for coluna, valor in (filtros_coluna or {}).items():
+            if coluna == "dias_vencimento" and valor:
+                # Número digitado compara com a contagem de dias; o resto (ex.: "N/A", "-") com o texto exibido
+                if valor.lstrip("-").isdigit():
+                    condicoes.append(f"{self.SQL_DIAS_VENCIMENTO} = ?")
+                    params.append(int(valor))
+                else:
+                    condicoes.append(f"COALESCE(CAST({self.SQL_DIAS_VENCIMENTO} AS TEXT), 'N/A') LIKE ?")
+                    params.append(f"%{valor}%")
+            elif coluna in self.COLUNAS_LISTA_EQUIPAMENTOS and valor:
+                condicoes.append(f"{self.COLUNAS_LISTA_EQUIPAMENTOS[coluna]} LIKE ?")
+                params.append(f"%{valor}%")
+        busca_global = str(busca_global or '')
+        consulta_fts = self._montar_consulta_fts(busca_global)
+        if busca_global:
+            # Mesmo critério de search_equipamentos: sem termo FTS utilizável (ou sem FTS5), usa LIKE
+            if consulta_fts and self._fts_disponivel():
+                condicoes.append("e.id IN (SELECT rowid FROM equipamentos_fts WHERE equipamentos_fts MATCH ?)")
+                params.append(consulta_fts)
+            else:
+                colunas_busca = [expr for nome, expr in self.COLUNAS_LISTA_EQUIPAMENTOS.items() if nome != "dias_vencimento"]
+                condicoes.append("(" + " OR ".join(f"{expr} LIKE ?" for expr in colunas_busca) + ")")
+                params.extend([f"%{busca_global}%"] * len(colunas_busca))
+
+        joins = """FROM equipamentos e
+                   LEFT JOIN tipos_equipamento te ON e.tipo_equipamento_id = te.id
+                   LEFT JOIN empresas emp ON e.empresa_id = emp.id"""
+        where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+        total_row = self.execute_query("SELECT COUNT(*) AS total FROM equipamentos", fetch_one=True)
+        total = total_row['total'] if total_row else 0
+        if condicoes:
+            filtrado_row = self.execute_query(f"SELECT COUNT(*) AS total {joins} {where}", tuple(params), fetch_one=True)
+            total_filtrado = filtrado_row['total'] if filtrado_row else 0
+        else:
+            total_filtrado = total
+
+        params_pagina = list(params)
+        condicoes_pagina = list(condicoes)
+        if cursor is not None:
+            condicoes_pagina.append(f"({expr_ordem}, e.id) {'<' if desc else '>'} (?, ?)")
+            params_pagina.extend(cursor)
+        where_pagina = f"WHERE {' AND '.join(condicoes_pagina)}" if condicoes_pagina else ""
+        sentido = "DESC" if desc else "ASC"
+        query = f"""SELECT e.*, te.nome_tipo as tipo_equipamento_nome, emp.nome_fantasia as empresa_nome,
+                           {expr_ordem} AS _valor_ordem
+                   {joins} {where_pagina}
+                   ORDER BY {expr_ordem} {sentido}, e.id {sentido}
+                   LIMIT ?"""
+        limite = int(limite)
+        if cursor is None and int(inicio) > 0:
+            query += " OFFSET ?"
+            params_pagina.extend([limite, int(inicio)])
+        else:
+            params_pagina.append(limite)
+        linhas = self.execute_query(query, tuple(params_pagina), fetch_all=True) or []
+
+        proximo_cursor = None
+        if linhas and len(linhas) == limite:
+            proximo_cursor = [linhas[-1]['_valor_ordem'], linhas[-1]['id']]
+        return total, total_filtrado, linhas, proximo_cursor
+
     def fetch_equipamento_completo_by_id(self, equip_id):
         query = """SELECT e.*, te.nome_tipo as tipo_equipamento_nome, emp.nome_fantasia as empresa_nome
                    FROM equipamentos e
@@ -227,13 +761,21 @@ class DatabaseManager:
             data.get('tag'),
             data.get('status'), data.get('localizacao'), data.get('observacoes_equipamento'),
             data.get('tipo_equipamento_id'), data.get('faixa_de_uso'),
+            data.get('empresa_id'),
             1 if data.get('ativo') else 0,
             1 if data.get('requer_calibracao') else 0,
             1 if data.get('em_calibracao') else 0,
-            data.get('destino_inativo'),
-            data.get('empresa_id')
+            data.get('destino_inativo')
         )
-        return self.execute_query(query, params, commit=True)
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(query, params)
+                equip_id = cursor.lastrowid
+                self._ajustar_agregados(cursor, None, self._linha_agregado_equipamento(cursor, equip_id))
+            return equip_id
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite: {e} | Query: {query} | Params: {params}")
+            return False
 
     def update_equipamento_principal(self, equip_id, data):
         query = """UPDATE equipamentos SET nome=?, fabricante=?, modelo=?, 
@@ -246,50 +788,278 @@ class DatabaseManager:
             data.get('nome'), data.get('fabricante'), data.get('modelo'), data.get('numero_serie'),
             data.get('tag'),
             data.get('status'), data.get('localizacao'), data.get('observacoes_equipamento'),
-            data.get('tipo_equipamento_id'), data.get('faixa_de_uso'),
-            data.get('empresa_id'),
+            data.get('tipo_equipamento_id'), data.get('empresa_id'),
+            data.get('faixa_de_uso'),
             1 if data.get('ativo') else 0,
             1 if data.get('requer_calibracao') else 0,
             1 if data.get('em_calibracao') else 0,
             data.get('destino_inativo'),
             equip_id
         )
-        return self.execute_query(query, params, commit=True)
+        return self._executar_com_agregados(equip_id, query, params)
+
+    def update_equipamento_status(self, equip_id, status):
+        # O texto do status não entra em nenhum agregado (ativo/em_calibracao/data sim)
+        return self.execute_query("UPDATE equipamentos SET status = ? WHERE id = ?", (status, equip_id), commit=True)
+
+    def recalcular_status_equipamentos(self, hoje=None):
+        """Recalcula em lote o status 'Calibração Vencida' / 'Ativo' a partir da próxima calibração.
+
+        Duas UPDATEs numa transação; idempotente (uma segunda execução no mesmo dia não altera nada).
+        Retorna {'vencidos': n, 'reativados': n} ou None em caso de erro.
+        """
+        hoje_iso = (hoje or datetime.date.today()).isoformat()
+        filtro_base = f"""ativo AND NOT COALESCE(em_calibracao, 0)
+                         AND {self.SQL_DATA_VALIDA.format(coluna="proxima_data_calibracao")}"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(f"""UPDATE equipamentos SET status = 'Calibração Vencida'
+                                   WHERE {filtro_base} AND proxima_data_calibracao <= ?
+                                     AND status IS NOT 'Calibração Vencida'""", (hoje_iso,))
+                vencidos = cursor.rowcount
+                cursor.execute(f"""UPDATE equipamentos SET status = 'Ativo'
+                                   WHERE {filtro_base} AND proxima_data_calibracao > ?
+                                     AND status = 'Calibração Vencida'""", (hoje_iso,))
+                reativados = cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao recalcular status dos equipamentos: {e}")
+            return None
+        return {"vencidos": vencidos, "reativados": reativados}
 
     def delete_equipamento(self, equip_id, app_upload_folder, app_utils_instance=None): 
         analises = self.fetch_analises_by_equipamento_id(equip_id, app_utils_instance=app_utils_instance)
         for analise in analises: 
             self.delete_analise_certificado(analise['id'], app_upload_folder, app_utils_instance=app_utils_instance) 
-        return self.execute_query("DELETE FROM equipamentos WHERE id=?", (equip_id,), commit=True)
+        return self._executar_com_agregados(equip_id, "DELETE FROM equipamentos WHERE id=?", (equip_id,))
+
+    # --- Agregados do dashboard (mantidos incrementalmente a cada escrita em equipamentos) ---
+    def _faixa_cor(self, ativo, em_calibracao, data_proxima_str, hoje):
+        """Mesma classificação de AppUtils.calcular_dias_para_vencimento, devolvendo o tag_style."""
+        if not ativo: return "status_inativo"
+        if em_calibracao: return "status_em_calibracao"
+        try:
+            delta = (datetime.datetime.strptime(str(data_proxima_str), "%Y-%m-%d").date() - hoje).days
+        except ValueError:
+            return "status_semdata"
+        for regra in self.regras_cores:
+            lim_inf, lim_sup = regra['limite_inferior'], regra['limite_superior']
+            if (lim_inf is None or delta >= lim_inf) and (lim_sup is None or delta < lim_sup):
+                return regra['tag_style']
+        return "status_semdata"
+
+    def _chaves_agregado(self, row, hoje):
+        return (
+            ("geral", ""),
+            ("faixa_cor", self._faixa_cor(row['ativo'], row['em_calibracao'], row['proxima_data_calibracao'], hoje)),
+            ("tipo", str(row['tipo_equipamento_id'] or "")),
+            ("empresa", str(row['empresa_id'] or "")),
+            ("localizacao", (row['localizacao'] or "").strip()),
+        )
+
+    def _linha_agregado_equipamento(self, cursor, equip_id):
+        return cursor.execute("""SELECT ativo, em_calibracao, proxima_data_calibracao, tipo_equipamento_id,
+                                        empresa_id, localizacao
+                                 FROM equipamentos WHERE id = ?""", (equip_id,)).fetchone()
+
+    def _aplicar_agregado(self, cursor, row, sinal, hoje):
+        ativo = 1 if row['ativo'] else 0
+        em_calibracao = 1 if (row['ativo'] and row['em_calibracao']) else 0
+        for dimensao, chave in self._chaves_agregado(row, hoje):
+            cursor.execute("""INSERT INTO dashboard_agregados (dimensao, chave, total, ativos, em_calibracao)
+                              VALUES (?, ?, ?, ?, ?)
+                              ON CONFLICT (dimensao, chave) DO UPDATE SET
+                                  total = total + excluded.total,
+                                  ativos = ativos + excluded.ativos,
+                                  em_calibracao = em_calibracao + excluded.em_calibracao""",
+                           (dimensao, chave, sinal, sinal * ativo, sinal * em_calibracao))
+            if sinal < 0:
+                cursor.execute("DELETE FROM dashboard_agregados WHERE dimensao = ? AND chave = ? AND total <= 0",
+                               (dimensao, chave))
+
+    def _ajustar_agregados(self, cursor, linha_antes, linha_depois):
+        hoje = datetime.date.today()
+        data_faixas = cursor.execute("SELECT valor FROM metadados_sistema WHERE chave = 'agregados_data_faixas'").fetchone()
+        if not data_faixas or data_faixas['valor'] != hoje.isoformat():
+            # As faixas de cor dependem da data: no primeiro ajuste do dia reconstrói tudo.
+            self._reconstruir_agregados(cursor, hoje)
+            return
+        if linha_antes is not None:
+            self._aplicar_agregado(cursor, linha_antes, -1, hoje)
+        if linha_depois is not None:
+            self._aplicar_agregado(cursor, linha_depois, 1, hoje)
+
+    def _executar_com_agregados(self, equip_id, query, params):
+        try:
+            with self.transaction() as cursor:
+                linha_antes = self._linha_agregado_equipamento(cursor, equip_id)
+                cursor.execute(query, params)
+                self._ajustar_agregados(cursor, linha_antes, self._linha_agregado_equipamento(cursor, equip_id))
+            return True
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite: {e} | Query: {query} | Params: {params}")
+            return False
+
+    def _reconstruir_agregados(self, cursor, hoje):
+        contagens = {}
+        for row in cursor.execute("""SELECT ativo, em_calibracao, proxima_data_calibracao, tipo_equipamento_id,
+                                            empresa_id, localizacao FROM equipamentos""").fetchall():
+            ativo = 1 if row['ativo'] else 0
+            em_calibracao = 1 if (row['ativo'] and row['em_calibracao']) else 0
+            for chave in self._chaves_agregado(row, hoje):
+                total, ativos, em_cal = contagens.get(chave, (0, 0, 0))
+                contagens[chave] = (total + 1, ativos + ativo, em_cal + em_calibracao)
+        cursor.execute("DELETE FROM dashboard_agregados")
+        cursor.executemany("INSERT INTO dashboard_agregados (dimensao, chave, total, ativos, em_calibracao) VALUES (?, ?, ?, ?, ?)",
+                           [(dim, chave, *valores) for (dim, chave), valores in contagens.items()])
+        cursor.execute("INSERT OR REPLACE INTO metadados_sistema (chave, valor) VALUES ('agregados_data_faixas', ?)",
+                       (hoje.isoformat(),))
+
+    def reconstruir_agregados_dashboard(self):
+        try:
+            # Dados derivados: não alteram a versão dos dados (nem disparam recálculo ou novas exportações)
+            with self.transaction(versionar=False) as cursor:
+                self._reconstruir_agregados(cursor, datetime.date.today())
+            return True
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao reconstruir agregados do dashboard: {e}")
+            return False
+
+    def fetch_agregados_dashboard(self):
+        """Contadores do dashboard numa única leitura da tabela de agregados (chave primária)."""
+        data_faixas = self.execute_query("SELECT valor FROM metadados_sistema WHERE chave = 'agregados_data_faixas'", fetch_one=True)
+        if not data_faixas or data_faixas['valor'] != datetime.date.today().isoformat():
+            self.reconstruir_agregados_dashboard()
+        rows = self.execute_query("""SELECT a.dimensao, a.chave, a.total, a.ativos, a.em_calibracao,
+                                            CASE a.dimensao WHEN 'tipo' THEN te.nome_tipo
+                                                            WHEN 'empresa' THEN COALESCE(emp.nome_fantasia, emp.razao_social)
+                                                            ELSE a.chave END AS rotulo
+                                     FROM dashboard_agregados a
+                                     LEFT JOIN tipos_equipamento te ON a.dimensao = 'tipo' AND te.id = CAST(a.chave AS INTEGER)
+                                     LEFT JOIN empresas emp ON a.dimensao = 'empresa' AND emp.id = CAST(a.chave AS INTEGER)
+                                     ORDER BY a.dimensao, a.total DESC""", fetch_all=True) or []
+        resultado = {"total": 0, "ativos": 0, "em_calibracao": 0,
+                     "faixa_cor": [], "tipo": [], "empresa": [], "localizacao": []}
+        for row in rows:
+            item = dict(row)
+            if item['dimensao'] == 'geral':
+                resultado.update(total=item['total'], ativos=item['ativos'], em_calibracao=item['em_calibracao'])
+            elif item['dimensao'] in resultado:
+                resultado[item['dimensao']].append(item)
+        return resultado
 
     def fetch_all_tipos_equipamento(self):
-        return self.execute_query("SELECT id, nome_tipo FROM tipos_equipamento ORDER BY nome_tipo", fetch_all=True) or []
+        return self._cache_consulta(("tipos",), ("tipos",), lambda: self.execute_query(
+            "SELECT id, nome_tipo FROM tipos_equipamento ORDER BY nome_tipo", fetch_all=True) or [])
     
     def fetch_tipo_equipamento_by_id(self, tipo_id):
         return self.execute_query("SELECT id, nome_tipo FROM tipos_equipamento WHERE id = ?", (tipo_id,), fetch_one=True)
 
     def add_tipo_equipamento(self, nome_tipo):
-        return self.execute_query("INSERT INTO tipos_equipamento (nome_tipo) VALUES (?)", (nome_tipo,), commit=True)
+        resultado = self.execute_query("INSERT INTO tipos_equipamento (nome_tipo) VALUES (?)", (nome_tipo,), commit=True)
+        self._invalidar_referencia("tipos")
+        return resultado
             
     def update_tipo_equipamento(self, tipo_id, novo_nome_tipo):
-        return self.execute_query("UPDATE tipos_equipamento SET nome_tipo = ? WHERE id = ?", (novo_nome_tipo, tipo_id), commit=True)
+        resultado = self.execute_query("UPDATE tipos_equipamento SET nome_tipo = ? WHERE id = ?", (novo_nome_tipo, tipo_id), commit=True)
+        self._invalidar_referencia("tipos")
+        return resultado
 
     def delete_tipo_equipamento(self, tipo_id):
         equip_usando = self.execute_query("SELECT 1 FROM equipamentos WHERE tipo_equipamento_id = ? LIMIT 1", (tipo_id,), fetch_one=True)
         if equip_usando:
             return "EM_USO" 
-        return self.execute_query("DELETE FROM tipos_equipamento WHERE id = ?", (tipo_id,), commit=True)
+        try:
+            # Unidades e tipo saem juntos, cada um num único DELETE
+            with self.transaction() as cursor:
+                cursor.execute("DELETE FROM unidades_medida_config WHERE tipo_equipamento_id = ?", (tipo_id,))
+                cursor.execute("DELETE FROM tipos_equipamento WHERE id = ?", (tipo_id,))
+            return True
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao excluir tipo {tipo_id}: {e}")
+            return False
+        finally:
+            self._invalidar_referencia("tipos", "unidades")
 
     def fetch_unidades_by_tipo_id(self, tipo_equip_id):
         if tipo_equip_id is None:
             return []
-        return self.execute_query("SELECT id, nome_unidade, simbolo_unidade FROM unidades_medida_config WHERE tipo_equipamento_id = ? ORDER BY nome_unidade", (tipo_equip_id,), fetch_all=True) or []
+        return self._cache_consulta(("unidades",), ("unidades", tipo_equip_id), lambda: self.execute_query(
+            "SELECT id, nome_unidade, simbolo_unidade FROM unidades_medida_config WHERE tipo_equipamento_id = ? ORDER BY nome_unidade",
+            (tipo_equip_id,), fetch_all=True) or [])
 
     def add_unidade_medida_config(self, tipo_equip_id, nome_unidade, simbolo_unidade):
-        return self.execute_query("INSERT INTO unidades_medida_config (tipo_equipamento_id, nome_unidade, simbolo_unidade) VALUES (?, ?, ?)", (tipo_equip_id, nome_unidade, simbolo_unidade), commit=True)
+        resultado = self.execute_query("INSERT INTO unidades_medida_config (tipo_equipamento_id, nome_unidade, simbolo_unidade) VALUES (?, ?, ?)", (tipo_equip_id, nome_unidade, simbolo_unidade), commit=True)
+        self._invalidar_referencia("unidades")
+        return resultado
             
     def delete_unidade_medida_config(self, unidade_id):
-        return self.execute_query("DELETE FROM unidades_medida_config WHERE id = ?", (unidade_id,), commit=True)
+        resultado = self.execute_query("DELETE FROM unidades_medida_config WHERE id = ?", (unidade_id,), commit=True)
+        self._invalidar_referencia("unidades")
+        return resultado
+
+    def fetch_tipos_com_unidades(self):
+        """Todos os tipos com a lista 'unidades' aninhada, a partir de uma única consulta com LEFT JOIN."""
+        def carregar():
+            rows = self.execute_query("""SELECT t.id, t.nome_tipo, u.id AS unidade_id, u.nome_unidade, u.simbolo_unidade
+                                         FROM tipos_equipamento t
+                                         LEFT JOIN unidades_medida_config u ON u.tipo_equipamento_id = t.id
+                                         ORDER BY t.nome_tipo, t.id, u.nome_unidade""", fetch_all=True) or []
+            tipos = []
+            for row in rows:
+                if not tipos or tipos[-1]['id'] != row['id']:
+                    tipos.append({'id': row['id'], 'nome_tipo': row['nome_tipo'], 'unidades': []})
+                if row['unidade_id'] is not None:
+                    tipos[-1]['unidades'].append({'id': row['unidade_id'], 'nome_unidade': row['nome_unidade'],
+                                                  'simbolo_unidade': row['simbolo_unidade']})
+            return tipos
+        # Cópia por tipo: quem recebe pode alterar os dicts sem afetar o cache
+        return [dict(tipo, unidades=[dict(u) for u in tipo['unidades']])
+                for tipo in self._cache_consulta(("tipos", "unidades"), ("tipos_com_unidades",), carregar)]
+
+    def salvar_tipo_com_unidades(self, tipo_id, nome_tipo, unidades):
+        """Cria (tipo_id None) ou renomeia o tipo e aplica as unidades do formulário numa única transação.
+
+        `unidades` segue o formato de unidades_json_data: dicts com id, nome_unidade, simbolo_unidade
+        e status 'new', 'existing' ou 'deleted'. Retorna o id do tipo ou False em caso de erro.
+        """
+        try:
+            with self.transaction() as cursor:
+                if tipo_id is None:
+                    cursor.execute("INSERT INTO tipos_equipamento (nome_tipo) VALUES (?)", (nome_tipo,))
+                    tipo_id = cursor.lastrowid
+                else:
+                    cursor.execute("UPDATE tipos_equipamento SET nome_tipo = ? WHERE id = ?", (nome_tipo, tipo_id))
+
+                removidas, alteradas, novas = [], [], []
+                for unidade in unidades or []:
+                    status = unidade.get('status')
+                    nome_unidade = (unidade.get('nome_unidade') or '').strip()
+                    simbolo = unidade.get('simbolo_unidade')
+                    if status == 'deleted':
+                        if unidade.get('id') is not None:
+                            removidas.append((unidade['id'], tipo_id))
+                    elif not nome_unidade:
+                        continue
+                    elif unidade.get('id') is not None and status != 'new':
+                        alteradas.append((nome_unidade, simbolo, unidade['id'], tipo_id, nome_unidade, simbolo))
+                    else:
+                        novas.append((tipo_id, nome_unidade, simbolo))
+
+                cursor.executemany("DELETE FROM unidades_medida_config WHERE id = ? AND tipo_equipamento_id = ?", removidas)
+                # Só regrava unidades existentes que de fato mudaram
+                cursor.executemany("""UPDATE unidades_medida_config SET nome_unidade = ?, simbolo_unidade = ?
+                                      WHERE id = ? AND tipo_equipamento_id = ?
+                                        AND (nome_unidade IS NOT ? OR simbolo_unidade IS NOT ?)""", alteradas)
+                cursor.executemany("""INSERT INTO unidades_medida_config (tipo_equipamento_id, nome_unidade, simbolo_unidade)
+                                      VALUES (?, ?, ?)
+                                      ON CONFLICT (tipo_equipamento_id, nome_unidade)
+                                      DO UPDATE SET simbolo_unidade = excluded.simbolo_unidade""", novas)
+            return tipo_id
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao salvar tipo '{nome_tipo}' e unidades: {e}")
+            return False
+        finally:
+            self._invalidar_referencia("tipos", "unidades")
 
     def fetch_analises_by_equipamento_id(self, equip_id, add_is_latest_flag=False, app_utils_instance=None):
         query = """SELECT a.*, 
@@ -315,22 +1085,49 @@ class DatabaseManager:
         
         return analises_list
     
+    # Consultas em lote para exportações: os IDs vão como array JSON e json_each preserva a ordem
+    # recebida (coluna key), então cada aba sai numa única consulta, já na ordem dos equipamentos.
+    def iter_analises_por_equipamentos(self, equip_ids):
+        """Análises dos equipamentos informados (mais recente primeiro), com o nome do equipamento."""
+        query = """SELECT a.*, e.nome AS equipamento_nome
+                   FROM json_each(?) ids
+                   JOIN analises_certificado a ON a.equipamento_id = ids.value
+                   JOIN equipamentos e ON e.id = a.equipamento_id
+                   ORDER BY ids.key, a.id DESC"""
+        return self.iter_query(query, (json.dumps(list(equip_ids)),))
+
+    def iter_pontos_por_equipamentos(self, equip_ids):
+        """Pontos analisados de todas as análises dos equipamentos informados."""
+        query = """SELECT p.*, a.numero_certificado_analisado
+                   FROM json_each(?) ids
+                   JOIN analises_certificado a ON a.equipamento_id = ids.value
+                   JOIN pontos_analisados_certificado p ON p.analise_certificado_id = a.id
+                   ORDER BY ids.key, a.id DESC, p.nome_ponto"""
+        return self.iter_query(query, (json.dumps(list(equip_ids)),))
+
+    def iter_anexos_por_equipamentos(self, equip_ids):
+        """Anexos de todas as análises dos equipamentos informados."""
+        query = """SELECT an.*, a.numero_certificado_analisado
+                   FROM json_each(?) ids
+                   JOIN analises_certificado a ON a.equipamento_id = ids.value
+                   JOIN anexos_analise an ON an.analise_id = a.id
+                   ORDER BY ids.key, a.id DESC, an.nome_arquivo_original"""
+        return self.iter_query(query, (json.dumps(list(equip_ids)),))
+
+    # A análise mais recente de um equipamento é a de maior id; com o índice (equipamento_id, id)
+    # o MAX é uma única busca na árvore, sem carregar o histórico.
+    SQL_ANALISE_COM_IS_LATEST = """SELECT a.*,
+                                          a.id = (SELECT MAX(ult.id) FROM analises_certificado ult
+                                                  WHERE ult.equipamento_id = a.equipamento_id) AS is_latest
+                                   FROM analises_certificado a WHERE a.id = ?"""
+
     def fetch_analise_by_id(self, analise_id, app_utils_instance=None):
-        analise_row = self.execute_query("SELECT * FROM analises_certificado WHERE id = ?", (analise_id,), fetch_one=True)
+        analise_row = self.execute_query(self.SQL_ANALISE_COM_IS_LATEST, (analise_id,), fetch_one=True)
         if not analise_row:
             return None
         
         analise_data = dict(analise_row)
-        todas_analises_equip = self.fetch_analises_by_equipamento_id(analise_data['equipamento_id'], add_is_latest_flag=True, app_utils_instance=app_utils_instance)
-        
-        is_latest_found = False
-        for an_hist in todas_analises_equip:
-            if an_hist['id'] == analise_id:
-                analise_data['is_latest'] = an_hist['is_latest']
-                is_latest_found = True
-                break
-        if not is_latest_found: 
-             analise_data['is_latest'] = False 
+        analise_data['is_latest'] = bool(analise_data['is_latest'])
         
         if app_utils_instance:
             for date_field in ['data_analise_manual', 'data_calibracao_analisada', 'data_prox_calibracao_analisada', 'data_registro_sistema']:
@@ -338,7 +1135,78 @@ class DatabaseManager:
              
         return analise_data
 
-    def add_analise_certificado(self, equip_id, data, pontos_analise_json=None):
+    COLUNAS_PONTO_ANALISADO = ('nome_ponto', 'simbolo_ponto', 'amplitude_A_ponto', 'desvio_B_ponto',
+                               'regra_aplicada_ponto', 'resultado_ponto', 'observacoes_ponto', 'valor_nominal_ponto')
+
+    @staticmethod
+    def _carregar_pontos_json(pontos_analise_json, operacao):
+        """Lista de pontos do JSON do formulário; None se ausente ou inválido (pontos não são alterados)."""
+        if not pontos_analise_json:
+            return None
+        try:
+            return json.loads(pontos_analise_json)
+        except json.JSONDecodeError:
+            print(f"Erro ao processar pontos da análise (JSON inválido) ao {operacao}.")
+            return None
+
+    COLUNAS_PONTO_REAL = ('amplitude_A_ponto', 'desvio_B_ponto', 'valor_nominal_ponto')
+
+    @classmethod
+    def _converter_valor_ponto(cls, coluna, valor):
+        """Converte o valor vindo do formulário/JSON para o tipo da coluna: REAL vira float e texto vazio vira NULL."""
+        if isinstance(valor, str):
+            valor = valor.strip()
+            if not valor and coluna != 'nome_ponto':
+                return None
+        if valor is None or coluna not in cls.COLUNAS_PONTO_REAL:
+            return valor
+        try:
+            return float(valor.replace(',', '.')) if isinstance(valor, str) else float(valor)
+        except (TypeError, ValueError):
+            return valor
+
+    def _valores_ponto(self, ponto_data):
+        return tuple(self._converter_valor_ponto(coluna, ponto_data.get(coluna)) for coluna in self.COLUNAS_PONTO_ANALISADO)
+
+    def _inserir_pontos(self, cursor, analise_id, pontos):
+        colunas = ", ".join(self.COLUNAS_PONTO_ANALISADO)
+        marcadores = ", ".join("?" for _ in self.COLUNAS_PONTO_ANALISADO)
+        cursor.executemany(f"INSERT INTO pontos_analisados_certificado (analise_certificado_id, {colunas}) VALUES (?, {marcadores})",
+                           [(analise_id, *self._valores_ponto(ponto)) for ponto in pontos])
+
+    def _sincronizar_pontos(self, cursor, analise_id, pontos):
+        """Aplica a lista do formulário comparando com o banco: só insere, altera ou remove o que mudou."""
+        existentes = {row['id']: row for row in cursor.execute(
+            "SELECT * FROM pontos_analisados_certificado WHERE analise_certificado_id = ?", (analise_id,)).fetchall()}
+        novos, alterados, mantidos = [], [], set()
+        for ponto in pontos:
+            try:
+                ponto_id = int(ponto.get('id_ponto_db') or ponto.get('id') or 0)
+            except (TypeError, ValueError):
+                ponto_id = 0
+            atual = existentes.get(ponto_id)
+            if atual is None:
+                novos.append(ponto)
+                continue
+            mantidos.add(ponto_id)
+            # Colunas ausentes no formulário (ex.: valor_nominal_ponto) mantêm o valor gravado
+            atual = dict(atual)
+            valores = self._valores_ponto({**atual, **ponto})
+            if valores != self._valores_ponto(atual):
+                alterados.append((*valores, ponto_id))
+
+        removidos = [(ponto_id,) for ponto_id in existentes if ponto_id not in mantidos]
+        if removidos:
+            cursor.executemany("DELETE FROM pontos_analisados_certificado WHERE id = ?", removidos)
+        if alterados:
+            atribuicoes = ", ".join(f"{coluna} = ?" for coluna in self.COLUNAS_PONTO_ANALISADO)
+            cursor.executemany(f"UPDATE pontos_analisados_certificado SET {atribuicoes} WHERE id = ?", alterados)
+        if novos:
+            self._inserir_pontos(cursor, analise_id, novos)
+        return {"inseridos": len(novos), "alterados": len(alterados), "removidos": len(removidos)}
+
+    def add_analise_certificado(self, equip_id, data, pontos_analise_json=None, sincronizar_equipamento=True):
+        """Grava a análise, seus pontos (executemany) e a última análise do equipamento numa única transação."""
         query = """INSERT INTO analises_certificado (equipamento_id, data_registro_sistema, data_analise_manual,
                                                  responsavel_analise, numero_certificado_analisado,
                                                  data_calibracao_analisada, data_prox_calibracao_analisada,
@@ -351,23 +1219,21 @@ class DatabaseManager:
             data.get('data_prox_calibracao_analisada'), data.get('resultado_geral_certificado'),
             data.get('observacoes_analise')
         )
-        analise_id = self.execute_query(query, params, commit=True)
-        if analise_id and pontos_analise_json:
-            try:
-                pontos = json.loads(pontos_analise_json)
-                for ponto_data in pontos:
-                    self.add_ponto_analisado(analise_id, ponto_data)
-            except json.JSONDecodeError:
-                print("Erro ao processar pontos da análise (JSON inválido) ao adicionar.")
-        return analise_id
-
-    def update_analise_certificado(self, analise_id, data, pontos_analise_json=None, app_utils_instance=None):
-        analise_atual = self.fetch_analise_by_id(analise_id, app_utils_instance=app_utils_instance)
-        if not analise_atual:
-            return "NOT_FOUND"
-        if not analise_atual.get('is_latest', False): 
-            return "NOT_LATEST"
+        pontos = self._carregar_pontos_json(pontos_analise_json, "adicionar")
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(query, params)
+                analise_id = cursor.lastrowid
+                if pontos:
+                    self._inserir_pontos(cursor, analise_id, pontos)
+                if sincronizar_equipamento:
+                    self._atualizar_ultima_analise(cursor, equip_id, data)
+            return analise_id
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao adicionar análise do equipamento {equip_id}: {e}")
+            return False
 
+    def update_analise_certificado(self, analise_id, data, pontos_analise_json=None, app_utils_instance=None, sincronizar_equipamento=True):
         query = """UPDATE analises_certificado SET data_analise_manual = ?, 
                           responsavel_analise = ?,
                           numero_certificado_analisado = ?, 
@@ -382,48 +1248,46 @@ class DatabaseManager:
             data.get('data_prox_calibracao_analisada'), data.get('resultado_geral_certificado'),
             data.get('observacoes_analise'), analise_id
         )
-        success = self.execute_query(query, params, commit=True)
-        if success and pontos_analise_json:
-            self.delete_all_pontos_for_analise(analise_id) 
-            try:
-                pontos = json.loads(pontos_analise_json)
-                for ponto_data in pontos:
-                    self.add_ponto_analisado(analise_id, ponto_data)
-            except json.JSONDecodeError:
-                 print("Erro ao processar pontos da análise (JSON inválido) ao atualizar.")
-        return success
+        pontos = self._carregar_pontos_json(pontos_analise_json, "atualizar")
+        try:
+            with self.transaction() as cursor:
+                # Verificação dentro da transação: outra escrita não pode criar uma análise mais nova no meio
+                analise_atual = cursor.execute(self.SQL_ANALISE_COM_IS_LATEST, (analise_id,)).fetchone()
+                if not analise_atual:
+                    return "NOT_FOUND"
+                if not analise_atual['is_latest']: 
+                    return "NOT_LATEST"
+                cursor.execute(query, params)
+                if pontos is not None:
+                    self._sincronizar_pontos(cursor, analise_id, pontos)
+                if sincronizar_equipamento:
+                    self._atualizar_ultima_analise(cursor, analise_atual['equipamento_id'], data)
+            return True
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao atualizar análise {analise_id}: {e}")
+            return False
 
     def delete_analise_certificado(self, analise_id, upload_folder, app_utils_instance=None): 
-        analise_info = self.fetch_analise_by_id(analise_id, app_utils_instance=app_utils_instance)
+        analise_info = self.execute_query("SELECT equipamento_id FROM analises_certificado WHERE id = ?", (analise_id,), fetch_one=True)
         if not analise_info:
             print(f"Tentativa de excluir análise ID {analise_id} que não foi encontrada.")
             return False, None 
         
         equip_id = analise_info['equipamento_id']
 
-        self.delete_all_pontos_for_analise(analise_id)
         self.delete_all_anexos_for_analise(analise_id, upload_folder)
-        delete_success = self.execute_query("DELETE FROM analises_certificado WHERE id = ?", (analise_id,), commit=True)
-
-        if delete_success:
-            novas_analises_restantes = self.fetch_analises_by_equipamento_id(equip_id, add_is_latest_flag=True, app_utils_instance=app_utils_instance)
-            if novas_analises_restantes:
-                nova_analise_mais_recente = novas_analises_restantes[0] 
-                dados_para_equip = {
-                    'numero_certificado_analisado': nova_analise_mais_recente.get('numero_certificado_analisado'),
-                    'data_calibracao_analisada': nova_analise_mais_recente.get('data_calibracao_analisada'),
-                    'data_prox_calibracao_analisada': nova_analise_mais_recente.get('data_prox_calibracao_analisada'),
-                    'resultado_geral_certificado': nova_analise_mais_recente.get('resultado_geral_certificado')
-                }
-                self.update_ultima_analise_em_equipamento(equip_id, dados_para_equip)
-            else: 
-                dados_para_equip_vazios = {
-                    'numero_certificado_analisado': None, 'data_calibracao_analisada': None,
-                    'data_prox_calibracao_analisada': None, 'resultado_geral_certificado': None
-                }
-                self.update_ultima_analise_em_equipamento(equip_id, dados_para_equip_vazios)
+        try:
+            with self.transaction() as cursor:
+                cursor.execute("DELETE FROM pontos_analisados_certificado WHERE analise_certificado_id = ?", (analise_id,))
+                cursor.execute("DELETE FROM analises_certificado WHERE id = ?", (analise_id,))
+                # A nova análise mais recente (maior id restante) passa a alimentar o equipamento
+                nova_mais_recente = cursor.execute("""SELECT * FROM analises_certificado WHERE equipamento_id = ?
+                                                      ORDER BY id DESC LIMIT 1""", (equip_id,)).fetchone()
+                self._atualizar_ultima_analise(cursor, equip_id, dict(nova_mais_recente) if nova_mais_recente else {})
             return True, equip_id 
-        return False, equip_id 
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao excluir análise {analise_id}: {e}")
+            return False, equip_id 
 
     def fetch_pontos_by_analise_id(self, analise_id):
         return self.execute_query("SELECT * FROM pontos_analisados_certificado WHERE analise_certificado_id = ? ORDER BY nome_ponto", (analise_id,), fetch_all=True) or []
@@ -433,11 +1297,7 @@ class DatabaseManager:
                    (analise_certificado_id, nome_ponto, simbolo_ponto, 
                     amplitude_A_ponto, desvio_B_ponto, regra_aplicada_ponto, resultado_ponto, observacoes_ponto, valor_nominal_ponto)
                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""" 
-        params = (analise_id, ponto_data.get('nome_ponto'), ponto_data.get('simbolo_ponto'),
-                  ponto_data.get('amplitude_A_ponto'), ponto_data.get('desvio_B_ponto'), 
-                  ponto_data.get('regra_aplicada_ponto'), ponto_data.get('resultado_ponto'), 
-                  ponto_data.get('observacoes_ponto'),
-                  ponto_data.get('valor_nominal_ponto', None)) 
+        params = (analise_id, *self._valores_ponto(ponto_data))
         return self.execute_query(query, params, commit=True)
 
     def delete_all_pontos_for_analise(self, analise_id):
@@ -485,7 +1345,8 @@ class DatabaseManager:
                 print(f"Aviso: Não foi possível remover o diretório de anexos vazio para a análise {analise_id}: {e}")
         return all_deleted_ok
 
-    def update_ultima_analise_em_equipamento(self, equip_id, analise_data_dict):
+    def _atualizar_ultima_analise(self, cursor, equip_id, analise_data_dict):
+        """Copia os dados da última análise para o equipamento (e ajusta os agregados) na transação atual."""
         query = """UPDATE equipamentos SET ultimo_numero_certificado = ?, 
                           ultima_data_calibracao = ?,
                           proxima_data_calibracao = ?, 
@@ -498,9 +1359,69 @@ class DatabaseManager:
             analise_data_dict.get('resultado_geral_certificado'),
             equip_id
         )
-        return self.execute_query(query, params, commit=True)
+        linha_antes = self._linha_agregado_equipamento(cursor, equip_id)
+        cursor.execute(query, params)
+        self._ajustar_agregados(cursor, linha_antes, self._linha_agregado_equipamento(cursor, equip_id))
+
+    def update_ultima_analise_em_equipamento(self, equip_id, analise_data_dict):
+        try:
+            with self.transaction() as cursor:
+                self._atualizar_ultima_analise(cursor, equip_id, analise_data_dict)
+            return True
+        except sqlite3.Error as e:
+            print(f"Erro BD SQLite ao atualizar última análise do equipamento {equip_id}: {e}")
+            return False
         
+    def _migracao_004_agregados_dashboard(self, cursor):
+        cursor.execute("""CREATE TABLE IF NOT EXISTS dashboard_agregados (
+            dimensao TEXT NOT NULL, chave TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0, ativos INTEGER NOT NULL DEFAULT 0,
+            em_calibracao INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimensao, chave)
+        ) WITHOUT ROWID""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS metadados_sistema (
+            chave TEXT PRIMARY KEY, valor TEXT
+        )""")
+        self._reconstruir_agregados(cursor, datetime.date.today())
+
+    @staticmethod
+    def _montar_consulta_fts(search_term):
+        """Converte o termo digitado numa consulta FTS5: todos os tokens, cada um como prefixo.
+
+        Tokens sem letras/dígitos (só aspas ou pontuação) não geram termos no índice e são descartados;
+        se nada sobrar, retorna "" e quem chama recorre ao LIKE.
+        """
+        tokens = [token.replace('"', '') for token in str(search_term or '').split()]
+        return " ".join(f'"{token}"*' for token in tokens if any(caractere.isalnum() for caractere in token))
+
+    def _fts_disponivel(self):
+        if not hasattr(self, "_fts_equipamentos"):
+            row = self.execute_query("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'equipamentos_fts'", fetch_one=True)
+            self._fts_equipamentos = bool(row)
+        return self._fts_equipamentos
+
     def search_equipamentos(self, search_term):
+        """Pesquisa equipamentos pelo índice FTS5, ordenando por relevância (bm25).
+
+        Aceita vários termos (todos precisam ocorrer) e prefixos, sem diferenciar
+        acentos. Sem FTS5 disponível, recorre à pesquisa LIKE original.
+        """
+        consulta_fts = self._montar_consulta_fts(search_term)
+        if not consulta_fts or not self._fts_disponivel():
+            return self._search_equipamentos_like(search_term)
+        pesos = ", ".join(str(peso) for _, peso in self.FTS_COLUNAS_EQUIPAMENTOS)
+        query = f"""SELECT e.*, te.nome_tipo as tipo_equipamento_nome
+                   FROM equipamentos_fts
+                   JOIN equipamentos e ON e.id = equipamentos_fts.rowid
+                   LEFT JOIN tipos_equipamento te ON e.tipo_equipamento_id = te.id
+                   WHERE equipamentos_fts MATCH ?
+                   ORDER BY bm25(equipamentos_fts, {pesos}), e.nome"""
+        resultado = self.execute_query(query, (consulta_fts,), fetch_all=True)
+        if resultado is False:
+            return self._search_equipamentos_like(search_term)
+        return resultado
+
+    def _search_equipamentos_like(self, search_term):
         query = """SELECT e.*, te.nome_tipo as tipo_equipamento_nome
                    FROM equipamentos e LEFT JOIN tipos_equipamento te ON e.tipo_equipamento_id = te.id
                    WHERE e.nome LIKE ? OR e.modelo LIKE ? OR e.numero_serie LIKE ? OR e.fabricante LIKE ?
@@ -524,10 +1445,13 @@ class DatabaseManager:
             data.get('telefone'), data.get('email'), data.get('categoria'),
             data.get('certificado_iso_path') 
         )
-        return self.execute_query(query, params, commit=True)
+        resultado = self.execute_query(query, params, commit=True)
+        self._invalidar_referencia("empresas")
+        return resultado
 
     def fetch_all_empresas(self):
-        return self.execute_query("SELECT * FROM empresas ORDER BY nome_fantasia, razao_social", fetch_all=True) or []
+        return self._cache_consulta(("empresas",), ("empresas",), lambda: self.execute_query(
+            "SELECT * FROM empresas ORDER BY nome_fantasia, razao_social", fetch_all=True) or [])
 
     def fetch_empresa_by_id(self, empresa_id):
         return self.execute_query("SELECT * FROM empresas WHERE id = ?", (empresa_id,), fetch_one=True)
@@ -556,7 +1480,9 @@ class DatabaseManager:
         query = f"UPDATE empresas SET {', '.join(campos_para_atualizar)} WHERE id=?"
         params.append(empresa_id)
         
-        return self.execute_query(query, tuple(params), commit=True)
+        resultado = self.execute_query(query, tuple(params), commit=True)
+        self._invalidar_referencia("empresas")
+        return resultado
 
     def delete_empresa(self, empresa_id, upload_folder_empresas):
         empresa = self.fetch_empresa_by_id(empresa_id)
@@ -571,11 +1497,14 @@ class DatabaseManager:
                 except OSError as e:
                     print(f"Aviso: Erro ao excluir arquivo/pasta do certificado ISO da empresa {empresa_id}: {e}")
         
-        return self.execute_query("DELETE FROM empresas WHERE id = ?", (empresa_id,), commit=True)
+        resultado = self.execute_query("DELETE FROM empresas WHERE id = ?", (empresa_id,), commit=True)
+        self._invalidar_referencia("empresas")
+        return resultado
 
     def fetch_empresas_unidade(self):
         query = "SELECT * FROM empresas WHERE categoria = 'Unidade'"
-        return self.execute_query(query, fetch_all=True) or []
+        return self._cache_consulta(("empresas",), ("empresas", "Unidade"),
+                                    lambda: self.execute_query(query, fetch_all=True) or [])
 
     def fetch_tipo_by_id(self, tipo_id):
         query = "SELECT * FROM tipos_equipamento WHERE id = ?"
@@ -583,13 +1512,62 @@ class DatabaseManager:
 
     def fetch_empresas_calibracao(self):
         query = "SELECT * FROM empresas WHERE categoria = 'Calibração'"
-        return self.execute_query(query, fetch_all=True) or []
+        return self._cache_consulta(("empresas",), ("empresas", "Calibração"),
+                                    lambda: self.execute_query(query, fetch_all=True) or [])
 
     # --- Métodos CRUD para Usuários (adicionados para login) ---
-    def get_user_by_id(self, user_id):
-        """Busca um usuário pelo ID."""
+    def get_user_by_id(self, user_id, geracao=None):
+        """Busca um usuário pelo ID (servido do cache LRU/TTL quando possível).
+
+        Com `geracao` (de get_user_generation), a entrada em cache só vale se ainda tiver essa geração.
+        """
+        try:
+            chave = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        agora = time.monotonic()
+        with self._user_cache_lock:
+            entrada = self._user_cache.get(chave)
+            if entrada is not None:
+                if entrada[0] > agora and (geracao is None or entrada[1]['geracao_sessao'] == geracao):
+                    self._user_cache.move_to_end(chave)
+                    self._user_cache_stats["hits"] += 1
+                    return entrada[1]
+                del self._user_cache[chave]
+                self._user_cache_stats["expirados"] += 1
+            self._user_cache_stats["misses"] += 1
+
         query = "SELECT * FROM usuarios WHERE id = ?"
-        return self.execute_query(query, (user_id,), fetch_one=True)
+        user = self.execute_query(query, (chave,), fetch_one=True)
+        if user:
+            with self._user_cache_lock:
+                self._user_cache[chave] = (agora + self.user_cache_ttl, user)
+                self._user_cache.move_to_end(chave)
+                while len(self._user_cache) > self.user_cache_size:
+                    self._user_cache.popitem(last=False)
+        return user
+
+    def _invalidar_usuario(self, user_id):
+        try:
+            chave = int(user_id)
+        except (TypeError, ValueError):
+            return
+        with self._user_cache_lock:
+            self._user_cache.pop(chave, None)
+            self._user_cache_stats["invalidacoes"] += 1
+
+    def get_user_generation(self, user_id):
+        """Geração gravada do usuário (None se não existe); claims/cache com geração diferente estão desatualizados."""
+        linha = self.execute_query("SELECT geracao_sessao FROM usuarios WHERE id = ?", (int(user_id),), fetch_one=True)
+        return linha['geracao_sessao'] if linha else None
+
+    def get_user_cache_stats(self):
+        with self._user_cache_lock:
+            stats = dict(self._user_cache_stats)
+            stats["entradas"] = len(self._user_cache)
+            stats["capacidade"] = self.user_cache_size
+            stats["ttl"] = self.user_cache_ttl
+        return stats
 
     def get_user_by_username(self, nome_usuario):
         """Busca um usuário pelo nome de usuário."""
@@ -603,24 +1581,367 @@ class DatabaseManager:
 
     def update_user_password(self, user_id, new_password_hash):
         """Atualiza a senha de um usuário."""
-        query = "UPDATE usuarios SET senha = ? WHERE id = ?"
-        return self.execute_query(query, (new_password_hash, user_id), commit=True)
+        query = "UPDATE usuarios SET senha = ?, geracao_sessao = geracao_sessao + 1 WHERE id = ?"
+        resultado = self.execute_query(query, (new_password_hash, user_id), commit=True)
+        self._invalidar_usuario(user_id)
+        return resultado
 
     def set_password_change_required(self, user_id, required):
         """Define se um usuário precisa trocar a senha."""
-        query = "UPDATE usuarios SET requires_password_change = ? WHERE id = ?"
+        query = "UPDATE usuarios SET requires_password_change = ?, geracao_sessao = geracao_sessao + 1 WHERE id = ?"
         flag = 1 if required else 0
-        return self.execute_query(query, (flag, user_id), commit=True)
+        resultado = self.execute_query(query, (flag, user_id), commit=True)
+        self._invalidar_usuario(user_id)
+        return resultado
+
+    def set_user_active(self, user_id, ativo):
+        """Ativa ou desativa um usuário."""
+        query = "UPDATE usuarios SET ativo = ?, geracao_sessao = geracao_sessao + 1 WHERE id = ?"
+        resultado = self.execute_query(query, (1 if ativo else 0, user_id), commit=True)
+        self._invalidar_usuario(user_id)
+        return resultado
     
     def get_all_users(self):
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios")
-        users = cursor.fetchall()
-        conn.close()
-        return users
+        return self.execute_query("SELECT * FROM usuarios", fetch_all=True) or []
+
+    # --- Fila persistente de notificações (outbox) ---
+    def _migracao_005_fila_notificacoes(self, cursor):
+        cursor.execute("""CREATE TABLE IF NOT EXISTS notificacoes_fila (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            canal TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            max_tentativas INTEGER NOT NULL DEFAULT 5,
+            proxima_tentativa TEXT NOT NULL,
+            ultimo_erro TEXT,
+            origem TEXT,
+            criado_em TEXT NOT NULL,
+            atualizado_em TEXT NOT NULL
+        )""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notificacoes_fila_status ON notificacoes_fila (status, proxima_tentativa)")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS notificacoes_entregas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fila_id INTEGER NOT NULL,
+            tentativa INTEGER NOT NULL,
+            sucesso INTEGER NOT NULL,
+            detalhe TEXT,
+            duracao_ms REAL,
+            registrado_em TEXT NOT NULL
+        )""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notificacoes_entregas_fila ON notificacoes_entregas (fila_id)")
+
+    @staticmethod
+    def _agora_iso():
+        return datetime.datetime.now().isoformat(timespec='seconds')
+
+    def enfileirar_notificacao(self, canal, payload, max_tentativas=5, origem="manual"):
+        """Grava uma notificação na fila para envio imediato pelo worker. Retorna o id ou False."""
+        agora = self._agora_iso()
+        try:
+            with self.transaction(versionar=False) as cursor:
+                cursor.execute("""INSERT INTO notificacoes_fila
+                    (canal, payload, status, max_tentativas, proxima_tentativa, origem, criado_em, atualizado_em)
+                    VALUES (?, ?, 'pendente', ?, ?, ?, ?, ?)""",
+                    (canal, json.dumps(payload, ensure_ascii=False), max(1, int(max_tentativas)), agora, origem, agora, agora))
+                return cursor.lastrowid
+        except sqlite3.Error as e:
+            print(f"Erro ao enfileirar notificação ({canal}): {e}")
+            return False
+
+    def reservar_notificacoes(self, limite=10):
+        """Marca como 'enviando' e devolve (como dicts, com payload decodificado) as notificações vencidas."""
+        agora = self._agora_iso()
+        try:
+            with self.transaction(versionar=False) as cursor:
+                linhas = cursor.execute("""SELECT * FROM notificacoes_fila
+                    WHERE status = 'pendente' AND proxima_tentativa <= ?
+                    ORDER BY proxima_tentativa, id LIMIT ?""", (agora, limite)).fetchall()
+                if linhas:
+                    cursor.executemany("UPDATE notificacoes_fila SET status = 'enviando', atualizado_em = ? WHERE id = ?",
+                                       [(agora, linha['id']) for linha in linhas])
+        except sqlite3.Error as e:
+            print(f"Erro ao reservar notificações da fila: {e}")
+            return []
+        itens = []
+        for linha in linhas:
+            item = dict(linha)
+            item['payload'] = json.loads(item['payload'])
+            itens.append(item)
+        return itens
+
+    def liberar_notificacoes_travadas(self, travada_segundos=900):
+        """Devolve para 'pendente' o que está 'enviando' há mais de `travada_segundos` (processo interrompido no meio do envio).
+
+        Itens reservados há menos tempo podem estar sendo enviados pelo worker de outro processo e não são tocados.
+        """
+        agora = datetime.datetime.now()
+        limite = (agora - datetime.timedelta(seconds=travada_segundos)).isoformat(timespec='seconds')
+        try:
+            with self.transaction(versionar=False) as cursor:
+                cursor.execute("""UPDATE notificacoes_fila SET status = 'pendente', atualizado_em = ?
+                                  WHERE status = 'enviando' AND atualizado_em < ?""",
+                               (agora.isoformat(timespec='seconds'), limite))
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Erro ao liberar notificações travadas: {e}")
+            return 0
+
+    def registrar_entrega_notificacao(self, fila_id, sucesso, detalhe=None, duracao_ms=None, novo_payload=None,
+                                      backoff_base=60, backoff_max=3600):
+        """Registra a tentativa no log e decide o próximo estado do item.
+
+        Sucesso -> 'enviado'. Falha -> nova tentativa com backoff exponencial (backoff_base * 2^(n-1),
+        limitado a backoff_max segundos) ou 'falhou' ao atingir max_tentativas. `novo_payload` substitui
+        o conteúdo para as próximas tentativas (ex.: só os destinatários que falharam). Retorna o novo status.
+        """
+        agora = datetime.datetime.now()
+        try:
+            with self.transaction(versionar=False) as cursor:
+                item = cursor.execute("SELECT tentativas, max_tentativas FROM notificacoes_fila WHERE id = ?",
+                                      (fila_id,)).fetchone()
+                if item is None:
+                    return None
+                tentativa = item['tentativas'] + 1
+                cursor.execute("""INSERT INTO notificacoes_entregas (fila_id, tentativa, sucesso, detalhe, duracao_ms, registrado_em)
+                    VALUES (?, ?, ?, ?, ?, ?)""", (fila_id, tentativa, 1 if sucesso else 0, detalhe, duracao_ms,
+                                                   agora.isoformat(timespec='seconds')))
+                if sucesso:
+                    status, proxima = "enviado", agora
+                elif tentativa >= item['max_tentativas']:
+                    status, proxima = "falhou", agora
+                else:
+                    atraso = min(backoff_max, backoff_base * (2 ** (tentativa - 1)))
+                    status, proxima = "pendente", agora + datetime.timedelta(seconds=atraso)
+                cursor.execute("""UPDATE notificacoes_fila SET status = ?, tentativas = ?, proxima_tentativa = ?,
+                    ultimo_erro = ?, atualizado_em = ?, payload = COALESCE(?, payload) WHERE id = ?""",
+                    (status, tentativa, proxima.isoformat(timespec='seconds'), None if sucesso else detalhe,
+                     agora.isoformat(timespec='seconds'),
+                     json.dumps(novo_payload, ensure_ascii=False) if novo_payload is not None else None, fila_id))
+                return status
+        except sqlite3.Error as e:
+            print(f"Erro ao registrar entrega da notificação {fila_id}: {e}")
+            return None
+
+    def reenfileirar_notificacao(self, fila_id):
+        """Recoloca uma notificação 'falhou' na fila, zerando as tentativas."""
+        query = """UPDATE notificacoes_fila SET status = 'pendente', tentativas = 0, proxima_tentativa = ?, atualizado_em = ?
+                   WHERE id = ? AND status = 'falhou'"""
+        agora = self._agora_iso()
+        try:
+            with self.transaction(versionar=False) as cursor:
+                cursor.execute(query, (agora, agora, fila_id))
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            print(f"Erro ao reenfileirar notificação {fila_id}: {e}")
+            return False
+
+    SQL_NOTIFICACAO_RESUMO = """SELECT id, canal, status, tentativas, max_tentativas, proxima_tentativa, ultimo_erro, origem,
+                                       criado_em, atualizado_em FROM notificacoes_fila"""
+
+    def fetch_notificacao_by_id(self, fila_id):
+        return self.execute_query(self.SQL_NOTIFICACAO_RESUMO + " WHERE id = ?", (fila_id,), fetch_one=True)
+
+    def fetch_notificacoes_fila(self, status=None, limite=50):
+        query = self.SQL_NOTIFICACAO_RESUMO
+        params = []
+        if status:
+            query += " WHERE status = ?"
+            params.append(status)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limite)
+        return self.execute_query(query, tuple(params), fetch_all=True) or []
+
+    def fetch_entregas_notificacao(self, fila_id):
+        return self.execute_query("SELECT * FROM notificacoes_entregas WHERE fila_id = ? ORDER BY id",
+                                  (fila_id,), fetch_all=True) or []
+
+    # --- Agendamento de notificações ---
+    def _migracao_006_agendamento_notificacoes(self, cursor):
+        # Uma linha por ocorrência do agendamento; a chave primária é a trava entre processos
+        cursor.execute("""CREATE TABLE IF NOT EXISTS notificacoes_agendamento (
+            ocorrencia TEXT PRIMARY KEY,
+            periodicidade TEXT,
+            instancia TEXT NOT NULL,
+            reivindicada_em TEXT NOT NULL,
+            concluida_em TEXT,
+            itens_enfileirados INTEGER,
+            detalhe TEXT
+        ) WITHOUT ROWID""")
+
+    def reivindicar_execucao_agendada(self, ocorrencia, periodicidade, instancia, expira_segundos=600):
+        """Reserva a ocorrência para esta instância; só uma instância (processo) recebe True.
+
+        Uma reserva não concluída há mais de `expira_segundos` (processo que caiu no meio) pode ser retomada.
+        """
+        agora = datetime.datetime.now()
+        limite = (agora - datetime.timedelta(seconds=expira_segundos)).isoformat(timespec='seconds')
+        try:
+            with self.transaction(versionar=False) as cursor:
+                cursor.execute("""INSERT OR IGNORE INTO notificacoes_agendamento (ocorrencia, periodicidade, instancia, reivindicada_em)
+                    VALUES (?, ?, ?, ?)""", (ocorrencia, periodicidade, instancia, agora.isoformat(timespec='seconds')))
+                if cursor.rowcount:
+                    return True
+                cursor.execute("""UPDATE notificacoes_agendamento SET instancia = ?, reivindicada_em = ?
+                    WHERE ocorrencia = ? AND concluida_em IS NULL AND reivindicada_em < ?""",
+                    (instancia, agora.isoformat(timespec='seconds'), ocorrencia, limite))
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            print(f"Erro ao reservar a execução agendada {ocorrencia}: {e}")
+            return False
+
+    def concluir_execucao_agendada(self, ocorrencia, itens_enfileirados, detalhe=None):
+        try:
+            with self.transaction(versionar=False) as cursor:
+                cursor.execute("""UPDATE notificacoes_agendamento SET concluida_em = ?, itens_enfileirados = ?, detalhe = ?
+                    WHERE ocorrencia = ?""", (self._agora_iso(), itens_enfileirados, detalhe, ocorrencia))
+                return True
+        except sqlite3.Error as e:
+            print(f"Erro ao concluir a execução agendada {ocorrencia}: {e}")
+            return False
+
+    def fetch_ultima_execucao_agendada(self):
+        return self.execute_query("SELECT * FROM notificacoes_agendamento ORDER BY ocorrencia DESC LIMIT 1", fetch_one=True)
+
+    # --- Cache das mensagens geradas pelo Gemini ---
+    def _migracao_007_cache_mensagens_gemini(self, cursor):
+        cursor.execute("""CREATE TABLE IF NOT EXISTS mensagens_gemini_cache (
+            chave TEXT PRIMARY KEY,
+            mensagem TEXT NOT NULL,
+            criado_em TEXT NOT NULL,
+            expira_em TEXT NOT NULL
+        ) WITHOUT ROWID""")
+
+    def fetch_mensagem_gemini_cache(self, chave):
+        linha = self.execute_query("SELECT mensagem FROM mensagens_gemini_cache WHERE chave = ? AND expira_em > ?",
+                                   (chave, self._agora_iso()), fetch_one=True)
+        return linha['mensagem'] if linha else None
+
+    def salvar_mensagem_gemini_cache(self, chave, mensagem, ttl_segundos):
+        """Grava (ou renova) a mensagem e aproveita a escrita para descartar as expiradas."""
+        agora = datetime.datetime.now()
+        try:
+            with self.transaction(versionar=False) as cursor:
+                cursor.execute("DELETE FROM mensagens_gemini_cache WHERE expira_em <= ?", (agora.isoformat(timespec='seconds'),))
+                cursor.execute("INSERT OR REPLACE INTO mensagens_gemini_cache (chave, mensagem, criado_em, expira_em) VALUES (?, ?, ?, ?)",
+                               (chave, mensagem, agora.isoformat(timespec='seconds'),
+                                (agora + datetime.timedelta(seconds=ttl_segundos)).isoformat(timespec='seconds')))
+                return True
+        except sqlite3.Error as e:
+            print(f"Erro ao gravar mensagem no cache do Gemini: {e}")
+            return False
+
+    # --- Jobs de exportação (estado visível para todos os processos) ---
+    def _migracao_008_exportacoes_jobs(self, cursor):
+        cursor.execute("""CREATE TABLE IF NOT EXISTS exportacoes_jobs (
+            id TEXT PRIMARY KEY,
+            search TEXT NOT NULL,
+            versao_dados INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            progresso TEXT NOT NULL,
+            arquivo TEXT NOT NULL,
+            instancia TEXT NOT NULL,
+            erro TEXT,
+            criado_em TEXT NOT NULL,
+            atualizado_em REAL NOT NULL,
+            concluido_em TEXT,
+            expira_em REAL
+        ) WITHOUT ROWID""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_exportacoes_jobs_search ON exportacoes_jobs (search, versao_dados)")
+
+    @staticmethod
+    def _job_exportacao(linha):
+        if linha is None:
+            return None
+        job = dict(linha)
+        job['progresso'] = json.loads(job['progresso'])
+        return job
+
+    def criar_job_exportacao(self, job_id, search, versao_dados, progresso, arquivo, instancia, inativo_segundos=300):
+        """Cria o job ou devolve o existente para a mesma pesquisa e versão dos dados. Retorna (job, reutilizado).
+
+        Um job pendente/em execução sem atualização há mais de `inativo_segundos` (processo que caiu)
+        não é reaproveitado. Retorna (None, False) em caso de erro.
+        """
+        agora = time.time()
+        try:
+            with self.transaction(versionar=False) as cursor:
+                existente = cursor.execute("""SELECT * FROM exportacoes_jobs
+                    WHERE search = ? AND versao_dados = ? AND status != 'erro' AND (expira_em IS NULL OR expira_em > ?)
+                      AND (status = 'concluido' OR atualizado_em > ?)
+                    ORDER BY criado_em DESC LIMIT 1""", (search, versao_dados, agora, agora - inativo_segundos)).fetchone()
+                if existente:
+                    return self._job_exportacao(existente), True
+                cursor.execute("""INSERT INTO exportacoes_jobs
+                    (id, search, versao_dados, status, progresso, arquivo, instancia, criado_em, atualizado_em)
+                    VALUES (?, ?, ?, 'pendente', ?, ?, ?, ?, ?)""",
+                    (job_id, search, versao_dados, json.dumps(progresso), arquivo, instancia, self._agora_iso(), agora))
+                novo = cursor.execute("SELECT * FROM exportacoes_jobs WHERE id = ?", (job_id,)).fetchone()
+                return self._job_exportacao(novo), False
+        except sqlite3.Error as e:
+            print(f"Erro ao criar job de exportação: {e}")
+            return None, False
+
+    def atualizar_job_exportacao(self, job_id, status=None, progresso=None, erro=None, expira_em=None):
+        """Grava status/progresso do job; status final ('concluido'/'erro') também registra concluido_em."""
+        final = status in ('concluido', 'erro')
+        try:
+            with self.transaction(versionar=False) as cursor:
+                cursor.execute("""UPDATE exportacoes_jobs SET status = COALESCE(?, status), progresso = COALESCE(?, progresso),
+                    erro = COALESCE(?, erro), expira_em = COALESCE(?, expira_em), atualizado_em = ?,
+                    concluido_em = CASE WHEN ? THEN ? ELSE concluido_em END WHERE id = ?""",
+                    (status, json.dumps(progresso) if progresso is not None else None, erro, expira_em, time.time(),
+                     final, self._agora_iso(), job_id))
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            print(f"Erro ao atualizar job de exportação {job_id}: {e}")
+            return False
+
+    def fetch_job_exportacao(self, job_id):
+        return self._job_exportacao(self.execute_query("SELECT * FROM exportacoes_jobs WHERE id = ?", (job_id,), fetch_one=True))
+
+    def remover_jobs_exportacao_expirados(self, inativo_segundos=300):
+        """Apaga os jobs expirados e os abandonados (sem atualização e sem expira_em). Retorna os arquivos deles."""
+        agora = time.time()
+        try:
+            with self.transaction(versionar=False) as cursor:
+                condicao = "expira_em <= ? OR (expira_em IS NULL AND atualizado_em <= ?)"
+                params = (agora, agora - inativo_segundos)
+                arquivos = [linha['arquivo'] for linha in
+                            cursor.execute(f"SELECT arquivo FROM exportacoes_jobs WHERE {condicao}", params).fetchall()]
+                if arquivos:
+                    cursor.execute(f"DELETE FROM exportacoes_jobs WHERE {condicao}", params)
+                return arquivos
+        except sqlite3.Error as e:
+            print(f"Erro ao remover jobs de exportação expirados: {e}")
+            return []
+
+    # --- Geração de sessão dos usuários ---
+    def _migracao_009_geracao_sessao_usuarios(self, cursor):
+        colunas = {linha['name'] for linha in cursor.execute("PRAGMA table_info(usuarios)").fetchall()}
+        if 'geracao_sessao' not in colunas:
+            cursor.execute("ALTER TABLE usuarios ADD COLUMN geracao_sessao INTEGER NOT NULL DEFAULT 0")
+
+    def get_notification_queue_stats(self):
+        linhas = self.execute_query("SELECT status, COUNT(*) AS total FROM notificacoes_fila GROUP BY status", fetch_all=True) or []
+        stats = {status: 0 for status in self.STATUS_FILA_NOTIFICACAO}
+        stats.update({linha['status']: linha['total'] for linha in linhas})
+        return stats
 
     def close(self):
-        if hasattr(self, 'conn') and self.conn:
-            self.conn.close()
-            self.conn = None
\ No newline at end of file
+        """Fecha a conexão da thread atual e todas as conexões ociosas do pool."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+            with self._pool_cond:
+                self._pool_em_uso -= 1
+        with self._pool_cond:
+            for conn_ociosa in self._pool_ociosas:
+                conn_ociosa.close()
+            self._pool_ociosas = []
+            self._pool_cond.notify_all()
+        with self._writer_lock:
+            if self._writer_conn is not None:
+                self._writer_conn.close()
+                self._writer_conn = None
\ No newline at end of file
@@ -0,0 +1,150 @@
+"""Renderização das notificações (e-mail e WhatsApp) a partir das colunas de CAMPOS_TABELA_NOTIFICACAO.
+
+Os templates Jinja são compilados uma única vez, na criação do RenderizadorNotificacoes, e
+reaproveitados em todas as renderizações. As tabelas podem ser geradas em partes (iter_*),
+sem montar a string inteira, e as mensagens de WhatsApp são divididas no limite de caracteres.
+"""
+from functools import lru_cache
+
+from jinja2 import DictLoader, Environment
+
+TEMPLATE_TABELA_HTML = """\
+<table border='1' cellpadding='5' cellspacing='0' style='border-collapse: collapse; width: 100%;'><thead><tr>
+{%- for chave, rotulo in colunas %}<th>{{ rotulo }}</th>{% endfor -%}
+</tr></thead><tbody>
+{%- for equip in equipamentos %}<tr>
+{%- for chave, rotulo in colunas %}<td>{{ valor_celula(equip, chave) }}</td>{% endfor -%}
+</tr>{% endfor -%}
+</tbody></table>"""
+
+# Mesmo texto que era montado por concatenação: a tabela entra na chave do cache do Gemini
+TEMPLATE_TABELA_WHATSAPP = """\
+{% for equip in equipamentos %}
+*{{ (equip.get('tipo_equipamento_nome') or 'Equipamento') | upper }}*
+{% if campos.nome %}
+  * Nome: {{ equip.get('nome', 'N/D') }}
+{% endif %}
+{% if campos.tag %}
+  * TAG: {{ equip.get('tag', 'N/D') }}
+{% endif %}
+{% if campos.numero_serie %}
+  * Nº Série: {{ equip.get('numero_serie', '(Não informado)') }}
+{% endif %}
+{% if campos.proxima_data_calibracao %}
+  * Próxima Calibração: {{ equip.get('proxima_data_calibracao') | data }}
+{% endif %}
+{% if campos.dias_vencimento %}
+  * Dias para Venc.: {{ equip.get('dias_vencimento') | dias_texto }}
+{% endif %}
+{% if campos.status %}
+  * Status: {{ equip.get('status', 'N/D') }}
+{% endif %}
+{% if campos.localizacao %}
+  * Localização: {{ equip.get('localizacao', 'N/D') }}
+{% endif %}
+
+{% endfor %}"""
+
+
+def dias_vencimento_texto(dias):
+    if dias is None:
+        return "N/A"
+    if dias < 0:
+        return f"{abs(dias)} dia(s) vencido(s)"
+    if dias == 0:
+        return "Vence Hoje"
+    return f"Vence em {dias} dia(s)"
+
+
+@lru_cache(maxsize=32)
+def _partes_corpo(template_usuario, marcador):
+    """Separa o corpo configurado pelo usuário no marcador ({tabela_equipamentos}...), uma vez por texto."""
+    return tuple(template_usuario.split(marcador))
+
+
+class RenderizadorNotificacoes:
+    """Gera as tabelas de e-mail (HTML) e WhatsApp (texto) e monta os corpos com os templates do usuário."""
+    def __init__(self, campos_tabela, formatar_data, limite_whatsapp=4096):
+        self.campos_tabela = campos_tabela
+        self.limite_whatsapp = limite_whatsapp
+        self._env_html = Environment(loader=DictLoader({"tabela.html": TEMPLATE_TABELA_HTML}), autoescape=True)
+        self._env_texto = Environment(loader=DictLoader({"tabela.txt": TEMPLATE_TABELA_WHATSAPP}), autoescape=False,
+                                      trim_blocks=True, lstrip_blocks=True)
+        for env in (self._env_html, self._env_texto):
+            env.filters["data"] = formatar_data
+            env.filters["dias_texto"] = dias_vencimento_texto
+        self._formatar_data = formatar_data
+        self._tabela_html = self._env_html.get_template("tabela.html")
+        self._tabela_texto = self._env_texto.get_template("tabela.txt")
+
+    def colunas(self, campos_selecionados):
+        """(chave, rótulo) das colunas marcadas, na ordem de CAMPOS_TABELA_NOTIFICACAO."""
+        return [(chave, rotulo) for chave, rotulo in self.campos_tabela.items() if campos_selecionados.get(chave)]
+
+    def _valor_celula(self, equip, chave):
+        if chave == "proxima_data_calibracao":
+            return self._formatar_data(equip.get(chave))
+        if chave == "dias_vencimento":
+            return equip['dias_vencimento'] if equip.get('dias_vencimento') is not None else "N/A"
+        return equip.get(chave, 'N/D')
+
+    def iter_tabela_html(self, equipamentos, campos_selecionados):
+        return self._tabela_html.generate(equipamentos=equipamentos, colunas=self.colunas(campos_selecionados),
+                                          valor_celula=self._valor_celula)
+
+    def tabela_html(self, equipamentos, campos_selecionados):
+        return "".join(self.iter_tabela_html(equipamentos, campos_selecionados))
+
+    def tabela_texto(self, equipamentos, campos_selecionados):
+        return "".join(self._tabela_texto.generate(equipamentos=equipamentos, campos=campos_selecionados)).strip()
+
+    @staticmethod
+    def iter_corpo(template_usuario, marcador, conteudo):
+        """Entrega o corpo do usuário com `conteudo` (str ou iterável de partes) no lugar de cada marcador."""
+        partes = _partes_corpo(template_usuario or marcador, marcador)
+        for indice, parte in enumerate(partes):
+            if indice:
+                if isinstance(conteudo, str):
+                    yield conteudo
+                else:
+                    # Um gerador só pode ser consumido uma vez: materializa se houver vários marcadores
+                    conteudo = "".join(conteudo)
+                    yield conteudo
+            if parte:
+                yield parte
+
+    def corpo(self, template_usuario, marcador, conteudo):
+        return "".join(self.iter_corpo(template_usuario, marcador, conteudo))
+
+    def dividir_whatsapp(self, mensagem, limite=None):
+        """Divide a mensagem em partes de até `limite` caracteres.
+
+        Quebra preferencialmente entre blocos (linha em branco), depois entre linhas e, só para
+        uma linha maior que o limite, no meio do texto.
+        """
+        limite = limite or self.limite_whatsapp
+        if len(mensagem) <= limite:
+            return [mensagem]
+        partes, atual = [], ""
+        for bloco in mensagem.split("\n\n"):
+            candidato = f"{atual}\n\n{bloco}" if atual else bloco
+            if len(candidato) <= limite:
+                atual = candidato
+                continue
+            if atual:
+                partes.append(atual)
+            atual = ""
+            for linha in bloco.split("\n"):
+                candidato = f"{atual}\n{linha}" if atual else linha
+                if len(candidato) <= limite:
+                    atual = candidato
+                    continue
+                if atual:
+                    partes.append(atual)
+                while len(linha) > limite:
+                    partes.append(linha[:limite])
+                    linha = linha[limite:]
+                atual = linha
+        if atual:
+            partes.append(atual)
+        return partes